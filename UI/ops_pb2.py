@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: ops.proto
+# Protobuf Python Version: 4.25.1
 """Generated protocol buffer code."""
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
 # @@protoc_insertion_point(imports)
 
 _sym_db = _symbol_database.Default()
@@ -13,181 +14,27 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='ops.proto',
-  package='',
-  syntax='proto3',
-  serialized_options=None,
-  create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\tops.proto\"%\n\x05\x43hunk\x12\x0e\n\x06\x62uffer\x18\x01 \x01(\x0c\x12\x0c\n\x04name\x18\x02 \x01(\t\"\x17\n\x07Request\x12\x0c\n\x04name\x18\x01 \x01(\t\"\x17\n\x05Reply\x12\x0e\n\x06length\x18\x01 \x01(\x05\x32\x44\n\nFileServer\x12\x19\n\x03put\x12\x06.Chunk\x1a\x06.Reply\"\x00(\x01\x12\x1b\n\x03get\x12\x08.Request\x1a\x06.Chunk\"\x00\x30\x01\x62\x06proto3'
-)
-
-
-
-
-_CHUNK = _descriptor.Descriptor(
-  name='Chunk',
-  full_name='Chunk',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='buffer', full_name='Chunk.buffer', index=0,
-      number=1, type=12, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"",
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-    _descriptor.FieldDescriptor(
-      name='name', full_name='Chunk.name', index=1,
-      number=2, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=13,
-  serialized_end=50,
-)
-
-
-_REQUEST = _descriptor.Descriptor(
-  name='Request',
-  full_name='Request',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='name', full_name='Request.name', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=52,
-  serialized_end=75,
-)
-
-
-_REPLY = _descriptor.Descriptor(
-  name='Reply',
-  full_name='Reply',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='length', full_name='Reply.length', index=0,
-      number=1, type=5, cpp_type=1, label=1,
-      has_default_value=False, default_value=0,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=77,
-  serialized_end=100,
-)
-
-DESCRIPTOR.message_types_by_name['Chunk'] = _CHUNK
-DESCRIPTOR.message_types_by_name['Request'] = _REQUEST
-DESCRIPTOR.message_types_by_name['Reply'] = _REPLY
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-Chunk = _reflection.GeneratedProtocolMessageType('Chunk', (_message.Message,), {
-  'DESCRIPTOR' : _CHUNK,
-  '__module__' : 'ops_pb2'
-  # @@protoc_insertion_point(class_scope:Chunk)
-  })
-_sym_db.RegisterMessage(Chunk)
-
-Request = _reflection.GeneratedProtocolMessageType('Request', (_message.Message,), {
-  'DESCRIPTOR' : _REQUEST,
-  '__module__' : 'ops_pb2'
-  # @@protoc_insertion_point(class_scope:Request)
-  })
-_sym_db.RegisterMessage(Request)
-
-Reply = _reflection.GeneratedProtocolMessageType('Reply', (_message.Message,), {
-  'DESCRIPTOR' : _REPLY,
-  '__module__' : 'ops_pb2'
-  # @@protoc_insertion_point(class_scope:Reply)
-  })
-_sym_db.RegisterMessage(Reply)
-
-
-
-_FILESERVER = _descriptor.ServiceDescriptor(
-  name='FileServer',
-  full_name='FileServer',
-  file=DESCRIPTOR,
-  index=0,
-  serialized_options=None,
-  create_key=_descriptor._internal_create_key,
-  serialized_start=102,
-  serialized_end=170,
-  methods=[
-  _descriptor.MethodDescriptor(
-    name='put',
-    full_name='FileServer.put',
-    index=0,
-    containing_service=None,
-    input_type=_CHUNK,
-    output_type=_REPLY,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-  _descriptor.MethodDescriptor(
-    name='get',
-    full_name='FileServer.get',
-    index=1,
-    containing_service=None,
-    input_type=_REQUEST,
-    output_type=_CHUNK,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-])
-_sym_db.RegisterServiceDescriptor(_FILESERVER)
-
-DESCRIPTOR.services_by_name['FileServer'] = _FILESERVER
-
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\tops.proto\"b\n\x05\x43hunk\x12\x0e\n\x06\x62uffer\x18\x01 \x01(\x0c\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x0e\n\x06offset\x18\x03 \x01(\x03\x12\x0c\n\x04size\x18\x04 \x01(\x03\x12\r\n\x05mtime\x18\x05 \x01(\x01\x12\x0e\n\x06\x64igest\x18\x06 \x01(\t\"Y\n\x07Request\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0c\n\x04\x61rea\x18\x02 \x01(\x05\x12\x0e\n\x06offset\x18\x03 \x01(\x03\x12\x0e\n\x06length\x18\x04 \x01(\x03\x12\x12\n\nchunk_size\x18\x05 \x01(\x05\")\n\x08Manifest\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0f\n\x07\x64igests\x18\x02 \x03(\t\"1\n\x04Stat\x12\x0c\n\x04size\x18\x01 \x01(\x03\x12\r\n\x05mtime\x18\x02 \x01(\x01\x12\x0c\n\x04hash\x18\x03 \x01(\t\"%\n\x05Reply\x12\x0e\n\x06length\x18\x01 \x01(\x03\x12\x0c\n\x04hash\x18\x02 \x01(\t\"#\n\x10HeartbeatRequest\x12\x0f\n\x07message\x18\x01 \x01(\t\"$\n\x11HeartbeatResponse\x12\x0f\n\x07message\x18\x01 \x01(\t2\x92\x02\n\nFileServer\x12\x19\n\x03put\x12\x06.Chunk\x1a\x06.Reply\"\x00(\x01\x12\x1b\n\x03get\x12\x08.Request\x1a\x06.Chunk\"\x00\x30\x01\x12!\n\tget_range\x12\x08.Request\x1a\x06.Chunk\"\x00\x30\x01\x12\x19\n\x04stat\x12\x08.Request\x1a\x05.Stat\"\x00\x12$\n\nhas_chunks\x12\t.Manifest\x1a\t.Manifest\"\x00\x12\x34\n\theartbeat\x12\x11.HeartbeatRequest\x1a\x12.HeartbeatResponse\"\x00\x12\x32\n\x05watch\x12\x11.HeartbeatRequest\x1a\x12.HeartbeatResponse\"\x00\x30\x01\x62\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'ops_pb2', _globals)
+if _descriptor._USE_C_DESCRIPTORS == False:
+  DESCRIPTOR._options = None
+  _globals['_CHUNK']._serialized_start=13
+  _globals['_CHUNK']._serialized_end=111
+  _globals['_REQUEST']._serialized_start=113
+  _globals['_REQUEST']._serialized_end=202
+  _globals['_MANIFEST']._serialized_start=204
+  _globals['_MANIFEST']._serialized_end=245
+  _globals['_STAT']._serialized_start=247
+  _globals['_STAT']._serialized_end=296
+  _globals['_REPLY']._serialized_start=298
+  _globals['_REPLY']._serialized_end=335
+  _globals['_HEARTBEATREQUEST']._serialized_start=337
+  _globals['_HEARTBEATREQUEST']._serialized_end=372
+  _globals['_HEARTBEATRESPONSE']._serialized_start=374
+  _globals['_HEARTBEATRESPONSE']._serialized_end=410
+  _globals['_FILESERVER']._serialized_start=413
+  _globals['_FILESERVER']._serialized_end=687
 # @@protoc_insertion_point(module_scope)
@@ -24,6 +24,31 @@ class FileServerStub(object):
                 request_serializer=ops__pb2.Request.SerializeToString,
                 response_deserializer=ops__pb2.Chunk.FromString,
                 )
+        self.get_range = channel.unary_stream(
+                '/FileServer/get_range',
+                request_serializer=ops__pb2.Request.SerializeToString,
+                response_deserializer=ops__pb2.Chunk.FromString,
+                )
+        self.stat = channel.unary_unary(
+                '/FileServer/stat',
+                request_serializer=ops__pb2.Request.SerializeToString,
+                response_deserializer=ops__pb2.Stat.FromString,
+                )
+        self.has_chunks = channel.unary_unary(
+                '/FileServer/has_chunks',
+                request_serializer=ops__pb2.Manifest.SerializeToString,
+                response_deserializer=ops__pb2.Manifest.FromString,
+                )
+        self.heartbeat = channel.unary_unary(
+                '/FileServer/heartbeat',
+                request_serializer=ops__pb2.HeartbeatRequest.SerializeToString,
+                response_deserializer=ops__pb2.HeartbeatResponse.FromString,
+                )
+        self.watch = channel.unary_stream(
+                '/FileServer/watch',
+                request_serializer=ops__pb2.HeartbeatRequest.SerializeToString,
+                response_deserializer=ops__pb2.HeartbeatResponse.FromString,
+                )
 
 
 class FileServerServicer(object):
@@ -41,6 +66,36 @@ class FileServerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def get_range(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def stat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def has_chunks(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def heartbeat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def watch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_FileServerServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -54,6 +109,31 @@ def add_FileServerServicer_to_server(servicer, server):
                     request_deserializer=ops__pb2.Request.FromString,
                     response_serializer=ops__pb2.Chunk.SerializeToString,
             ),
+            'get_range': grpc.unary_stream_rpc_method_handler(
+                    servicer.get_range,
+                    request_deserializer=ops__pb2.Request.FromString,
+                    response_serializer=ops__pb2.Chunk.SerializeToString,
+            ),
+            'stat': grpc.unary_unary_rpc_method_handler(
+                    servicer.stat,
+                    request_deserializer=ops__pb2.Request.FromString,
+                    response_serializer=ops__pb2.Stat.SerializeToString,
+            ),
+            'has_chunks': grpc.unary_unary_rpc_method_handler(
+                    servicer.has_chunks,
+                    request_deserializer=ops__pb2.Manifest.FromString,
+                    response_serializer=ops__pb2.Manifest.SerializeToString,
+            ),
+            'heartbeat': grpc.unary_unary_rpc_method_handler(
+                    servicer.heartbeat,
+                    request_deserializer=ops__pb2.HeartbeatRequest.FromString,
+                    response_serializer=ops__pb2.HeartbeatResponse.SerializeToString,
+            ),
+            'watch': grpc.unary_stream_rpc_method_handler(
+                    servicer.watch,
+                    request_deserializer=ops__pb2.HeartbeatRequest.FromString,
+                    response_serializer=ops__pb2.HeartbeatResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'FileServer', rpc_method_handlers)
@@ -97,3 +177,88 @@ class FileServer(object):
             ops__pb2.Chunk.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def get_range(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/FileServer/get_range',
+            ops__pb2.Request.SerializeToString,
+            ops__pb2.Chunk.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def stat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/FileServer/stat',
+            ops__pb2.Request.SerializeToString,
+            ops__pb2.Stat.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def has_chunks(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/FileServer/has_chunks',
+            ops__pb2.Manifest.SerializeToString,
+            ops__pb2.Manifest.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def heartbeat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/FileServer/heartbeat',
+            ops__pb2.HeartbeatRequest.SerializeToString,
+            ops__pb2.HeartbeatResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def watch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/FileServer/watch',
+            ops__pb2.HeartbeatRequest.SerializeToString,
+            ops__pb2.HeartbeatResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
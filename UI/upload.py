@@ -1,5 +1,6 @@
 import os
 import grpc
+import hashlib
 import tkinter as tk
 from tkinter import filedialog
 import ops_pb2_grpc
@@ -18,11 +19,23 @@ class FileClient:
         channel = grpc.insecure_channel(address)
         self.stub = ops_pb2_grpc.FileServerStub(channel)
 
-    def get_file_chunks(self, filename):
+    def get_digests(self, filename):
         """
-        Reads the file in chunks of size CHUNK_SIZE and yields a Chunk message for each chunk
+        Hashes the file in chunks of size CHUNK_SIZE
+
+        :param filename: The name of the file to be sent to the server
+        :return: The SHA-256 hex digests of the chunks
+        """
+        with open(filename, 'rb') as f:
+            return [hashlib.sha256(piece).hexdigest() for piece in iter(lambda: f.read(CHUNK_SIZE), b'')]
+
+    def get_file_chunks(self, filename, missing=None):
+        """
+        Reads the file in chunks of size CHUNK_SIZE and yields a Chunk message for each chunk. Chunks the
+        server already has are sent as their digest only.
         
         :param filename: The name of the file to be sent to the server
+        :param missing: The digests of the chunks the server does not have, or None to send every chunk
         :return: A generator object.
         """
         with open(filename, 'rb') as f:
@@ -30,16 +43,28 @@ class FileClient:
                 piece = f.read(CHUNK_SIZE)
                 if len(piece) == 0:
                     return
-                yield ops_pb2.Chunk(buffer=piece, name=filename.split('/')[-1])
+                digest = hashlib.sha256(piece).hexdigest()
+                if missing is None or digest in missing:
+                    yield ops_pb2.Chunk(buffer=piece, name=filename.split('/')[-1], digest=digest)
+                else:
+                    yield ops_pb2.Chunk(name=filename.split('/')[-1], digest=digest)
 
     def upload(self, in_file_name):
         """
-        It takes a file name, splits it into chunks, and sends those chunks to the server
+        It takes a file name, splits it into chunks, asks the server which of them it is missing, and
+        sends only those chunks in full
         
         :param in_file_name: The name of the file to upload
         """
-        chunks_generator = self.get_file_chunks(in_file_name)
-        response = self.stub.put(chunks_generator)
+        manifest = ops_pb2.Manifest(name=in_file_name.split('/')[-1], digests=self.get_digests(in_file_name))
+        missing = set(self.stub.has_chunks(manifest).digests)
+        try:
+            response = self.stub.put(self.get_file_chunks(in_file_name, missing))
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.FAILED_PRECONDITION:
+                raise
+            # a chunk was removed since the check, so upload every chunk
+            response = self.stub.put(self.get_file_chunks(in_file_name))
         assert response.length == os.path.getsize(in_file_name)
 
 class UploadGUI:
@@ -0,0 +1,651 @@
+import grpc
+import os
+import signal
+import asyncio
+import re
+import json
+import hashlib
+import tempfile
+import mmap
+import logging
+from concurrent import futures
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+import time
+
+import ops_pb2
+import ops_pb2_grpc
+
+CHUNK_GC_INTERVAL = float(os.environ.get('CHUNK_GC_INTERVAL', 3600))
+CHUNK_GC_GRACE = float(os.environ.get('CHUNK_GC_GRACE', 3600))  # seconds an unreferenced chunk is kept
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 1024 * 1024  # 1MB
+MMAP_CACHE_ENTRIES = int(os.environ.get('MMAP_CACHE_ENTRIES', 256))  # open mappings of hot files
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 3 * 1024 * 1024  # stays below the 4MB default gRPC message limit
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 5))  # threads of the threaded server
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 32))  # threads the async server runs file I/O on
+MAX_CONCURRENT_RPCS = int(os.environ.get('MAX_CONCURRENT_RPCS', 0))  # 0 leaves the async server unbounded
+MAX_CONCURRENT_STREAMS = int(os.environ.get('MAX_CONCURRENT_STREAMS', 100))  # per connection
+STREAM_WINDOW = int(os.environ.get('STREAM_WINDOW', 4 * 1024 * 1024))  # bytes in flight per stream
+MAX_WATCHERS = int(os.environ.get('MAX_WATCHERS', 16))  # health watch streams of the threaded server
+WATCH_INTERVAL = float(os.environ.get('WATCH_INTERVAL', 5))  # how often idle watches check for cancellation
+SHUTDOWN_GRACE = float(os.environ.get('SHUTDOWN_GRACE', 5))
+KEEPALIVE_MIN_TIME = float(os.environ.get('KEEPALIVE_MIN_TIME', 5))  # at most the KEEPALIVE_TIME of the proxies
+SERVER_OPTIONS = [('grpc.max_concurrent_streams', MAX_CONCURRENT_STREAMS),
+                  ('grpc.http2.lookahead_bytes', STREAM_WINDOW),
+                  # accept the keepalive pings proxies send on their idle channels, and never close a
+                  # connection with a GOAWAY too_many_pings over pings that arrive early
+                  ('grpc.keepalive_permit_without_calls', 1),
+                  ('grpc.http2.min_ping_interval_without_data_ms', int(KEEPALIVE_MIN_TIME * 1000)),
+                  ('grpc.http2.max_ping_strikes', 0)]
+
+
+def negotiate_chunk_size(requested):
+    """
+    :return: The size of the chunks to answer a request with, the requested size bounded by MIN_CHUNK_SIZE
+    and MAX_CHUNK_SIZE, or CHUNK_SIZE if the request did not ask for one
+    """
+    if requested <= 0:
+        return CHUNK_SIZE
+    return max(MIN_CHUNK_SIZE, min(requested, MAX_CHUNK_SIZE))
+
+
+class MissingChunk(Exception):
+    pass
+
+
+class ObjectStore:
+    def __init__(self, root):
+        """
+        Stores uploaded files as manifests of the SHA-256 digests of their chunks, and keeps each distinct
+        chunk once in a content-addressed chunk directory. Chunks shared between files or versions of a
+        file are only stored and transferred once. Files stored before manifests existed are still served
+        as plain files.
+
+        :param root: The storage directory
+        """
+        self.root = root
+        self.chunk_dir = os.path.join(root, '.chunks')
+        self.manifest_dir = os.path.join(root, '.manifests')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.hashes = {}
+        # read-only mappings of hot files, by path, with the inode, size and mtime they were mapped at
+        self.mappings = OrderedDict()
+        self.mappings_lock = Lock()
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest)
+
+    def manifest_path(self, filename):
+        return os.path.join(self.manifest_dir, filename)
+
+    def _write(self, path, data):
+        """
+        Writes a file through a temporary file and a rename, so readers never see it partially written
+        """
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_name, path)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+    def _manifest(self, filename):
+        """
+        :return: The manifest of a file with its modification time, or None if the file has no manifest
+        """
+        try:
+            with open(self.manifest_path(filename)) as f:
+                manifest = json.load(f)
+                manifest['mtime'] = os.fstat(f.fileno()).st_mtime
+                return manifest
+        except FileNotFoundError:
+            return None
+
+    def missing(self, digests):
+        """
+        Finds the chunks the store does not have. The chunks it has are touched, so they are not
+        collected before the upload that refers to them completes.
+
+        :param digests: The SHA-256 hex digests of the chunks
+        :return: The digests of the missing chunks
+        """
+        missing = []
+        for digest in digests:
+            try:
+                if not DIGEST.match(digest):
+                    raise FileNotFoundError(digest)
+                os.utime(self.chunk_path(digest))
+            except FileNotFoundError:
+                missing.append(digest)
+
+        return missing
+
+    def save(self, chunks):
+        """
+        Stores the chunks of an upload, and commits the manifest of the file once all of them are stored,
+        so readers never see a partial file. A chunk with a digest but no buffer refers to a chunk that is
+        already in the store.
+
+        :param chunks: The chunks of the file that were uploaded
+        :return: A tuple of the file name, size and SHA-256 hex digest of the file that was just saved,
+        or a tuple of Nones if the upload was empty.
+        """
+        filename, entries, size, file_digest = None, [], 0, hashlib.sha256()
+        for chunk in chunks:
+            filename = filename or chunk.name
+            if chunk.buffer:
+                piece, digest = chunk.buffer, hashlib.sha256(chunk.buffer).hexdigest()
+                if chunk.digest and chunk.digest != digest:
+                    raise ValueError(f"Chunk {len(entries)} of {filename} does not match its digest")
+                if self.missing([digest]):
+                    self._write(self.chunk_path(digest), piece)
+            elif chunk.digest:
+                digest = chunk.digest
+                if self.missing([digest]):
+                    raise MissingChunk(digest)
+                with open(self.chunk_path(digest), 'rb') as f:
+                    piece = f.read()
+            else:
+                continue
+
+            file_digest.update(piece)
+            entries.append([digest, len(piece)])
+            size += len(piece)
+
+        if filename is None:
+            return None, None, None
+
+        manifest = {'size': size, 'hash': file_digest.hexdigest(), 'chunks': entries}
+        self._write(self.manifest_path(filename), json.dumps(manifest).encode())
+        if os.path.exists(os.path.join(self.root, filename)):
+            # the manifest replaces the plain file stored before manifests existed
+            os.remove(os.path.join(self.root, filename))
+
+        return filename, size, file_digest.hexdigest()
+
+    def digests(self, filename):
+        """
+        :return: The digests of the chunks of a file, or None if it is a plain file
+        """
+        manifest = self._manifest(filename)
+        return None if manifest is None else [digest for digest, _ in manifest['chunks']]
+
+    def info(self, filename):
+        """
+        Returns the size, modification time and SHA-256 hash of a file. The hash of a plain file is
+        reused while its size and modification time are unchanged.
+
+        :param filename: The name of the file
+        :return: A tuple of the size, modification time and hex digest of the file.
+        """
+        manifest = self._manifest(filename)
+        if manifest is not None:
+            return manifest['size'], manifest['mtime'], manifest['hash']
+
+        path = os.path.join(self.root, filename)
+        stat = os.stat(path)
+        cached = self.hashes.get(filename)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return stat.st_size, stat.st_mtime, cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for piece in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(piece)
+
+        self.hashes[filename] = ((stat.st_size, stat.st_mtime_ns), digest.hexdigest())
+        return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+    def _map(self, path):
+        """
+        Returns a read-only memory mapping of a file, reusing the mapping while the file is unchanged, so
+        concurrent reads of a hot file share its pages instead of each reading it again. At most
+        MMAP_CACHE_ENTRIES mappings are kept, and an evicted mapping is closed once no read uses it anymore.
+
+        :param path: The path of the file
+        :return: The mapping
+        """
+        stat = os.stat(path)
+        version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.mappings_lock:
+            cached = self.mappings.get(path)
+            if cached and cached[0] == version:
+                self.mappings.move_to_end(path)
+                return cached[1]
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0:
+                return b''
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with self.mappings_lock:
+            self.mappings[path] = ((stat.st_ino, stat.st_size, stat.st_mtime_ns), mapping)
+            self.mappings.move_to_end(path)
+            while len(self.mappings) > MMAP_CACHE_ENTRIES:
+                self.mappings.popitem(last=False)
+
+        return mapping
+
+    def read(self, filename, offset=0, length=0, chunk_size=CHUNK_SIZE):
+        """
+        Reads length bytes of a file starting at offset, sliced out of the mappings of its chunks or
+        of the plain file
+
+        :param filename: The name of the file
+        :param offset: The position of the first byte to read
+        :param length: The number of bytes to read, 0 reads the rest of the file
+        :param chunk_size: The maximum size of the pieces
+        :return: A generator of tuples of the offset of a piece of at most chunk_size bytes, the piece,
+        and the size and modification time of the file.
+        """
+        manifest = self._manifest(filename)
+        if manifest is not None:
+            size, mtime = manifest['size'], manifest['mtime']
+            segments = [(self.chunk_path(digest), chunk_size) for digest, chunk_size in manifest['chunks']]
+        else:
+            path = os.path.join(self.root, filename)
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+            segments = [(path, size)]
+
+        end = size if length <= 0 else min(offset + length, size)
+        position = 0
+        for path, segment_size in segments:
+            segment_end = min(position + segment_size, end)
+            if offset < segment_end:
+                mapping = self._map(path)
+                while offset < segment_end:
+                    piece = mapping[offset - position:min(offset + chunk_size, segment_end) - position]
+                    if len(piece) == 0:
+                        return
+                    yield offset, piece, size, mtime
+                    offset += len(piece)
+
+            position += segment_size
+            if offset >= end:
+                return
+
+    def read_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            return f.read()
+
+    def collect_garbage(self):
+        """
+        Removes the chunks no manifest refers to that were not touched for CHUNK_GC_GRACE seconds
+        """
+        referenced = set()
+        for filename in os.listdir(self.manifest_dir):
+            manifest = self._manifest(filename) if not filename.startswith('.upload-') else None
+            if manifest is not None:
+                referenced.update(digest for digest, _ in manifest['chunks'])
+
+        removed = 0
+        for digest in os.listdir(self.chunk_dir):
+            path = self.chunk_path(digest)
+            if DIGEST.match(digest) and digest not in referenced and time.time() - os.stat(path).st_mtime > CHUNK_GC_GRACE:
+                os.remove(path)
+                removed += 1
+
+        logging.info(f"Collected {removed} unreferenced chunks")
+
+    def run_garbage_collection(self):
+        while True:
+            time.sleep(CHUNK_GC_INTERVAL)
+            try:
+                self.collect_garbage()
+            except OSError as e:
+                logging.error(f"Chunk garbage collection failed. {str(e)}")
+
+
+class UploadError(Exception):
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
+class FileServer(ops_pb2_grpc.FileServerServicer):
+
+    def __init__(self, storage_dir):
+        """
+        Serves the files of an object store. The origin and the backups extend it with what they do
+        on top of storing and serving files.
+
+        :param storage_dir: The storage directory
+        """
+        self.origin_files = storage_dir
+        self.store = ObjectStore(storage_dir)
+        self.serving = True
+        self.health = Condition()
+        self.watchers = 0
+
+    def _get_file_chunks(self, filename, chunk_size=CHUNK_SIZE):
+        """
+        Reads the file in chunks of chunk_size, and yields each chunk as a Chunk message
+
+        :param filename: The name of the file to be sent to the server
+        :param chunk_size: The maximum size of the chunks
+        :return: A generator object.
+        """
+        try:
+            for offset, piece, size, mtime in self.store.read(filename, chunk_size=chunk_size):
+                yield ops_pb2.Chunk(buffer=piece, name=filename, mtime=mtime)
+
+        except Exception as e:
+            logging.error(f"Error: {self.origin_files + filename}. {str(e)}")
+
+    def _get_file_range(self, filename, offset, length, chunk_size=CHUNK_SIZE):
+        """
+        Reads length bytes of the file starting at offset in chunks of chunk_size, and yields each chunk
+        as a Chunk message carrying its offset and the total size of the file
+
+        :param filename: The name of the file to be sent to the server
+        :param offset: The position of the first byte to send
+        :param length: The number of bytes to send, 0 sends the rest of the file
+        :param chunk_size: The maximum size of the chunks
+        :return: A generator object.
+        """
+        try:
+            for offset, piece, size, mtime in self.store.read(filename, offset, length, chunk_size):
+                yield ops_pb2.Chunk(buffer=piece, name=filename, offset=offset, size=size, mtime=mtime)
+
+        except Exception as e:
+            logging.error(f"Error: {self.origin_files + filename}. {str(e)}")
+
+    def _put(self, request_iterator):
+        """
+        Takes a stream of chunks, saves them to the object store, and returns the size of the file
+
+        :param request_iterator: Iterator that will be used to iterate over the chunks of data
+        that are sent by the client
+        :return: The size of the file that was saved.
+        """
+        try:
+            filename, size, digest = self.store.save(request_iterator)
+        except MissingChunk as e:
+            raise UploadError(grpc.StatusCode.FAILED_PRECONDITION, f"Chunk {e} is missing, upload it in full")
+        except ValueError as e:
+            raise UploadError(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        if filename is None:
+            raise UploadError(grpc.StatusCode.INVALID_ARGUMENT, "Empty upload")
+
+        logging.info(f"Stored file {filename} ({digest})")
+        return ops_pb2.Reply(length=size, hash=digest)
+
+    def put(self, request_iterator, context):
+        """
+        Takes a stream of chunks, saves them to a file, and returns the size of the file
+
+        :param request_iterator: Iterator that will be used to iterate over the chunks of data
+        that are sent by the client
+        :param context: This is the context object that is passed to the server.
+        :return: The size of the file that was saved.
+        """
+        try:
+            return self._put(request_iterator)
+        except UploadError as e:
+            context.abort(e.code, e.details)
+
+    def get(self, request, context):
+        """
+        It takes a request object, and returns a response object
+
+        :param request: The request object that was sent from the client
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: The file chunks
+        """
+        time.sleep(2)
+        if request.name:
+            logging.info(f"Served file {request.name}")
+            return self._get_file_chunks(request.name, negotiate_chunk_size(request.chunk_size))
+
+    def get_range(self, request, context):
+        """
+        Returns the chunks covering a byte range of the requested file
+
+        :param request: The request object with the file name, offset and length of the range
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: The file chunks
+        """
+        time.sleep(2)
+        if request.name:
+            logging.info(f"Served range {request.offset}+{request.length} of file {request.name}")
+            return self._get_file_range(request.name, request.offset, request.length,
+                                        negotiate_chunk_size(request.chunk_size))
+
+    def has_chunks(self, request, context):
+        """
+        Returns the digests of the chunks of a manifest that are not stored yet, so an uploader can send
+        only those and refer to the others by their digest
+
+        :param request: A Manifest message with the digests of the chunks of the file to upload
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: A Manifest message with the digests of the missing chunks
+        """
+        return ops_pb2.Manifest(name=request.name, digests=self.store.missing(request.digests))
+
+    def stat(self, request, context):
+        """
+        Returns the size, modification time and content hash of the requested file, so proxies can
+        revalidate their cached copy without downloading it again
+
+        :param request: The request object that was sent from the client
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: A Stat message
+        """
+        try:
+            size, mtime, digest = self.store.info(request.name)
+        except OSError:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"File {request.name} not found")
+
+        return ops_pb2.Stat(size=size, mtime=mtime, hash=digest)
+
+    def heartbeat(self, request, context):
+        """
+        Handles heartbeat requests from other servers or clients.
+
+        :param request: The request object that was sent from the client
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: A heartbeat response object
+        """
+        return self._health()
+
+    def _health(self):
+        return ops_pb2.HeartbeatResponse(message="acknowledged" if self.serving else "not serving")
+
+    def set_serving(self, serving):
+        """
+        Changes the health state the server reports, waking up the health watches
+
+        :param serving: Whether the server accepts requests
+        """
+        with self.health:
+            self.serving = serving
+            self.health.notify_all()
+
+    def watch(self, request, context):
+        """
+        Streams the health of the server, sending its state when the watch starts and whenever it changes,
+        so clients learn of changes without polling and of a dead server from the broken stream. Every
+        watch holds a worker thread, so at most MAX_WATCHERS run at once.
+
+        :param request: The request object that was sent from the client
+        :param context: The context is a value passed in by the server and contains RPC-specific information
+        :return: A generator of heartbeat responses
+        """
+        with self.health:
+            if self.watchers >= MAX_WATCHERS:
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Too many health watches")
+            self.watchers += 1
+
+        try:
+            serving = None
+            while context.is_active():
+                with self.health:
+                    self.health.wait_for(lambda: self.serving != serving, timeout=WATCH_INTERVAL)
+                    changed, serving = self.serving != serving, self.serving
+                if changed:
+                    yield self._health()
+        finally:
+            with self.health:
+                self.watchers -= 1
+
+
+class AsyncFileServer(FileServer):
+
+    def __init__(self, io_pool):
+        """
+        Serves the same RPCs as the FileServer it is mixed into on a grpc.aio server. The blocking file I/O of every RPC runs
+        on a bounded pool, and a stream only reads its next chunk once grpc has sent the previous one, so
+        a slow receiver holds back its own stream instead of buffering it in memory.
+
+        :param io_pool: The executor file I/O is offloaded to
+        """
+        super().__init__()
+        self.io_pool = io_pool
+        self.changed = asyncio.Event()
+
+    async def _offload(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, function, *args)
+
+    async def _iterate(self, chunks):
+        """
+        Pulls the chunks of a blocking generator one at a time on the I/O pool
+
+        :param chunks: A generator of Chunk messages
+        :return: An async generator object.
+        """
+        try:
+            while True:
+                chunk = await self._offload(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                # the stream was cancelled while a read was still running on the pool
+                pass
+
+    def _blocking_iterator(self, request_iterator, loop):
+        """
+        Iterates an async request stream from a thread of the I/O pool
+
+        :param request_iterator: The async iterator of the uploaded chunks
+        :param loop: The event loop the request stream belongs to
+        :return: A generator object.
+        """
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(request_iterator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+
+    async def put(self, request_iterator, context):
+        try:
+            chunks = self._blocking_iterator(request_iterator, asyncio.get_running_loop())
+            return await self._offload(self._put, chunks)
+        except UploadError as e:
+            await context.abort(e.code, e.details)
+
+    async def get(self, request, context):
+        await asyncio.sleep(2)
+        if request.name:
+            logging.info(f"Served file {request.name}")
+            async for chunk in self._iterate(self._get_file_chunks(request.name, negotiate_chunk_size(request.chunk_size))):
+                yield chunk
+
+    async def get_range(self, request, context):
+        await asyncio.sleep(2)
+        if request.name:
+            logging.info(f"Served range {request.offset}+{request.length} of file {request.name}")
+            chunks = self._get_file_range(request.name, request.offset, request.length,
+                                          negotiate_chunk_size(request.chunk_size))
+            async for chunk in self._iterate(chunks):
+                yield chunk
+
+    async def has_chunks(self, request, context):
+        return ops_pb2.Manifest(name=request.name, digests=await self._offload(self.store.missing, list(request.digests)))
+
+    async def stat(self, request, context):
+        try:
+            size, mtime, digest = await self._offload(self.store.info, request.name)
+        except OSError:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"File {request.name} not found")
+
+        return ops_pb2.Stat(size=size, mtime=mtime, hash=digest)
+
+    async def heartbeat(self, request, context):
+        return self._health()
+
+    def set_serving(self, serving):
+        super().set_serving(serving)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def watch(self, request, context):
+        while True:
+            changed = self.changed
+            yield self._health()
+            await changed.wait()
+
+
+def run_server(servicer_class, port, name):
+    """
+    Runs a servicer on a threaded gRPC server until it is stopped. On SIGTERM the servicer reports
+    not serving first, so proxies fail over before the server stops.
+
+    :param servicer_class: The FileServer class to serve
+    :param port: The port to listen on
+    :param name: The name of the server to log
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=MAX_WORKERS + MAX_WATCHERS), options=SERVER_OPTIONS)
+    servicer = servicer_class()
+    ops_pb2_grpc.add_FileServerServicer_to_server(servicer, server)
+    Thread(target=servicer.store.run_garbage_collection, daemon=True).start()
+    server.add_insecure_port(f'[::]:{port}')
+
+    def shutdown(signum, frame):
+        servicer.set_serving(False)
+        server.stop(SHUTDOWN_GRACE)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    logging.info(f"{name} start on port {port}")
+    server.start()
+    server.wait_for_termination()
+
+
+async def run_async_server(servicer_class, port, name):
+    """
+    The async counterpart of run_server, on a grpc.aio server with file I/O on IO_WORKERS threads.
+
+    :param servicer_class: The AsyncFileServer class to serve
+    :param port: The port to listen on
+    :param name: The name of the server to log
+    """
+    io_pool = futures.ThreadPoolExecutor(max_workers=IO_WORKERS)
+    server = grpc.aio.server(options=SERVER_OPTIONS, maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS or None)
+    servicer = servicer_class(io_pool)
+    ops_pb2_grpc.add_FileServerServicer_to_server(servicer, server)
+    Thread(target=servicer.store.run_garbage_collection, daemon=True).start()
+    server.add_insecure_port(f'[::]:{port}')
+
+    loop = asyncio.get_running_loop()
+
+    def shutdown():
+        servicer.set_serving(False)
+        loop.create_task(server.stop(SHUTDOWN_GRACE))
+    loop.add_signal_handler(signal.SIGTERM, shutdown)
+
+    logging.info(f"{name} start on port {port}")
+    await server.start()
+    await server.wait_for_termination()
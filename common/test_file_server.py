@@ -0,0 +1,219 @@
+import os
+import time
+import types
+import asyncio
+import hashlib
+import threading
+from concurrent import futures
+
+import grpc
+import pytest
+
+import ops_pb2
+import ops_pb2_grpc
+import file_server
+from file_server import ObjectStore, MissingChunk, FileServer, AsyncFileServer, negotiate_chunk_size
+
+
+def chunk(name, data=b'', digest=''):
+    return ops_pb2.Chunk(name=name, buffer=data, digest=digest)
+
+
+def sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ObjectStore(str(tmp_path))
+
+
+@pytest.fixture
+def no_delay(monkeypatch):
+    # get and get_range simulate a slow origin with a 2 second sleep
+    monkeypatch.setattr(file_server, 'time', types.SimpleNamespace(sleep=lambda seconds: None, time=time.time))
+
+
+def read_all(store, filename, *args):
+    return b''.join(piece for _, piece, _, _ in store.read(filename, *args))
+
+
+def test_save_rejects_missing_and_mismatched_chunks_without_committing(store):
+    with pytest.raises(MissingChunk):
+        store.save([chunk('a', digest=sha(b'never uploaded'))])
+    with pytest.raises(ValueError):
+        store.save([chunk('a', b'data', digest=sha(b'other data'))])
+
+    assert store.digests('a') is None
+    assert not [name for name in os.listdir(store.manifest_dir) if name.startswith('.upload-')]
+
+
+def test_file_server_rpcs(tmp_path, grpc_server, no_delay):
+    address = grpc_server(FileServer(str(tmp_path) + '/'))
+    stub = ops_pb2_grpc.FileServerStub(grpc.insecure_channel(address))
+    data = os.urandom(300 * 1024)
+
+    reply = stub.put(iter([chunk('f', data[:200 * 1024]), chunk('f', data[200 * 1024:])]))
+    assert (reply.length, reply.hash) == (len(data), sha(data))
+    assert stub.stat(ops_pb2.Request(name='f')).hash == sha(data)
+    assert stub.has_chunks(ops_pb2.Manifest(name='g', digests=[sha(data[:200 * 1024]), sha(b'x')])).digests == [sha(b'x')]
+
+    pieces = list(stub.get(ops_pb2.Request(name='f', chunk_size=64 * 1024)))
+    assert b''.join(piece.buffer for piece in pieces) == data
+    assert max(len(piece.buffer) for piece in pieces) == 64 * 1024
+
+    ranged = list(stub.get_range(ops_pb2.Request(name='f', offset=1000, length=5000)))
+    assert b''.join(piece.buffer for piece in ranged) == data[1000:6000]
+    assert ranged[0].offset == 1000 and ranged[0].size == len(data)
+
+    with pytest.raises(grpc.RpcError) as error:
+        stub.stat(ops_pb2.Request(name='missing'))
+    assert error.value.code() == grpc.StatusCode.NOT_FOUND
+    with pytest.raises(grpc.RpcError) as error:
+        stub.put(iter([chunk('f', digest=sha(b'unknown'))]))
+    assert error.value.code() == grpc.StatusCode.FAILED_PRECONDITION
+
+
+def test_save_stores_a_manifest_and_each_distinct_chunk_once(store):
+    name, size, digest = store.save([chunk('a', b'x' * 10), chunk('a', b'y' * 5), chunk('a', b'x' * 10)])
+
+    assert (name, size, digest) == ('a', 25, sha(b'x' * 10 + b'y' * 5 + b'x' * 10))
+    assert sorted(os.listdir(store.chunk_dir)) == sorted([sha(b'x' * 10), sha(b'y' * 5)])
+    assert store.digests('a') == [sha(b'x' * 10), sha(b'y' * 5), sha(b'x' * 10)]
+    assert read_all(store, 'a') == b'x' * 10 + b'y' * 5 + b'x' * 10
+    assert store.info('a')[0::2] == (25, digest)
+
+
+def test_save_resolves_digest_only_chunks_from_the_store(store):
+    store.save([chunk('a', b'shared')])
+
+    assert store.missing([sha(b'shared'), sha(b'other'), 'not a digest']) == [sha(b'other'), 'not a digest']
+    store.save([chunk('b', digest=sha(b'shared')), chunk('b', b'!')])
+    assert read_all(store, 'b') == b'shared!'
+
+
+def test_plain_files_stored_before_manifests_are_still_served(store, tmp_path):
+    (tmp_path / 'old.txt').write_bytes(b'legacy contents')
+
+    assert read_all(store, 'old.txt', 7, 4) == b'cont'
+    assert store.info('old.txt')[2] == sha(b'legacy contents')
+
+    store.save([chunk('old.txt', b'new')])
+    assert not (tmp_path / 'old.txt').exists()
+    assert read_all(store, 'old.txt') == b'new'
+
+
+def test_garbage_collection_only_removes_old_unreferenced_chunks(store, monkeypatch):
+    store.save([chunk('a', b'kept')])
+    store.save([chunk('b', b'dropped')])
+    store.save([chunk('b', b'replacement')])
+    old = time.time() - 10
+    for digest in os.listdir(store.chunk_dir):
+        os.utime(store.chunk_path(digest), (old, old))
+
+    monkeypatch.setattr(file_server, 'CHUNK_GC_GRACE', 5)
+    store.collect_garbage()
+
+    assert sorted(os.listdir(store.chunk_dir)) == sorted([sha(b'kept'), sha(b'replacement')])
+
+
+@pytest.fixture
+def async_server(tmp_path):
+    """
+    Runs an AsyncFileServer on a grpc.aio server in an event loop of its own thread.
+    """
+    class Server(FileServer):
+        def __init__(self):
+            super().__init__(str(tmp_path) + '/')
+
+    class AsyncServer(AsyncFileServer, Server):
+        pass
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def start():
+        server = grpc.aio.server(options=file_server.SERVER_OPTIONS)
+        servicer = AsyncServer(futures.ThreadPoolExecutor(max_workers=4))
+        ops_pb2_grpc.add_FileServerServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        return server, servicer, port
+
+    server, servicer, port = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    yield servicer, f'127.0.0.1:{port}', loop
+    asyncio.run_coroutine_threadsafe(server.stop(None), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_async_file_server_rpcs(async_server):
+    servicer, address, loop = async_server
+    stub = ops_pb2_grpc.FileServerStub(grpc.insecure_channel(address))
+    data = os.urandom(100 * 1024)
+
+    assert stub.put(iter([chunk('f', data)])).hash == sha(data)
+    assert stub.stat(ops_pb2.Request(name='f')).size == len(data)
+    assert b''.join(piece.buffer for piece in stub.get_range(ops_pb2.Request(name='f', offset=10, length=20))) == data[10:30]
+
+    watch = stub.watch(ops_pb2.HeartbeatRequest())
+    assert next(watch).message == 'acknowledged'
+    loop.call_soon_threadsafe(servicer.set_serving, False)
+    assert next(watch).message == 'not serving'
+    watch.cancel()
+
+
+def test_read_slices_ranges_across_chunks_into_pieces(store):
+    store.save([chunk('a', b'0123'), chunk('a', b'4567'), chunk('a', b'89')])
+
+    pieces = list(store.read('a', 3, 6, 2))
+    assert [(offset, piece) for offset, piece, _, _ in pieces] == [(3, b'3'), (4, b'45'), (6, b'67'), (8, b'8')]
+    assert {size for _, _, size, _ in pieces} == {10}
+    assert read_all(store, 'a', 8) == b'89'
+    assert read_all(store, 'a', 20) == b''
+
+
+def test_mappings_are_shared_until_the_file_changes(store, tmp_path):
+    path = tmp_path / 'plain'
+    path.write_bytes(b'version one')
+    first = store._map(str(path))
+    assert store._map(str(path)) is first
+
+    replacement = tmp_path / 'replacement'
+    replacement.write_bytes(b'version two!')
+    os.replace(replacement, path)
+    assert store._map(str(path)) is not first
+    assert read_all(store, 'plain') == b'version two!'
+
+
+def test_mappings_are_bounded(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_server, 'MMAP_CACHE_ENTRIES', 2)
+    for i in range(4):
+        (tmp_path / str(i)).write_bytes(b'data')
+        store._map(str(tmp_path / str(i)))
+
+    assert len(store.mappings) == 2
+
+
+def test_negotiate_chunk_size_bounds_the_requested_size():
+    assert negotiate_chunk_size(0) == file_server.CHUNK_SIZE
+    assert negotiate_chunk_size(1) == file_server.MIN_CHUNK_SIZE
+    assert negotiate_chunk_size(256 * 1024) == 256 * 1024
+    assert negotiate_chunk_size(64 * 1024 * 1024) == file_server.MAX_CHUNK_SIZE
+
+
+def test_watch_streams_health_changes(tmp_path, grpc_server):
+    servicer = FileServer(str(tmp_path) + '/')
+    stub = ops_pb2_grpc.FileServerStub(grpc.insecure_channel(grpc_server(servicer)))
+
+    watch = stub.watch(ops_pb2.HeartbeatRequest())
+    assert next(watch).message == 'acknowledged'
+    servicer.set_serving(False)
+    assert next(watch).message == 'not serving'
+    assert stub.heartbeat(ops_pb2.HeartbeatRequest()).message == 'not serving'
+    watch.cancel()
+
+
+def test_servers_accept_pings_as_often_as_proxies_send_them():
+    options = dict(file_server.SERVER_OPTIONS)
+    assert options['grpc.http2.min_ping_interval_without_data_ms'] <= 10000
+    assert options['grpc.http2.max_ping_strikes'] == 0
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+import importlib.util
+from concurrent import futures
+
+import grpc
+import pytest
+from grpc_tools import protoc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# the services import the stubs the Dockerfiles generate from ops.proto, and the shared file server
+STUBS = tempfile.mkdtemp(prefix='ops-stubs-')
+protoc.main(['grpc_tools.protoc', f'--proto_path={ROOT}/proto', f'--python_out={STUBS}',
+             f'--grpc_python_out={STUBS}', 'ops.proto'])
+sys.path[:0] = [STUBS, os.path.join(ROOT, 'common')]
+
+import ops_pb2_grpc
+
+
+@pytest.fixture
+def load_service(monkeypatch):
+    """
+    Imports the server module of a service as a new module, configured by the given environment
+    variables, so every test gets its own module state.
+    """
+    def load(service, **env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        spec = importlib.util.spec_from_file_location(f'{service}_server', os.path.join(ROOT, service, 'server.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
+
+
+@pytest.fixture
+def grpc_server():
+    """
+    Starts FileServer servicers on threaded gRPC servers on free local ports, and stops them after
+    the test.
+    """
+    servers = []
+
+    def start(servicer, options=()):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=16), options=list(options))
+        ops_pb2_grpc.add_FileServerServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        server.start()
+        servers.append(server)
+        return f'127.0.0.1:{port}'
+
+    yield start
+    for server in servers:
+        server.stop(None)
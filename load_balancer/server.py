@@ -1,17 +1,44 @@
 import os
 import re
+import hmac
 import json
+import math
 import time
 import random
+import hashlib
 import logging
+import ipaddress
 import requests
-import itertools
-from threading import Thread
-from flask import Flask, redirect, request
+from collections import Counter, deque
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, redirect, request, jsonify
 
 PORT = os.environ.get("PORT")
-NUM_AREAS = int(os.environ.get("NUM_AREAS"))
+NUM_AREAS = int(os.environ.get("NUM_AREAS", 0))
 DEFAULT_PATH = os.environ.get("DEFAULT_PATH")
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", 1))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get("HEALTH_CHECK_TIMEOUT", 1))
+HEALTHY_THRESHOLD = int(os.environ.get("HEALTHY_THRESHOLD", 2))
+UNHEALTHY_THRESHOLD = int(os.environ.get("UNHEALTHY_THRESHOLD", 2))
+RTT_EWMA_ALPHA = float(os.environ.get("RTT_EWMA_ALPHA", 0.3))
+# round_robin, latency, hash, least_outstanding or p2c
+ROUTING_POLICY = os.environ.get("ROUTING_POLICY", "round_robin")
+AREA_CIDRS = os.environ.get("AREA_CIDRS", "")  # comma separated cidr=area pairs
+AREA_CIDR_FILE = os.environ.get("AREA_CIDR_FILE")  # file of 'cidr area' lines
+# only enable behind a trusted proxy that sets X-Forwarded-For, clients can send any address in it
+TRUST_X_FORWARDED_FOR = os.environ.get("TRUST_X_FORWARDED_FOR", "false").lower() == "true"
+LB_MODE = os.environ.get("LB_MODE", "redirect")  # redirect or proxy
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 32))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 1))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 30))
+UPSTREAM_ATTEMPTS = int(os.environ.get("UPSTREAM_ATTEMPTS", 3))
+CHUNK_SIZE = 64 * 1024
+HASH_LOAD_FACTOR = float(os.environ.get("HASH_LOAD_FACTOR", 1.25))
+HASH_LOAD_WINDOW = int(os.environ.get("HASH_LOAD_WINDOW", 1000))
+HEALTH_CHECK_WORKERS = int(os.environ.get("HEALTH_CHECK_WORKERS", 32))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")  # bearer token of the /admin endpoints, which are disabled without one
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.basicConfig(level=logging.DEBUG,
@@ -20,105 +47,709 @@ logging.basicConfig(level=logging.DEBUG,
 
 
 app = Flask(__name__)
-areas = [os.environ.get(f"AREA{i}_PROXIES").split(",") for i in range(NUM_AREAS)]
-servers = {str(i): itertools.cycle([f"http://localhost:{port}/" for port in area]) for i, area in enumerate(areas)}
-liveliness = {f"http://localhost:{port}/": False for area in areas for port in area}
-proxies = [f'http://proxy{idx}.{i}:{area[i]}/' for idx, area in enumerate(areas) for i in range(len(area))]
+# the proxies configured at startup, more can join and leave at runtime through /admin/proxies
+areas = [[port for port in os.environ.get(f"AREA{i}_PROXIES", "").split(",") if port] for i in range(NUM_AREAS)]
+liveliness = {}
+# EWMA of the heartbeat round trip time of each proxy in seconds, None until its first heartbeat
+rtt = {}
+# consecutive heartbeats of each proxy that disagree with its current liveliness
+health_streaks = {}
+# the load each proxy reported on its last heartbeat, and the requests routed to it since
+proxy_load = {}
+routed_since_report = Counter()
 
+# the proxies the last HASH_LOAD_WINDOW requests were routed to, for bounding the load of hash routing
+recent_assignments = deque(maxlen=HASH_LOAD_WINDOW)
+assignment_counts = Counter()
+assignment_lock = Lock()
 
-def check_liveliness(proxies, liveliness):
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=HEALTH_CHECK_WORKERS, pool_maxsize=HEALTH_CHECK_WORKERS))
+
+# keep-alive connections to the proxies for forwarding requests in proxy mode
+upstream_session = requests.Session()
+upstream_session.mount('http://', HTTPAdapter(pool_connections=HEALTH_CHECK_WORKERS, pool_maxsize=UPSTREAM_POOL_SIZE))
+FORWARDED_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since', 'Accept', 'Accept-Encoding')
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade',
+                      'proxy-authenticate', 'proxy-authorization')
+
+
+class PrefixIndex:
+    def __init__(self):
+        """
+        A binary trie of IP networks for longest prefix matching, with one trie per IP version. Each
+        node is a [zero child, one child, value] list, so a lookup walks at most one node per bit of
+        the matched prefix.
+        """
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.size = 0
+
+    def insert(self, network, value):
+        """
+        Maps every address in a network to a value.
+
+        :param network: The network as an ipaddress network
+        :param value: The value of the network
+        """
+        node = self.roots[network.version]
+        bits = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (bits >> (network.max_prefixlen - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        node[2] = value
+        self.size += 1
+
+    def lookup(self, address):
+        """
+        Finds the value of the longest network containing an address.
+
+        :param address: The IP address as a string
+        :return: The value of the longest matching network, or None if no network matches
+        """
+        try:
+            ip = ipaddress.ip_address(address.strip())
+        except ValueError:
+            return None
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        node = self.roots[ip.version]
+        bits = int(ip)
+        match = node[2]
+        for i in range(ip.max_prefixlen):
+            node = node[(bits >> (ip.max_prefixlen - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+
+        return match
+
+
+class Member:
+    __slots__ = ('address', 'public_address', 'area_id', 'weight', 'draining')
+
+    def __init__(self, address, public_address, area_id, weight=1.0, draining=False):
+        """
+        A proxy registered with the load balancer.
+
+        :param address: The address of the proxy in the docker network, which heartbeats and forwarded requests go to
+        :param public_address: The address clients are redirected to, which is the key of the proxy in liveliness
+        :param area_id: The ID of the area of the proxy
+        :param weight: The capacity of the proxy relative to the others, which scales its share of the requests
+        :param draining: Whether the proxy is leaving, so it is still health checked but gets no new requests
+        """
+        self.address = address
+        self.public_address = public_address
+        self.area_id = area_id
+        self.weight = weight
+        self.draining = draining
+
+    def to_dict(self):
+        return {'address': self.address, 'public_address': self.public_address, 'area': self.area_id,
+                'weight': self.weight, 'draining': self.draining}
+
+
+class SmoothWeightedRoundRobin:
+    def __init__(self, weights):
+        """
+        Smooth weighted round robin over the proxies of an area. Every pick adds the weight of each
+        candidate to its current weight and picks the highest, which then gives back the total weight
+        of the candidates. Each proxy is picked in proportion to its weight, fractional weights
+        included, and the picks of a heavy proxy are interleaved with the others rather than back to back.
+
+        :param weights: The weights of the proxies by address
+        """
+        self.weights = weights
+        self.current = dict.fromkeys(weights, 0.0)
+        self.lock = Lock()
+
+    def pick(self, candidates):
+        """
+        :param candidates: The addresses of the proxies that may be picked
+        :return: The address of the next proxy, or None if there are no candidates
+        """
+        best = None
+        total = 0
+        with self.lock:
+            for proxy in candidates:
+                self.current[proxy] += self.weights[proxy]
+                total += self.weights[proxy]
+                if best is None or self.current[proxy] > self.current[best]:
+                    best = proxy
+            if best is not None:
+                self.current[best] -= total
+        return best
+
+
+class Topology:
+    def __init__(self, members=()):
+        """
+        An immutable snapshot of the registered proxies and the routing tables derived from them.
+        Membership changes build a new topology and swap the global reference to it, so request
+        threads read one consistent snapshot without taking a lock.
+
+        :param members: The registered proxies
+        """
+        self.members = {member.public_address: member for member in members}
+        self.area_servers = {}
+        for member in self.members.values():
+            if not member.draining:
+                self.area_servers.setdefault(member.area_id, []).append(member.public_address)
+
+        self.area_ids = sorted(self.area_servers, key=int)
+        self.servers = {area_id: SmoothWeightedRoundRobin({proxy: self.members[proxy].weight for proxy in area})
+                        for area_id, area in self.area_servers.items()}
+        self.upstream_addresses = {key: member.address for key, member in self.members.items()}
+
+    def weight(self, proxy):
+        member = self.members.get(proxy)
+        return member.weight if member else 1.0
+
+    def find(self, address):
+        """
+        Finds a registered proxy by either of its addresses.
+
+        :param address: The public or docker network address of the proxy
+        :return: The member, or None if no proxy has that address
+        """
+        if address in self.members:
+            return self.members[address]
+        return next((member for member in self.members.values() if member.address == address), None)
+
+    def join(self, member):
+        """
+        :return: A topology with a proxy added, or its registration replaced if it already joined
+        """
+        members = [other for other in self.members.values()
+                   if other.public_address != member.public_address and other.address != member.address]
+        return Topology(members + [member])
+
+    def drain(self, public_address):
+        """
+        :return: A topology where a proxy gets no new requests
+        """
+        return Topology([Member(member.address, member.public_address, member.area_id, member.weight,
+                                member.draining or key == public_address)
+                         for key, member in self.members.items()])
+
+    def leave(self, public_address):
+        """
+        :return: A topology without a proxy
+        """
+        return Topology([member for key, member in self.members.items() if key != public_address])
+
+
+def load_area_cidrs():
+    """
+    Builds the index of client networks to areas from AREA_CIDRS and AREA_CIDR_FILE.
+
+    :return: A PrefixIndex of the networks, with the area IDs as values
+    """
+    entries = [entry.split('=') for entry in AREA_CIDRS.split(',') if entry.strip()]
+    if AREA_CIDR_FILE:
+        with open(AREA_CIDR_FILE) as f:
+            entries += [line.split() for line in f if line.strip() and not line.startswith('#')]
+
+    index = PrefixIndex()
+    for cidr, area_id in entries:
+        # proxies of an area may only join later, so the area just has to be a valid ID
+        if not area_id.strip().isdigit():
+            logging.warning(f'Ignoring network {cidr} of invalid area {area_id}')
+            continue
+        index.insert(ipaddress.ip_network(cidr.strip(), strict=False), area_id.strip())
+
+    logging.info(f'Loaded {index.size} client networks')
+    return index
+
+
+area_cidrs = load_area_cidrs()
+
+
+def client_area(req):
+    """
+    Finds the area of the client of a request from its address, or from the first address in
+    X-Forwarded-For when TRUST_X_FORWARDED_FOR is set.
+
+    :param req: The incoming request
+    :return: The ID of the area, or None if the client's address is not in any known network
+    """
+    address = req.remote_addr or ''
+    forwarded_for = req.headers.get('X-Forwarded-For')
+    if TRUST_X_FORWARDED_FOR and forwarded_for:
+        address = forwarded_for.split(',')[0]
+
+    return area_cidrs.lookup(address)
+
+
+def request_area(req):
     """
-    Checks the liveliness of a list of proxies by sending requests to them and updates
-    the liveliness dictionary
+    :param req: The incoming request
+    :return: The area the request asks for with its area parameter, otherwise the area of the client's
+    address, or None if neither is known
     """
+    return req.args.get('area') or client_area(req)
 
-    while True:
-        for addr in proxies:
-            try:
-                alive = requests.get(addr + 'heartbeat').text
-                liveliness[re.sub(r"http://proxy([0-9].[0-9]):([0-9]+)/", 
-                              r"http://localhost:\2/", addr)] = True if str(alive) == 'OK' else False
-            except Exception:
-                liveliness[re.sub(r"http://proxy([0-9].[0-9]):([0-9]+)/", 
-                              r"http://localhost:\2/", addr)] = False
 
+def area_url(url, req):
+    """
+    Adds the area of a request to the URL it is redirected to, so the proxy knows where the client is.
+
+    :param url: The URL of the file at the proxy
+    :param req: The incoming request
+    :return: The URL to redirect to
+    """
+    area_id = request_area(req)
+    return url + f'?area={area_id}' if area_id else url
+
+
+def liveliness_key(addr):
+    """
+    Maps the docker network address of a proxy to the address clients are redirected to,
+    which is the key of the proxy in liveliness.
 
-def get_server(req):
+    :param addr: The address of the proxy in the docker network
+    :return: The address of the proxy as seen by clients
     """
-    Selects a proxy server based on the given area ID or a random one (if area ID not passed), and
-    checks if it is alive before returning it. If its dead it will try all proxies in that area.
+    return re.sub(r"http://proxy([0-9].[0-9]):([0-9]+)/", r"http://localhost:\2/", addr)
+
+
+topology = Topology([Member(f'http://proxy{idx}.{i}:{area[i]}/', f'http://localhost:{area[i]}/', str(idx))
+                     for idx, area in enumerate(areas) for i in range(len(area))])
+liveliness.update({key: False for key in topology.members})
+rtt.update({key: None for key in topology.members})
+proxy_load.update({key: None for key in topology.members})
+topology_lock = Lock()
+
+
+def update_topology(change):
+    """
+    Applies a membership change by building a new topology and swapping it in. Writers are
+    serialized by topology_lock, readers keep using the snapshot they already read.
+
+    :param change: A function from the current topology to the new one
+    :return: The new topology
+    """
+    global topology
+    with topology_lock:
+        previous = topology
+        topology = change(previous)
+
+        for key in topology.members.keys() - previous.members.keys():
+            liveliness.setdefault(key, False)
+            rtt.setdefault(key, None)
+            proxy_load.setdefault(key, None)
+        for key in previous.members.keys() - topology.members.keys():
+            for state in (liveliness, rtt, proxy_load, health_streaks, routed_since_report):
+                state.pop(key, None)
+
+        return topology
+
+
+def probe(addr):
+    """
+    Sends a heartbeat to a proxy.
+
+    :param addr: The address of the proxy in the docker network
+    :return: A tuple of the round trip time of the heartbeat in seconds, or None if the proxy is not
+    healthy, and the load the proxy reported, or None if it did not report one
+    """
+    start = time.monotonic()
+    try:
+        alive = session.get(addr + 'heartbeat', timeout=HEALTH_CHECK_TIMEOUT).text
+    except requests.RequestException:
+        return None, None
+    heartbeat_rtt = time.monotonic() - start
+
+    # proxies report their load as JSON, older ones only answer 'OK'
+    if str(alive) == 'OK':
+        return heartbeat_rtt, None
+    try:
+        report = json.loads(alive)
+    except ValueError:
+        return None, None
+
+    return (heartbeat_rtt, report) if report.get('status') == 'OK' else (None, None)
+
+
+def update_health(key, heartbeat_rtt, liveliness):
+    """
+    Updates the liveliness and RTT of a proxy from a heartbeat. A proxy only changes state after
+    HEALTHY_THRESHOLD consecutive successful or UNHEALTHY_THRESHOLD consecutive failed heartbeats,
+    so a single slow or lost heartbeat does not flap it. Its first heartbeat decides its state.
+
+    :param key: The key of the proxy in liveliness
+    :param heartbeat_rtt: The round trip time of the heartbeat, or None if it failed
+    :param liveliness: The liveliness dictionary to update
+    """
+    if key not in topology.members:
+        # the proxy left while its heartbeat was in flight
+        return
+
+    alive = heartbeat_rtt is not None
+    if alive:
+        previous = rtt.get(key)
+        rtt[key] = heartbeat_rtt if previous is None else RTT_EWMA_ALPHA * heartbeat_rtt + (1 - RTT_EWMA_ALPHA) * previous
+
+    if key not in health_streaks or liveliness.get(key) == alive:
+        health_streaks[key] = 0
+        liveliness[key] = alive
+        return
+
+    health_streaks[key] += 1
+    if health_streaks[key] >= (HEALTHY_THRESHOLD if alive else UNHEALTHY_THRESHOLD):
+        health_streaks[key] = 0
+        liveliness[key] = alive
+        logging.warning(f'Proxy {key} is now {"alive" if alive else "dead"}')
+
+
+def check_liveliness(liveliness):
+    """
+    Checks the liveliness of the registered proxies, including draining ones, by sending heartbeats
+    to all of them concurrently every HEALTH_CHECK_INTERVAL seconds, and updates the liveliness dictionary
+    """
+    with ThreadPoolExecutor(max_workers=HEALTH_CHECK_WORKERS) as pool:
+        while True:
+            start = time.monotonic()
+            members = topology.members
+            heartbeats = {key: pool.submit(probe, member.address) for key, member in members.items()}
+
+            for key, heartbeat in heartbeats.items():
+                heartbeat_rtt, report = heartbeat.result()
+                update_health(key, heartbeat_rtt, liveliness)
+                if report is not None and key in topology.members:
+                    with assignment_lock:
+                        proxy_load[key] = report
+                        routed_since_report[key] = 0
+
+            time.sleep(max(0, HEALTH_CHECK_INTERVAL - (time.monotonic() - start)))
+
+
+def rendezvous_score(proxy, key, weight=1.0):
+    """
+    Weighted rendezvous score, so a proxy wins a share of the keys proportional to its weight.
+    """
+    h = int.from_bytes(hashlib.blake2b(f'{proxy}{key}'.encode(), digest_size=8).digest(), 'big')
+    return weight / -math.log((h + 1) / (2 ** 64 + 1))
+
+
+def record_assignment(proxy):
+    """
+    Records that a request was routed to a proxy, forgetting the oldest assignment in the window.
+
+    :param proxy: The address of the proxy
+    """
+    with assignment_lock:
+        if len(recent_assignments) == recent_assignments.maxlen:
+            assignment_counts[recent_assignments[0]] -= 1
+        recent_assignments.append(proxy)
+        assignment_counts[proxy] += 1
+
+
+def hash_proxy(topo, live, key):
+    """
+    Picks the proxy for a key with rendezvous hashing, so each key sticks to one proxy of the area
+    and only the keys of a proxy that dies move. A proxy that has taken more than HASH_LOAD_FACTOR
+    times its fair share of the recent requests, in proportion to its weight, is skipped for the next
+    proxy in the key's order.
+
+    :param topo: The topology the proxies belong to
+    :param live: The addresses of the live proxies of the area
+    :param key: The requested path
+    :return: The address of the chosen proxy
+    """
+    ranked = sorted(live, key=lambda proxy: rendezvous_score(proxy, key, topo.weight(proxy)), reverse=True)
+    total = sum(assignment_counts[proxy] for proxy in live) + 1
+    total_weight = sum(topo.weight(proxy) for proxy in live)
+
+    def limit(proxy):
+        return math.ceil(HASH_LOAD_FACTOR * total * topo.weight(proxy) / total_weight)
+
+    proxy = next((proxy for proxy in ranked if assignment_counts[proxy] < limit(proxy)), ranked[0])
+    if proxy != ranked[0]:
+        logging.info(f'Proxy {ranked[0]} is overloaded, spilling {key} over to {proxy}')
+    record_assignment(proxy)
+    return proxy
+
+
+def outstanding(proxy, weight=1.0):
+    """
+    Estimates the outstanding requests of a proxy as the requests it reported to be serving or queueing
+    plus the requests routed to it since that report, relative to its weight.
+
+    :param proxy: The address of the proxy
+    :param weight: The weight of the proxy
+    :return: A tuple of the estimated outstanding requests per unit of weight and the reported p99
+    latency, for sorting
+    """
+    report = proxy_load.get(proxy) or {}
+    return ((report.get('in_flight', 0) + report.get('queue_depth', 0) + routed_since_report[proxy]) / weight,
+            report.get('p99', 0))
+
+
+def live_proxies(topo, area_id, exclude):
+    return [proxy for proxy in topo.area_servers[area_id] if liveliness.get(proxy) and proxy not in exclude]
+
+
+def least_loaded_proxy(topo, live):
+    """
+    Picks the live proxy with the fewest outstanding requests per unit of weight, either among all of
+    them or, for the p2c policy, among two picked at random.
+
+    :param topo: The topology the proxies belong to
+    :param live: The addresses of the live proxies of the area
+    :return: The address of the chosen proxy
+    """
+    candidates = random.sample(live, min(2, len(live))) if ROUTING_POLICY == 'p2c' else live
+    with assignment_lock:
+        proxy = min(candidates, key=lambda candidate: outstanding(candidate, topo.weight(candidate)))
+        routed_since_report[proxy] += 1
+    return proxy
+
+
+def pick_proxy(topo, area_id, key, exclude=()):
+    """
+    Picks a live proxy in an area according to ROUTING_POLICY, either the next proxy in weighted round
+    robin order, the proxy with the lowest heartbeat RTT, the proxy the requested path hashes to or the
+    least loaded proxy.
+
+    :param topo: The topology to route with
+    :param area_id: The ID of the area
+    :param key: The requested path
+    :param exclude: Proxies that must not be picked
+    :return: The address of a live proxy, or None if every proxy in the area is dead
+    """
+    if ROUTING_POLICY == 'hash':
+        live = live_proxies(topo, area_id, exclude)
+        return hash_proxy(topo, live, key) if live else None
+
+    if ROUTING_POLICY in ('least_outstanding', 'p2c'):
+        live = live_proxies(topo, area_id, exclude)
+        return least_loaded_proxy(topo, live) if live else None
+
+    if ROUTING_POLICY == 'latency':
+        live = live_proxies(topo, area_id, exclude)
+        if not live:
+            return None
+        return min(live, key=lambda proxy: rtt.get(proxy) if rtt.get(proxy) is not None else float('inf'))
+
+    for proxy in topo.area_servers[area_id]:
+        if not liveliness.get(proxy):
+            logging.warning(f'Proxy {proxy} is dead')
+    return topo.servers[area_id].pick(live_proxies(topo, area_id, exclude))
+
+
+def get_server(req, exclude=()):
+    """
+    Selects a proxy server based on the given area ID, the area of the client's address or a random
+    one (if neither is known), and checks if it is alive before returning it. If its dead it will try all proxies in that area.
     If that area is dead then it will try the other areas
     
-    :param req: The request object that contains the area ID of the incoming request
-    :return: a proxy server to handle a request.
+    :param req: The request object that contains the area ID and path of the incoming request
+    :param exclude: Proxies that already failed to handle the request
+    :return: a proxy server to handle a request, or None if no proxy is registered
     """
-    area_id = req.args.get('area')
-    if not area_id:
-        area_id = random.choice([key for key in servers.keys()])
+    topo = topology
+    if not topo.area_ids:
+        return None
 
-    area_retry_count = 0
-    while area_retry_count <= len(areas):
-        area_proxies = servers[area_id]
-        proxy = next(area_proxies)
+    path = req.path.lstrip('/') or DEFAULT_PATH
+    area_id = request_area(req)
+    if area_id not in topo.area_servers:
+        area_id = random.choice(topo.area_ids)
 
-        # return proxy if it is alive
-        if liveliness[proxy]:
+    start = topo.area_ids.index(area_id)
+    for area_retry_count in range(len(topo.area_ids)):
+        area_id = topo.area_ids[(start + area_retry_count) % len(topo.area_ids)]
+        proxy = pick_proxy(topo, area_id, path, exclude)
+        if proxy is not None:
+            logging.info(f'Routing request to {proxy}')
             return proxy
-        logging.warning(f'Proxy {proxy} is dead')
-
-        # try the next proxies in the area
-        proxy_retry_count = 1
-        while proxy_retry_count <= len(areas[int(area_id) - 1]):
-            proxy = next(area_proxies)
-            proxy_retry_count += 1
-
-            if liveliness[proxy]:
-                return proxy
-            
-            
+
         # no proxy in the area is alive then try proxies in the next area
         logging.warning(f'Area {area_id} is dead')
-        area_retry_count += 1
-        area_id = str(((int(area_id) + 1) % len(areas))) 
 
+    proxy = topo.servers[topo.area_ids[start]].pick(topo.area_servers[topo.area_ids[start]])
     logging.info(f'Routing request to {proxy}')
     return proxy
 
 
 
+def forward(req, path):
+    """
+    Forwards a request to a proxy over a pooled keep-alive connection and streams its response back.
+    If the proxy cannot be reached or fails, the request is retried on another proxy, up to
+    UPSTREAM_ATTEMPTS proxies, as long as nothing has been sent to the client yet.
+
+    :param req: The incoming request
+    :param path: The path of the file requested
+    :return: The response of the proxy
+    """
+    headers = {name: req.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in req.headers}
+    headers['X-Forwarded-For'] = ', '.join(filter(None, [req.headers.get('X-Forwarded-For'), req.remote_addr]))
+    params = list(req.args.items(multi=True))
+    area_id = request_area(req)
+    if area_id and 'area' not in req.args:
+        params.append(('area', area_id))
+    tried = []
+
+    while len(tried) < UPSTREAM_ATTEMPTS:
+        server = get_server(req, exclude=tried)
+        if server is None or server in tried:
+            break
+        tried.append(server)
+
+        address = topology.upstream_addresses.get(server)
+        if address is None:
+            # the proxy left since it was picked
+            continue
+        try:
+            upstream = upstream_session.get(address + path, params=params, headers=headers,
+                                            stream=True, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+        except requests.RequestException as e:
+            logging.warning(f'Proxy {server} failed to serve {path}, retrying on another proxy. {str(e)}')
+            continue
+
+        if upstream.status_code >= 500:
+            logging.warning(f'Proxy {server} answered {path} with {upstream.status_code}, retrying on another proxy')
+            upstream.close()
+            continue
+
+        response = Response(upstream.raw.stream(CHUNK_SIZE, decode_content=False), status=upstream.status_code,
+                            headers=[(name, value) for name, value in upstream.headers.items()
+                                     if name.lower() not in HOP_BY_HOP_HEADERS])
+        response.call_on_close(upstream.close)
+        return response
+
+    return Response(f'No proxy could serve {path}', status=502)
+
+
+def member_status(key, member):
+    status = member.to_dict()
+    status.update({'alive': liveliness.get(key, False), 'rtt': rtt.get(key), 'load': proxy_load.get(key)})
+    return status
+
+
+@app.before_request
+def check_admin_token():
+    """
+    Rejects requests to the admin endpoints that do not carry ADMIN_TOKEN as a bearer token. The admin
+    endpoints are disabled if no ADMIN_TOKEN is set.
+    """
+    if not request.path.startswith('/admin/'):
+        return None
+    if not ADMIN_TOKEN:
+        return Response('The admin endpoints are disabled, set ADMIN_TOKEN to enable them', status=403)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {ADMIN_TOKEN}'.encode()):
+        return Response('Missing or wrong admin token', status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return None
+
+
+@app.route('/admin/proxies', methods=['GET'])
+def list_proxies():
+    """
+    Lists the registered proxies with their liveliness and load
+    :return: A JSON list of the proxies
+    """
+    topo = topology
+    return jsonify([member_status(key, member) for key, member in topo.members.items()])
+
+
+@app.route('/admin/proxies', methods=['POST'])
+def join_proxy():
+    """
+    Registers a proxy, or updates its area and weight if it is already registered. The proxy gets
+    requests once it passes its health checks. Takes a JSON body with the address of the proxy in the
+    docker network, its area, and optionally the address clients are redirected to and its weight.
+    :return: The registered proxy
+    """
+    body = request.get_json(silent=True) or {}
+    address, area_id = body.get('address'), str(body.get('area', ''))
+    if not address or not area_id.isdigit():
+        return Response('A proxy needs an address and an area', status=400)
+    try:
+        weight = float(body.get('weight', 1))
+    except (TypeError, ValueError):
+        weight = 0
+    if weight <= 0:
+        return Response('The weight of a proxy must be a positive number', status=400)
+
+    address = address if address.endswith('/') else address + '/'
+    member = Member(address, body.get('public_address') or liveliness_key(address), area_id, weight)
+    update_topology(lambda topo: topo.join(member))
+    logging.info(f'Proxy {member.public_address} joined area {area_id} with weight {weight}')
+    return jsonify(member.to_dict())
+
+
+@app.route('/admin/proxies/drain', methods=['POST'])
+def drain_proxy():
+    """
+    Stops routing new requests to a proxy so it can leave once its outstanding requests are done.
+    Takes a JSON body with either address of the proxy.
+    :return: The draining proxy
+    """
+    member = topology.find((request.get_json(silent=True) or {}).get('address'))
+    if member is None:
+        return Response('Unknown proxy', status=404)
+
+    update_topology(lambda topo: topo.drain(member.public_address))
+    logging.info(f'Proxy {member.public_address} is draining')
+    return jsonify(topology.members[member.public_address].to_dict())
+
+
+@app.route('/admin/proxies', methods=['DELETE'])
+def leave_proxy():
+    """
+    Deregisters a proxy. Takes a JSON body with either address of the proxy.
+    :return: The removed proxy
+    """
+    member = topology.find((request.get_json(silent=True) or {}).get('address'))
+    if member is None:
+        return Response('Unknown proxy', status=404)
+
+    update_topology(lambda topo: topo.leave(member.public_address))
+    logging.info(f'Proxy {member.public_address} left')
+    return jsonify(member.to_dict())
+
+
 @app.route('/')
 def serve_main():
     """
-    Redirects request for no file to the default path
+    Redirects request for no file to the default path, or serves it through a proxy in proxy mode
     :return: A redirect to the proxy with the default path.
     """
-    server = get_server(request)
-    area_id = request.args.get("area")
-    if area_id:
-        return redirect(server + DEFAULT_PATH + f'?area={area_id}')
+    if LB_MODE == 'proxy':
+        return forward(request, DEFAULT_PATH)
 
-    return redirect(server + DEFAULT_PATH)
+    server = get_server(request)
+    if server is None:
+        return Response('No proxy is registered', status=503)
+    return redirect(area_url(server + DEFAULT_PATH, request))
 
 
 @app.route('/<path:path>')
 def serve_GET(path):
     """
-    Redirect to the "closest" proxy server that has the file
+    Redirect to the "closest" proxy server that has the file, or serve it through that proxy
+    in proxy mode
 
     :param path: The path of the file requested
     :return: A redirect to the proxy
     """
+    if LB_MODE == 'proxy':
+        return forward(request, path)
 
     server = get_server(request)
-    area_id = request.args.get("area")
-    if area_id:
-        return redirect(server + path + f'?area={area_id}')
-    
-    return redirect(server + path)
+    if server is None:
+        return Response('No proxy is registered', status=503)
+    return redirect(area_url(server + path, request))
 
 
 if __name__ == "__main__":
-    th = Thread(target=check_liveliness, args=(proxies, liveliness,))
+    th = Thread(target=check_liveliness, args=(liveliness,))
     th.start()
 
     logging.info(f"Starting Load Balancer on port {PORT}")
@@ -0,0 +1,236 @@
+import types
+import ipaddress
+from collections import Counter
+
+import pytest
+
+PROXY0, PROXY1, PROXY2 = 'http://localhost:5000/', 'http://localhost:5001/', 'http://localhost:5002/'
+
+
+@pytest.fixture
+def lb(load_service):
+    lb = load_service('load_balancer', NUM_AREAS=2, AREA0_PROXIES='5000,5001', AREA1_PROXIES='5002',
+                      DEFAULT_PATH='index.html', AREA_CIDRS='10.0.0.0/8=0,10.1.0.0/16=1')
+    lb.liveliness.update({PROXY0: True, PROXY1: True, PROXY2: True})
+    return lb
+
+
+def test_update_health_needs_consecutive_heartbeats_to_flip(lb):
+    lb.update_health(PROXY0, 0.01, lb.liveliness)
+    lb.update_health(PROXY0, None, lb.liveliness)
+    assert lb.liveliness[PROXY0]
+    lb.update_health(PROXY0, 0.01, lb.liveliness)
+    lb.update_health(PROXY0, None, lb.liveliness)
+    lb.update_health(PROXY0, None, lb.liveliness)
+    assert not lb.liveliness[PROXY0]
+
+
+def test_update_health_tracks_rtt_as_an_ewma(lb):
+    lb.update_health(PROXY0, 0.1, lb.liveliness)
+    lb.update_health(PROXY0, 0.2, lb.liveliness)
+    assert lb.rtt[PROXY0] == pytest.approx(lb.RTT_EWMA_ALPHA * 0.2 + (1 - lb.RTT_EWMA_ALPHA) * 0.1)
+
+
+def test_round_robin_skips_dead_proxies_and_fails_over_to_the_next_area(lb):
+    picks = [lb.pick_proxy(lb.topology, '0', 'file') for _ in range(4)]
+    assert Counter(picks) == {PROXY0: 2, PROXY1: 2}
+
+    lb.liveliness[PROXY0] = False
+    assert {lb.pick_proxy(lb.topology, '0', 'file') for _ in range(4)} == {PROXY1}
+
+    lb.liveliness[PROXY1] = False
+    with lb.app.test_request_context('/file?area=0'):
+        assert lb.get_server(lb.request) == PROXY2
+
+
+def test_hash_routing_sticks_each_key_to_a_proxy(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'ROUTING_POLICY', 'hash')
+    monkeypatch.setattr(lb, 'HASH_LOAD_FACTOR', 100)
+    for key in ('a', 'b', 'c', 'd'):
+        picks = {lb.pick_proxy(lb.topology, '0', key) for _ in range(5)}
+        assert len(picks) == 1
+
+
+def test_rendezvous_shares_follow_the_weights(lb):
+    wins = Counter(max((PROXY0, PROXY1), key=lambda proxy: lb.rendezvous_score(proxy, key, 3 if proxy == PROXY0 else 1))
+                   for key in range(4000))
+    assert 2.5 < wins[PROXY0] / wins[PROXY1] < 3.5
+
+
+def test_hash_routing_spills_over_from_an_overloaded_proxy(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'ROUTING_POLICY', 'hash')
+    picks = Counter(lb.pick_proxy(lb.topology, '0', 'hot key') for _ in range(100))
+    assert len(picks) == 2
+    assert max(picks.values()) <= 100 * lb.HASH_LOAD_FACTOR / 2 + 1
+
+
+def test_least_outstanding_routing_uses_the_reported_load(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'ROUTING_POLICY', 'least_outstanding')
+    lb.proxy_load[PROXY0] = {'in_flight': 5, 'queue_depth': 0, 'p99': 0.1}
+    lb.proxy_load[PROXY1] = {'in_flight': 1, 'queue_depth': 1, 'p99': 0.1}
+
+    picks = [lb.pick_proxy(lb.topology, '0', 'file') for _ in range(4)]
+    # the requests routed since the last report count as outstanding too
+    assert picks == [PROXY1, PROXY1, PROXY1, PROXY0]
+
+
+def test_redirect_mode_sends_the_client_to_a_proxy(lb):
+    response = lb.app.test_client().get('/file.txt?area=1')
+    assert response.status_code == 302
+    assert response.location == PROXY2 + 'file.txt?area=1'
+
+
+class Upstream:
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = types.SimpleNamespace(stream=lambda size, decode_content: iter([body]))
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_forwarded_requests_stream_the_proxy_response(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'LB_MODE', 'proxy')
+    upstream = Upstream(200, b'file contents', {'Content-Type': 'text/plain', 'Connection': 'keep-alive'})
+    monkeypatch.setattr(lb.upstream_session, 'get', lambda url, **kwargs: upstream)
+
+    response = lb.app.test_client().get('/file.txt?area=1')
+    assert (response.status_code, response.data) == (200, b'file contents')
+    assert response.headers['Content-Type'] == 'text/plain'
+    assert 'Connection' not in response.headers
+    response.close()
+    assert upstream.closed
+
+
+def test_forwarding_fails_over_to_another_proxy(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'LB_MODE', 'proxy')
+    failed = Upstream(503)
+    sent = []
+
+    def get(url, **kwargs):
+        sent.append(url)
+        if len(sent) == 1:
+            raise lb.requests.ConnectionError('reset')
+        return failed if len(sent) == 2 else Upstream(200, b'served')
+
+    monkeypatch.setattr(lb.upstream_session, 'get', get)
+    assert lb.app.test_client().get('/file.txt?area=0').data == b'served'
+    assert len(sent) == 3 and sent[2] == 'http://proxy1.0:5002/file.txt'
+    assert failed.closed
+
+
+def test_forwarding_gives_up_after_the_attempts(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'LB_MODE', 'proxy')
+    monkeypatch.setattr(lb.upstream_session, 'get', lambda url, **kwargs: Upstream(500))
+    assert lb.app.test_client().get('/file.txt?area=0').status_code == 502
+
+
+def test_prefix_index_matches_the_longest_prefix(lb):
+    index = lb.PrefixIndex()
+    index.insert(ipaddress.ip_network('10.0.0.0/8'), '0')
+    index.insert(ipaddress.ip_network('10.1.0.0/16'), '1')
+    index.insert(ipaddress.ip_network('2001:db8::/32'), '2')
+
+    assert index.lookup('10.2.3.4') == '0'
+    assert index.lookup('10.1.3.4') == '1'
+    assert index.lookup('::ffff:10.1.0.1') == '1'
+    assert index.lookup('2001:db8::1') == '2'
+    assert index.lookup('192.168.0.1') is None
+    assert index.lookup('not an address') is None
+
+
+def test_client_area_uses_the_cidr_index(lb):
+    with lb.app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.1.2.3'}):
+        assert lb.client_area(lb.request) == '1'
+
+
+def test_client_area_only_trusts_x_forwarded_for_when_enabled(lb, monkeypatch):
+    with lb.app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                                     headers={'X-Forwarded-For': '10.1.2.3, 10.0.0.2'}):
+        assert lb.client_area(lb.request) == '0'
+        monkeypatch.setattr(lb, 'TRUST_X_FORWARDED_FOR', True)
+        assert lb.client_area(lb.request) == '1'
+
+
+def test_redirects_pass_the_area_of_the_client_network_to_the_proxy(lb):
+    response = lb.app.test_client().get('/file.txt', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+    assert response.location == PROXY2 + 'file.txt?area=1'
+
+
+def test_forwarded_requests_pass_the_area_of_the_client_network_to_the_proxy(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'LB_MODE', 'proxy')
+    sent = []
+
+    def get(url, params, **kwargs):
+        sent.append((url, params))
+        raise lb.requests.ConnectionError('unreachable')
+
+    monkeypatch.setattr(lb.upstream_session, 'get', get)
+    lb.app.test_client().get('/file.txt?v=2', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+    assert sent[0] == ('http://proxy1.0:5002/file.txt', [('v', '2'), ('area', '1')])
+
+
+def test_topology_changes_swap_in_a_new_snapshot(lb):
+    before = lb.topology
+    member = lb.Member('http://proxy1.1:5003/', 'http://localhost:5003/', '1', weight=2)
+    lb.update_topology(lambda topo: topo.join(member))
+
+    assert 'http://localhost:5003/' not in before.members
+    assert lb.topology.area_servers['1'] == [PROXY2, 'http://localhost:5003/']
+    assert lb.topology.servers['1'].weights['http://localhost:5003/'] == 2
+    assert lb.liveliness['http://localhost:5003/'] is False
+
+    lb.update_topology(lambda topo: topo.drain(PROXY2))
+    assert lb.topology.area_servers['1'] == ['http://localhost:5003/']
+    assert PROXY2 in lb.topology.members
+
+    lb.update_topology(lambda topo: topo.leave(PROXY2))
+    assert PROXY2 not in lb.topology.members
+    assert PROXY2 not in lb.liveliness
+
+
+def test_smooth_weighted_round_robin_follows_fractional_weights(lb):
+    balancer = lb.SmoothWeightedRoundRobin({'a': 1.5, 'b': 1, 'c': 0.5})
+    picks = [balancer.pick(['a', 'b', 'c']) for _ in range(300)]
+
+    assert Counter(picks) == {'a': 150, 'b': 100, 'c': 50}
+    # a heavy proxy is not picked back to back when others are due
+    assert picks[:6] == ['a', 'b', 'a', 'c', 'b', 'a']
+    assert balancer.pick([]) is None
+
+
+def test_round_robin_honours_the_weights_of_the_live_proxies(lb):
+    lb.update_topology(lambda topo: topo.join(lb.Member('http://proxy0.2:5004/', 'http://localhost:5004/', '0', 0.5)))
+    lb.liveliness['http://localhost:5004/'] = True
+
+    picks = Counter(lb.pick_proxy(lb.topology, '0', 'file') for _ in range(50))
+    assert picks == {PROXY0: 20, PROXY1: 20, 'http://localhost:5004/': 10}
+
+
+def test_admin_endpoints_need_the_admin_token(lb, monkeypatch):
+    client = lb.app.test_client()
+    assert client.get('/admin/proxies').status_code == 403
+
+    monkeypatch.setattr(lb, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/proxies').status_code == 401
+    assert client.get('/admin/proxies', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.post('/admin/proxies', json={'address': 'http://proxy1.1:5003', 'area': 1}).status_code == 401
+    assert client.get('/admin/proxies', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_admin_endpoints_register_drain_and_remove_proxies(lb, monkeypatch):
+    monkeypatch.setattr(lb, 'ADMIN_TOKEN', 'secret')
+    client = lb.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer secret'
+
+    response = client.post('/admin/proxies', json={'address': 'http://proxy1.1:5003', 'area': 1, 'weight': 2})
+    assert response.status_code == 200
+    assert response.json['public_address'] == 'http://localhost:5003/'
+    assert client.post('/admin/proxies', json={'address': 'http://proxy1.1:5003', 'area': 1, 'weight': 0}).status_code == 400
+
+    assert client.post('/admin/proxies/drain', json={'address': 'http://localhost:5003/'}).json['draining']
+    assert client.delete('/admin/proxies', json={'address': 'http://proxy1.1:5003/'}).status_code == 200
+    assert client.delete('/admin/proxies', json={'address': 'http://proxy1.1:5003/'}).status_code == 404
+    assert [proxy['public_address'] for proxy in client.get('/admin/proxies').json] == [PROXY0, PROXY1, PROXY2]
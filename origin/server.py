@@ -1,114 +1,320 @@
 import grpc
 import os
-import logging
-from concurrent import futures
+import asyncio
 import time
+import queue
+import logging
+from threading import Thread, Condition
 
 import ops_pb2
 import ops_pb2_grpc
+from file_server import FileServer, AsyncFileServer, MissingChunk, UploadError, run_server, run_async_server
 
 PORT = os.environ.get('PORT')
-BACKUP_PORTS = [port for port in enumerate(os.environ.get('BACKUP_PORTS').split(","))]
-
-
+BACKUP_PORTS = os.environ.get('BACKUP_PORTS').split(",")
+# hostnames must be docker service names since the backups are in the same network
+BACKUP_ADDRESSES = [f'origin_backup{i+1}:{port}' for i, port in enumerate(BACKUP_PORTS)]
+# all waits for every backup, quorum for a majority of the copies, async only for the local write
+REPLICATION_ACK = os.environ.get('REPLICATION_ACK', 'all')
+REPLICATION_QUEUE_SIZE = int(os.environ.get('REPLICATION_QUEUE_SIZE', 16))  # chunks buffered per backup
+REPLICATION_LAG_TIMEOUT = float(os.environ.get('REPLICATION_LAG_TIMEOUT', 5))
+REPLICATION_TIMEOUT = float(os.environ.get('REPLICATION_TIMEOUT', 60))
+REPAIR_INTERVAL = float(os.environ.get('REPAIR_INTERVAL', 30))  # seconds between retries of a failed replication
 STORAGE_DIR = os.environ.get('STORAGE_DIR', 'files/')
-CHUNK_SIZE = 1024 * 1024  # 1MB
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded')  # 'threaded' or 'async' for the grpc.aio server
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s',
                     handlers=[logging.StreamHandler()])
 
 
-class OriginServer(ops_pb2_grpc.FileServerServicer):
+class ReplicationAborted(Exception):
+    pass
+
+
+class Replica:
+    def __init__(self, address, acks):
+        """
+        Streams an upload to a backup while the origin is still receiving it. Chunks are handed over
+        through a bounded queue, so a backup that falls behind by more than REPLICATION_QUEUE_SIZE chunks
+        for REPLICATION_LAG_TIMEOUT seconds is abandoned and repaired from disk later instead of
+        buffering the upload in memory.
+
+        :param address: The address of the backup
+        :param acks: A condition notified when the replication finishes
+        """
+        self.address = address
+        self.acks = acks
+        self.queue = queue.Queue(maxsize=REPLICATION_QUEUE_SIZE)
+        self.aborted = False
+        self.done = False
+        self.settled = False
+        self.ok = False
+        self.hash = None
+        Thread(target=self._replicate, daemon=True).start()
+
+    def _chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if self.aborted:
+                raise ReplicationAborted(f"Replication to {self.address} was aborted")
+            if chunk is None:
+                return
+            yield chunk
+
+    def _replicate(self):
+        try:
+            with grpc.insecure_channel(self.address) as channel:
+                stub = ops_pb2_grpc.FileServerStub(channel)
+                reply = stub.put(self._chunks(), timeout=REPLICATION_TIMEOUT)
+            self.hash = reply.hash
+            self.ok = True
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.FAILED_PRECONDITION:
+                logging.info(f"Backup {self.address} is missing chunks of the upload, repairing it from disk")
+            else:
+                logging.warning(f"Replication to {self.address} failed. {str(e)}")
+        except Exception as e:
+            logging.warning(f"Replication to {self.address} failed. {str(e)}")
+        finally:
+            with self.acks:
+                self.done = True
+                self.acks.notify_all()
+
+    def send(self, chunk):
+        """
+        Queues a chunk for the backup, waiting while it catches up
+
+        :param chunk: The chunk, or None once the upload is complete
+        """
+        if self.done or self.aborted:
+            return
+        try:
+            self.queue.put(chunk, timeout=REPLICATION_LAG_TIMEOUT)
+        except queue.Full:
+            logging.warning(f"Backup {self.address} is falling behind, replicating it from disk later")
+            self.abort()
+
+    def abort(self):
+        self.aborted = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def required_acks(replicas):
+    """
+    :return: The number of backups that have to store an upload before it is acknowledged
+    """
+    if REPLICATION_ACK == 'async':
+        return 0
+    if REPLICATION_ACK == 'quorum':
+        # a majority of the copies, counting the origin's own
+        return (len(replicas) + 1) // 2
+    return len(replicas)
+
+
+class OriginServer(FileServer):
 
       def __init__(self):
-         self.origin_files = STORAGE_DIR
-      
-      def _save_chunks_to_file(self, chunks):
+         super().__init__(STORAGE_DIR)
+         # the stored files each backup still has to be sent, by backup address
+         self.backlog = {}
+         self.backlog_ready = Condition()
+
+      def _get_delta_chunks(self, filename, digests, missing):
          """
-         Takes a list of chunks, and writes them to a file
-         
+         Yields the chunks of a file as Chunk messages, sending only the digest of the chunks the
+         receiver already has
+
+         :param filename: The name of the file to be sent
+         :param digests: The digests of the chunks of the file
+         :param missing: The digests of the chunks the receiver does not have
+         :return: A generator object.
+         """
+         for digest in digests:
+            if digest in missing:
+               yield ops_pb2.Chunk(buffer=self.store.read_chunk(digest), name=filename, digest=digest)
+            else:
+               yield ops_pb2.Chunk(name=filename, digest=digest)
+
+      def _replicate_chunks(self, chunks, replicas):
+         """
+         Passes the uploaded chunks through while sending each of them to every backup
+
          :param chunks: The chunks of the file that were uploaded
-         :return: The file name of the file that was just saved.
+         :param replicas: The replications to the backups
+         :return: A generator object.
          """
-         chunks_iter = [chunk for chunk in chunks]
-         filename = chunks_iter[0].name
+         for chunk in chunks:
+            for replica in replicas:
+               replica.send(chunk)
+            yield chunk
 
-         with open(self.origin_files + filename, 'wb') as f:
-            for chunk in chunks_iter:
-                  f.write(chunk.buffer)
+         for replica in replicas:
+            replica.send(None)
 
-         return filename
-      
-      def _get_file_chunks(self, filename):
+      def _repair(self, replica, filename, digest):
          """
-         Reads the file in chunks of CHUNK_SIZE, and yields each chunk as a Chunk message
-         
-         :param filename: The name of the file to be sent to the server
-         :return: A generator object.
+         Waits for a replication to finish, and sends the stored file to the backup again if it failed
+         or the backup stored different content. The replica is settled once the backup has the file or
+         the repair failed, and a repaired backup counts towards REPLICATION_ACK
+
+         :param replica: The replication to the backup
+         :param filename: The name of the file that was uploaded
+         :param digest: The SHA-256 hex digest of the file
+         """
+         with replica.acks:
+            replica.acks.wait_for(lambda: replica.done)
+         stored = replica.hash if replica.ok else None
+         try:
+            if stored != digest:
+               stored = self._send_delta(replica.address, filename)
+            if stored is None:
+               self._queue_replication(replica.address, filename)
+         finally:
+            with replica.acks:
+               replica.ok = stored is not None
+               replica.hash = stored
+               replica.settled = True
+               replica.acks.notify_all()
+
+      def _send_delta(self, address, filename):
+         """
+         Sends a stored file to a backup, only sending the chunks the backup is missing in full
+
+         :param address: The address of the backup
+         :param filename: The name of the file
+         :return: The SHA-256 hex digest of the file stored on the backup, or None if it failed
          """
          try:
-            with open(self.origin_files + filename, 'rb') as f:
-               while True:
-                  piece = f.read(CHUNK_SIZE)
+            with grpc.insecure_channel(address) as channel:
+               stub = ops_pb2_grpc.FileServerStub(channel)
+               digests = self.store.digests(filename)
+               if digests is None:
+                  chunks = self._get_file_chunks(filename)
+               else:
+                  # only send the chunks the backup is missing
+                  manifest = ops_pb2.Manifest(name=filename, digests=digests)
+                  missing = set(stub.has_chunks(manifest, timeout=REPLICATION_TIMEOUT).digests)
+                  chunks = self._get_delta_chunks(filename, digests, missing)
+               reply = stub.put(chunks, timeout=REPLICATION_TIMEOUT)
+            logging.info(f"Repaired file {filename} on backup {address}")
+            return reply.hash
+         except grpc.RpcError as e:
+            logging.error(f"Could not replicate file {filename} to backup {address}. {str(e)}")
+            return None
+
+      def _queue_replication(self, address, filename):
+         """
+         Queues a stored file to be sent to a backup in the background. Each backup has a worker that
+         sends its queued files one at a time and retries the ones that failed every REPAIR_INTERVAL
+         seconds, until the backup has them
+
+         :param address: The address of the backup
+         :param filename: The name of the stored file
+         """
+         with self.backlog_ready:
+            if address not in self.backlog:
+               self.backlog[address] = set()
+               Thread(target=self._drain_backlog, args=(address,), daemon=True).start()
+            self.backlog[address].add(filename)
+            self.backlog_ready.notify_all()
+
+      def _drain_backlog(self, address):
+         """
+         Sends the queued files to a backup, waiting REPAIR_INTERVAL seconds after a failed send
+
+         :param address: The address of the backup
+         """
+         while True:
+            with self.backlog_ready:
+               self.backlog_ready.wait_for(lambda: self.backlog[address])
+               filename = self.backlog[address].pop()
+            if self._send_delta(address, filename) is None:
+               with self.backlog_ready:
+                  self.backlog[address].add(filename)
+                  behind = len(self.backlog[address])
+               logging.warning(f"Backup {address} is behind by {behind} files, retrying in {REPAIR_INTERVAL} seconds")
+               time.sleep(REPAIR_INTERVAL)
 
-                  if len(piece) == 0:
-                        return
-                  yield ops_pb2.Chunk(buffer=piece, name=filename)
+      def _save(self, chunks, replicas=()):
+         """
+         Saves an upload to the object store, aborting the replications of it if it fails
 
+         :param chunks: The uploaded chunks
+         :param replicas: The replications the chunks are streamed to
+         :return: A tuple of the name, size and SHA-256 hex digest of the file.
+         """
+         try:
+            filename, size, digest = self.store.save(chunks)
          except Exception as e:
-            logging.error(f"Error: {self.origin_files + filename}. {str(e)}")
+            for replica in replicas:
+               replica.abort()
+            if isinstance(e, MissingChunk):
+               raise UploadError(grpc.StatusCode.FAILED_PRECONDITION, f"Chunk {e} is missing, upload it in full")
+            if isinstance(e, ValueError):
+               raise UploadError(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            raise
+         if filename is None:
+            raise UploadError(grpc.StatusCode.INVALID_ARGUMENT, "Empty upload")
+         return filename, size, digest
 
-      def put(self, request_iterator, context):
+      def _put(self, request_iterator):
          """
-         Takes a stream of chunks, saves them to a file, and returns the size of the file
+         Takes a stream of chunks, saves them to the object store while streaming them to all backups
+         concurrently, and returns the size of the file once REPLICATION_ACK is satisfied. Chunks that only
+         carry a digest are forwarded as is, and a backup that is missing one of them is repaired from the
+         stored file before it counts as an ack. With async acks the upload is only written to the object
+         store, and sent to the backups from there once it is committed, so a slow backup never holds up
+         the upload
          
          :param request_iterator: Iterator that will be used to iterate over the chunks of data
          that are sent by the client
-         :param context: This is the context object that is passed to the server.
          :return: The size of the file that was saved.
          """
-         filename = self._save_chunks_to_file(request_iterator)
-         # Send the file to the backup server
+         if REPLICATION_ACK == 'async':
+            filename, size, digest = self._save(request_iterator)
+            for address in BACKUP_ADDRESSES:
+               self._queue_replication(address, filename)
+            logging.info(f"Stored file {filename} ({digest}), replicating it to the backups in the background")
+            return ops_pb2.Reply(length=size, hash=digest)
 
-         for i in range(len(BACKUP_PORTS)):
-             with grpc.insecure_channel(f'origin_backup{i+1}:{BACKUP_PORTS[i]}') as channel:
-                 stub = ops_pb2_grpc.FileServerStub(channel)
-                 stub.put(self._get_file_chunks(filename))
+         acks = Condition()
+         replicas = [Replica(address, acks) for address in BACKUP_ADDRESSES]
+         filename, size, digest = self._save(self._replicate_chunks(request_iterator, replicas), replicas)
 
-         logging.info(f"Stored file {filename}")
-         return ops_pb2.Reply(length=os.path.getsize(self.origin_files + filename))
+         for replica in replicas:
+            Thread(target=self._repair, args=(replica, filename, digest), daemon=True).start()
 
-      def get(self, request, context):
-         """
-         It takes a request object, and returns a response object
-         
-         :param request: The request object that was sent from the client
-         :param context: The context is a value passed in by the server and contains RPC-specific information
-         :return: The file chunks
-         """
-         time.sleep(2)
-         if request.name:
-            logging.info(f"Served file {request.name}")
-            return self._get_file_chunks(request.name)
-      
-      def heartbeat(self, request, context):
-        """
-        Handles heartbeat requests from other servers or clients.
+         def stored():
+            return sum(replica.ok and replica.hash == digest for replica in replicas)
+
+         required = required_acks(replicas)
+         with acks:
+            acks.wait_for(lambda: stored() >= required or all(replica.settled for replica in replicas),
+                          timeout=REPLICATION_TIMEOUT)
+            acked = stored()
+         if acked < required:
+            raise UploadError(grpc.StatusCode.UNAVAILABLE,
+                              f"File {filename} was stored on {acked} of the {required} backups required")
+
+         logging.info(f"Stored file {filename} ({digest}) on {acked} backups")
+         return ops_pb2.Reply(length=size, hash=digest)
+
+
+class AsyncOriginServer(AsyncFileServer, OriginServer):
+      pass
 
-        :param request: The request object that was sent from the client
-        :param context: The context is a value passed in by the server and contains RPC-specific information
-        :return: A heartbeat response object
-        """
-        return ops_pb2.HeartbeatResponse(message="acknowledged")
 
 def run_origin_server():
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=5))
-  ops_pb2_grpc.add_FileServerServicer_to_server(OriginServer(), server)
-  server.add_insecure_port(f'[::]:{PORT}')
+  run_server(OriginServer, PORT, "Origin Server")
 
-  logging.info(f"Origin Server start on port {PORT}")
-  server.start()
-  server.wait_for_termination()
+def run_async_origin_server():
+  return run_async_server(AsyncOriginServer, PORT, "Async Origin Server")
 
 if __name__ == "__main__":
-    run_origin_server()
\ No newline at end of file
+    if SERVER_MODE == 'async':
+        asyncio.run(run_async_origin_server())
+    else:
+        run_origin_server()
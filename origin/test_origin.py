@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import threading
+
+import grpc
+import pytest
+
+import ops_pb2
+import ops_pb2_grpc
+from file_server import FileServer
+
+DEAD_BACKUP = '127.0.0.1:1'
+
+
+@pytest.fixture
+def origin(load_service, tmp_path):
+    return load_service('origin', BACKUP_PORTS='8002,8003', STORAGE_DIR=f'{tmp_path}/origin/')
+
+
+@pytest.fixture
+def backups(tmp_path, grpc_server):
+    servicers = [FileServer(f'{tmp_path}/backup{i}/') for i in range(2)]
+    return servicers, [grpc_server(servicer) for servicer in servicers]
+
+
+def upload(address, name, *pieces):
+    stub = ops_pb2_grpc.FileServerStub(grpc.insecure_channel(address))
+    return stub.put(iter([ops_pb2.Chunk(name=name, buffer=piece) for piece in pieces]))
+
+
+def stored(servicer, name):
+    try:
+        return servicer.store.info(name)[2]
+    except OSError:
+        return None
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('mode, backups_needed', [('all', 2), ('quorum', 1), ('async', 0)])
+def test_required_acks(origin, monkeypatch, mode, backups_needed):
+    monkeypatch.setattr(origin, 'REPLICATION_ACK', mode)
+    assert origin.required_acks([None, None]) == backups_needed
+
+
+def test_uploads_are_streamed_to_every_backup_before_the_ack(origin, backups, grpc_server, monkeypatch):
+    servicers, addresses = backups
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', addresses)
+
+    reply = upload(grpc_server(origin.OriginServer()), 'f', b'first chunk', b'second chunk')
+
+    digest = hashlib.sha256(b'first chunksecond chunk').hexdigest()
+    assert reply.hash == digest
+    assert [stored(servicer, 'f') for servicer in servicers] == [digest, digest]
+
+
+def test_all_acks_fail_the_upload_when_a_backup_is_down(origin, backups, grpc_server, monkeypatch):
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', [backups[1][0], DEAD_BACKUP])
+
+    with pytest.raises(grpc.RpcError) as error:
+        upload(grpc_server(origin.OriginServer()), 'f', b'data')
+    assert error.value.code() == grpc.StatusCode.UNAVAILABLE
+
+
+@pytest.mark.parametrize('mode', ['quorum', 'async'])
+def test_quorum_and_async_acks_tolerate_a_backup_that_is_down(origin, backups, grpc_server, monkeypatch, mode):
+    servicers, addresses = backups
+    monkeypatch.setattr(origin, 'REPLICATION_ACK', mode)
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', [addresses[0], DEAD_BACKUP])
+
+    reply = upload(grpc_server(origin.OriginServer()), 'f', b'data')
+
+    assert reply.length == 4
+    wait_for(lambda: stored(servicers[0], 'f') == reply.hash)
+
+
+class StalledBackup(FileServer):
+    def __init__(self, storage_dir):
+        super().__init__(storage_dir)
+        self.release = threading.Event()
+
+    def put(self, request_iterator, context):
+        self.release.wait(10)
+        return super().put(request_iterator, context)
+
+
+class FlakyBackup(FileServer):
+    def __init__(self, storage_dir, failures):
+        super().__init__(storage_dir)
+        self.failures = failures
+
+    def put(self, request_iterator, context):
+        if self.failures:
+            self.failures -= 1
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'flaky backup')
+        return super().put(request_iterator, context)
+
+
+def test_async_acks_replicate_after_the_upload_without_waiting_on_the_backups(origin, tmp_path, grpc_server,
+                                                                              monkeypatch):
+    backup = StalledBackup(f'{tmp_path}/stalled/')
+    monkeypatch.setattr(origin, 'REPLICATION_ACK', 'async')
+    monkeypatch.setattr(origin, 'REPLICATION_QUEUE_SIZE', 1)
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', [grpc_server(backup)])
+
+    start = time.monotonic()
+    reply = upload(grpc_server(origin.OriginServer()), 'f', *[os.urandom(1024 * 1024) for _ in range(8)])
+    assert time.monotonic() - start < origin.REPLICATION_LAG_TIMEOUT
+    assert stored(backup, 'f') is None
+
+    backup.release.set()
+    wait_for(lambda: stored(backup, 'f') == reply.hash)
+
+
+def test_failed_repairs_are_retried_until_the_backup_has_the_file(origin, backups, tmp_path, grpc_server, monkeypatch):
+    servicers, addresses = backups
+    flaky = FlakyBackup(f'{tmp_path}/flaky/', failures=3)
+    monkeypatch.setattr(origin, 'REPLICATION_ACK', 'quorum')
+    monkeypatch.setattr(origin, 'REPAIR_INTERVAL', 0.1)
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', [addresses[0], grpc_server(flaky)])
+
+    reply = upload(grpc_server(origin.OriginServer()), 'f', b'data')
+
+    wait_for(lambda: stored(flaky, 'f') == reply.hash)
+    assert flaky.failures == 0
+
+
+def test_backups_missing_a_forwarded_digest_are_repaired_before_the_ack(origin, backups, grpc_server, monkeypatch):
+    servicers, addresses = backups
+    address = grpc_server(origin.OriginServer())
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', [])
+    upload(address, 'a', b'shared chunk')
+
+    # the backups never saw the chunk, so they reject the digest the origin forwards
+    monkeypatch.setattr(origin, 'BACKUP_ADDRESSES', addresses)
+    stub = ops_pb2_grpc.FileServerStub(grpc.insecure_channel(address))
+    reply = stub.put(iter([ops_pb2.Chunk(name='b', digest=hashlib.sha256(b'shared chunk').hexdigest()),
+                           ops_pb2.Chunk(name='b', buffer=b'!')]))
+
+    assert [stored(servicer, 'b') for servicer in servicers] == [reply.hash, reply.hash]
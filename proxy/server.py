@@ -1,12 +1,30 @@
 import os
+import json
 import grpc
 import time
+import asyncio
 import random
 import logging
-from datetime import datetime, timedelta
+import shutil
+import hashlib
+import tempfile
+import mimetypes
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from concurrent import futures
-from threading import Thread
-from flask import Flask, request
+from threading import Thread, Lock, Event, Condition
+from flask import Flask, Response, request, jsonify, send_file, g
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.responses import Response as AsyncResponse, StreamingResponse
+from starlette.routing import Route
+import uvicorn
+import httpx
 
 import ops_pb2_grpc
 import ops_pb2
@@ -16,12 +34,52 @@ PORT = os.environ.get("PORT", 5000)
 ORIGIN_PORT = os.environ.get("ORIGIN_PORT", 8001)
 ORIGIN_BACKUPS = [port for port in os.environ.get('ORIGIN_BACKUPS').split(",")]
 CACHE_DIR = os.environ.get("CACHE_DIR", "cache/")
+# the cache index and the chunk store, kept outside of CACHE_DIR so no request can reach them
+CACHE_META_DIR = os.environ.get("CACHE_META_DIR", os.path.normpath(CACHE_DIR) + '.meta/')
+CHUNKS_KEY_PREFIX = '.chunks/'  # indexes the cached chunks of a file, requested paths never start with a dot
 TTL = float(os.environ.get("TTL", 120))
+STALE_WHILE_REVALIDATE = float(os.environ.get("STALE_WHILE_REVALIDATE", 0))
+STALE_IF_ERROR = float(os.environ.get("STALE_IF_ERROR", 0))
+INDEX_SNAPSHOT_INTERVAL = float(os.environ.get("INDEX_SNAPSHOT_INTERVAL", 60))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 0))  # 0 leaves the disk cache unbounded
+CACHE_LOW_WATERMARK = float(os.environ.get("CACHE_LOW_WATERMARK", 0.9))
+CACHE_EVICTION_POLICY = os.environ.get("CACHE_EVICTION_POLICY", "lru")
+EVICTION_INTERVAL = float(os.environ.get("EVICTION_INTERVAL", 5))
 BASE_LATENCY = float(os.environ.get("BASE_LATENCY", 1))
 IN_SCALE = float(os.environ.get("IN_SCALE", 1))
 OUT_SCALE = float(os.environ.get("OUT_SCALE", 1))
+MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_SIZE", 64 * 1024 * 1024))  # 64MB
+MEMORY_CACHE_MAX_OBJECT = int(os.environ.get("MEMORY_CACHE_MAX_OBJECT", CHUNK_SIZE))
+MEMORY_CACHE_PROTECTED = float(os.environ.get("MEMORY_CACHE_PROTECTED", 0.8))
 TIME_FORMAT = '%Y-%m-%d-%H:%M:%S.%f'
 AREA = os.environ.get('AREA')
+PROXY_MODE = os.environ.get('PROXY_MODE', 'threaded')  # 'threaded' runs Flask, 'async' runs the asyncio proxy
+LOAD_BALANCER = os.environ.get('LOAD_BALANCER')  # e.g. http://load_balancer:8000/, registers the proxy on startup
+PROXY_ADDRESS = os.environ.get('PROXY_ADDRESS')  # the address of this proxy in the docker network
+PUBLIC_ADDRESS = os.environ.get('PUBLIC_ADDRESS')  # the address clients are redirected to
+PROXY_WEIGHT = float(os.environ.get('PROXY_WEIGHT', 1))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # the admin token of the load balancer, to register with it
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 1))  # between reconnects of a health watch
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 1))
+KEEPALIVE_TIME = float(os.environ.get('KEEPALIVE_TIME', 10))  # seconds between keepalive pings on idle channels
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', 5))
+CHANNEL_OPTIONS = [('grpc.keepalive_time_ms', int(KEEPALIVE_TIME * 1000)),
+                   ('grpc.keepalive_timeout_ms', int(KEEPALIVE_TIMEOUT * 1000)),
+                   ('grpc.keepalive_permit_without_calls', 1),
+                   ('grpc.http2.max_pings_without_data', 0)]
+HEDGE_MAX = int(os.environ.get('HEDGE_MAX', 1))  # extra origin servers a slow fetch is hedged to, 0 disables
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))  # of recent first chunk latencies
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 3))  # until HEDGE_MIN_SAMPLES fetches were timed
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.05))
+HEDGE_MIN_SAMPLES = 20
+SIBLINGS = [url for url in os.environ.get('SIBLINGS', '').split(',') if url]  # e.g. http://proxy0.1:5001, the proxies of the same area
+SHIELD = os.environ.get('SHIELD')  # e.g. http://shield0:5010, the proxy every origin fetch of the area goes through
+PEER_TIMEOUT = float(os.environ.get('PEER_TIMEOUT', 2))  # seconds the siblings have to start serving a cached copy
+SHIELD_TIMEOUT = float(os.environ.get('SHIELD_TIMEOUT', 30))  # seconds the shield has to start serving a file it may fetch from the origin first
+STRIPE_THRESHOLD = int(os.environ.get('STRIPE_THRESHOLD', 0))  # files this large are fetched from every origin server at once, 0 disables
+STRIPE_SIZE = int(os.environ.get('STRIPE_SIZE', 8 * 1024 * 1024))  # the size of the byte ranges of a striped download
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', 30))  # deadline of the fetch of one stripe
+ORIGIN_CHUNK_SIZE = int(os.environ.get('ORIGIN_CHUNK_SIZE', 0))  # the size of the chunks to ask the origin for, 0 for its default
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s',
@@ -43,9 +101,378 @@ def introduce_latency(request_area_id=None):
 
     return latency
 
+class IndexEntry:
+    __slots__ = ('size', 'expiry', 'last_access', 'etag', 'last_modified', 'hits')
+
+    def __init__(self, size, expiry, last_access=None, etag=None, last_modified=None, hits=0):
+        """
+        The metadata of a file in the cache.
+
+        :param size: The size of the file in bytes
+        :param expiry: The datetime after which the file must be revalidated
+        :param last_access: The time the file was last served as a timestamp
+        :param etag: The content hash of the file
+        :param last_modified: The modification time of the file at the origin as a timestamp
+        :param hits: The number of times the file was served from the cache
+        """
+        self.size = size
+        self.expiry = expiry
+        self.last_access = last_access or time.time()
+        self.etag = etag
+        self.last_modified = last_modified
+        self.hits = hits
+
+    def to_record(self):
+        return {
+            'size': self.size,
+            'expiry': self.expiry.timestamp(),
+            'last_access': self.last_access,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'hits': self.hits,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['size'], datetime.fromtimestamp(record['expiry']), record.get('last_access'),
+                   record.get('etag'), record.get('last_modified'), record.get('hits', 0))
+
+
+class CacheIndex:
+    def __init__(self, meta_location=CACHE_META_DIR):
+        """
+        An in-memory index of the files in the cache, persisted as a snapshot plus an append-only
+        journal of the changes made since the snapshot. On start up the snapshot is loaded and the
+        journal replayed, so the index is rebuilt without walking the cache directory.
+
+        :param meta_location: The metadata directory the index is kept in
+        """
+        self.directory = os.path.join(meta_location, 'index')
+        self.snapshot_path = os.path.join(self.directory, 'snapshot')
+        self.journal_path = os.path.join(self.directory, 'journal')
+        self.entries = {}
+        self.bytes = 0
+        self.lock = Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+        self.journal = open(self.journal_path, 'a')
+        self.snapshot()
+
+    def _load(self):
+        """
+        Loads the last snapshot and replays the journals written after it.
+        """
+        start = time.time()
+        try:
+            with open(self.snapshot_path) as f:
+                self.entries = {key: IndexEntry.from_record(record) for key, record in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logging.warning(f"Cache index snapshot {self.snapshot_path} is corrupt, ignoring it")
+        self.bytes = sum(entry.size for entry in self.entries.values())
+
+        # journal.old is left behind if the proxy stopped while a snapshot was being written
+        for path in (self.journal_path + '.old', self.journal_path):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break  # a torn write at the end of the journal
+                        self._apply(record)
+            except FileNotFoundError:
+                pass
+
+        logging.info(f"Loaded cache index of {len(self.entries)} files in {round((time.time() - start) * 1000, 1)} ms")
+
+    def _apply(self, record):
+        key = record['key']
+        if record['op'] in ('put', 'remove') and key in self.entries:
+            self.bytes -= self.entries.pop(key).size
+
+        if record['op'] == 'put':
+            self.entries[key] = IndexEntry.from_record(record)
+            self.bytes += record['size']
+        elif record['op'] == 'expiry' and key in self.entries:
+            self.entries[key].expiry = datetime.fromtimestamp(record['expiry'])
+        elif record['op'] == 'size' and key in self.entries:
+            self.bytes += record['size'] - self.entries[key].size
+            self.entries[key].size = record['size']
+
+    def _log(self, record):
+        with self.lock:
+            self._apply(record)
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+
+    def get(self, key):
+        """
+        Returns the index entry of a file.
+
+        :param key: The key of the file
+        :return: The IndexEntry, or None if the file is not in the cache.
+        """
+        return self.entries.get(key)
+
+    def put(self, key, size, expiry, etag=None, last_modified=None):
+        """
+        Adds or replaces the index entry of a file.
+
+        :param key: The key of the file
+        :param size: The size of the file in bytes
+        :param expiry: The datetime after which the file must be revalidated
+        :param etag: The content hash of the file
+        :param last_modified: The modification time of the file at the origin as a timestamp
+        """
+        self._log({'op': 'put', 'key': key, **IndexEntry(size, expiry, None, etag, last_modified).to_record()})
+
+    def set_expiry(self, key, expiry):
+        """
+        Changes the expiry of a file in the index.
+
+        :param key: The key of the file
+        :param expiry: The datetime after which the file must be revalidated
+        """
+        if key in self.entries:
+            self._log({'op': 'expiry', 'key': key, 'expiry': expiry.timestamp()})
+
+    def resize(self, key, size):
+        """
+        Changes the size of a file in the index.
+
+        :param key: The key of the file
+        :param size: The size of the file in bytes
+        """
+        if key in self.entries:
+            self._log({'op': 'size', 'key': key, 'size': size})
+
+    def remove(self, key):
+        """
+        Removes a file from the index.
+
+        :param key: The key of the file
+        """
+        if key in self.entries:
+            self._log({'op': 'remove', 'key': key})
+
+    def touch(self, key):
+        """
+        Records an access to a file. Access times and hit counts are only persisted by snapshots.
+
+        :param key: The key of the file
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.last_access = time.time()
+            entry.hits += 1
+
+    def stats(self):
+        """
+        Returns the number of files in the index and their total size.
+        """
+        return {'objects': len(self.entries), 'bytes': self.bytes}
+
+    def snapshot(self):
+        """
+        Writes every entry to a new snapshot and starts a new journal.
+        """
+        with self.lock:
+            self.journal.close()
+            os.replace(self.journal_path, self.journal_path + '.old')
+            self.journal = open(self.journal_path, 'a')
+            records = {key: entry.to_record() for key, entry in self.entries.items()}
+
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, prefix='.', suffix='.tmp', delete=False) as f:
+            json.dump(records, f)
+        os.replace(f.name, self.snapshot_path)
+        os.unlink(self.journal_path + '.old')
+
+    def run_snapshots(self):
+        """
+        Writes a snapshot every INDEX_SNAPSHOT_INTERVAL seconds.
+        """
+        while True:
+            time.sleep(INDEX_SNAPSHOT_INTERVAL)
+            try:
+                self.snapshot()
+            except Exception as e:
+                logging.error(f"Failed to snapshot the cache index. {str(e)}")
+
+
+class LRUPolicy:
+    """
+    Evicts the least recently used files first and admits every file.
+    """
+    name = 'lru'
+
+    def __init__(self):
+        # the cached files, least recently used first
+        self.order = OrderedDict()
+        self.lock = Lock()
+
+    def record(self, key):
+        """
+        Records a request for a key.
+        """
+
+    def load(self, entries):
+        """
+        Builds the eviction order of the files that are already cached.
+
+        :param entries: A list of (key, IndexEntry) tuples
+        """
+        for key, entry in sorted(entries, key=lambda item: item[1].last_access):
+            self.update(key, entry)
+
+    def update(self, key, entry):
+        """
+        Moves a file to its place in the eviction order after it was cached or served.
+
+        :param key: The key of the file
+        :param entry: The IndexEntry of the file
+        """
+        with self.lock:
+            self.order[key] = None
+            self.order.move_to_end(key)
+
+    def discard(self, key):
+        """
+        Drops a file that left the cache from the eviction order.
+
+        :param key: The key of the file
+        """
+        with self.lock:
+            self.order.pop(key, None)
+
+    def victim(self):
+        """
+        :return: The key of the file to evict first, or None if nothing is cached.
+        """
+        with self.lock:
+            return next(iter(self.order), None)
+
+    def admit(self, key, victim):
+        """
+        Decides if a new file may replace the file that would be evicted for it.
+
+        :param key: The key of the new file
+        :param victim: The key of the file that would be evicted
+        """
+        return True
+
+
+class LFUPolicy(LRUPolicy):
+    """
+    Evicts the least frequently served files first, breaking ties by recency.
+    """
+    name = 'lfu'
+
+    def __init__(self):
+        super().__init__()
+        # the cached files by hit count, least recently used first
+        self.buckets = {}
+        self.hits = {}
+
+    def update(self, key, entry):
+        with self.lock:
+            self._remove(key)
+            self.hits[key] = entry.hits
+            self.buckets.setdefault(entry.hits, OrderedDict())[key] = None
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def victim(self):
+        with self.lock:
+            if not self.buckets:
+                return None
+            return next(iter(self.buckets[min(self.buckets)]))
+
+    def _remove(self, key):
+        hits = self.hits.pop(key, None)
+        if hits is None:
+            return
+        bucket = self.buckets[hits]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[hits]
+
+
+class TinyLFUPolicy(LRUPolicy):
+    """
+    Evicts in LRU order, but only admits a new file when a count-min sketch of recent request
+    frequencies says it is more popular than the file it would evict. This keeps one-off requests
+    from a scan over the long tail from pushing popular files out of the cache.
+    """
+    name = 'tinylfu'
+
+    def __init__(self, width=4096, depth=4):
+        super().__init__()
+        self.width = width
+        self.depth = depth
+        self.counters = [[0] * width for _ in range(depth)]
+        self.additions = 0
+        self.sample_size = width * 10
+
+    def _cells(self, key):
+        return [(row, hash((row, key)) % self.width) for row in range(self.depth)]
+
+    def frequency(self, key):
+        return min(self.counters[row][column] for row, column in self._cells(key))
+
+    def record(self, key):
+        with self.lock:
+            for row, column in self._cells(key):
+                self.counters[row][column] += 1
+
+            # halve every counter once in a while so old popularity fades out
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.additions = 0
+                self.counters = [[count // 2 for count in row] for row in self.counters]
+
+    def admit(self, key, victim):
+        return self.frequency(key) > self.frequency(victim)
+
+
+EVICTION_POLICIES = {policy.name: policy for policy in (LRUPolicy, LFUPolicy, TinyLFUPolicy)}
+
+
 class FileStore:
-    def __init__(self, cache_location=CACHE_DIR):
+    def __init__(self, cache_location=CACHE_DIR, capacity=CACHE_MAX_BYTES, policy=CACHE_EVICTION_POLICY,
+                 on_remove=None, on_reject=None, meta_location=None):
+        """
+        The disk cache of the proxy.
+
+        :param cache_location: The directory the files are cached in
+        :param capacity: The maximum number of bytes of files and chunks kept in the cache, 0 for no limit
+        :param policy: The name of the eviction policy, one of EVICTION_POLICIES
+        :param on_remove: Called with the key of every file removed from the cache, so the tiers in front
+        of it drop their copies
+        :param on_reject: Called with the key and the open, unlinked file of every download the eviction
+        policy did not admit, so the requests waiting on the download can still be served from it
+        :param meta_location: The directory the cache index and the chunk store are kept in, next to the
+        cache directory by default
+        """
+        meta_location = meta_location or os.path.normpath(cache_location) + '.meta/'
         self.cache = cache_location
+        self.on_remove = on_remove
+        self.on_reject = on_reject
+        self.index = CacheIndex(meta_location)
+        self.chunks = ChunkStore(meta_location, self)
+        self.capacity = capacity
+        self.policy = EVICTION_POLICIES[policy]()
+        self.policy.load(list(self.index.entries.items()))
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.bytes_missed = 0
+        self.evictions = 0
+        self.rejections = 0
 
     def get_file_chunks(self, filename):
         """
@@ -63,6 +490,102 @@ class FileStore:
                 yield ops_pb2.Chunk(buffer=piece)
 
 
+    def tee_chunks_to_file(self, chunks, filename):
+        """
+        Writes the chunks to a temp file while yielding them, and atomically moves the temp file into
+        the cache once the chunks are exhausted. If the chunks fail or the generator is closed early
+        the temp file is discarded, so readers never see a partial file. The content hash and origin
+        modification time of the file are recorded as its validators.
+
+        :param chunks: The chunks of data that are being downloaded
+        :param filename: The name of the file to be downloaded
+        :return: A generator of the chunks.
+        """
+        f = self.open_temp(filename)
+        digest = hashlib.sha256()
+        mtime = None
+        size = 0
+
+        try:
+            with f:
+                for chunk in chunks:
+                    f.write(chunk.buffer)
+                    digest.update(chunk.buffer)
+                    mtime = mtime or chunk.mtime
+                    size += len(chunk.buffer)
+                    yield chunk
+        except BaseException:
+            os.unlink(f.name)
+            if hasattr(chunks, 'cancel'):
+                chunks.cancel()
+            raise
+
+        self.commit(f.name, filename, size, digest.hexdigest(), mtime)
+
+    async def async_tee_chunks_to_file(self, chunks, filename):
+        """
+        The async counterpart of tee_chunks_to_file, with the writes offloaded to a thread so they do
+        not block the event loop.
+
+        :param chunks: The async generator of the chunks that are being downloaded
+        :param filename: The name of the file to be downloaded
+        :return: An async generator of the chunks.
+        """
+        f = self.open_temp(filename)
+        digest = hashlib.sha256()
+        mtime = None
+        size = 0
+
+        try:
+            with f:
+                async for chunk in chunks:
+                    await asyncio.to_thread(f.write, chunk.buffer)
+                    digest.update(chunk.buffer)
+                    mtime = mtime or chunk.mtime
+                    size += len(chunk.buffer)
+                    yield chunk
+        except BaseException:
+            os.unlink(f.name)
+            await chunks.aclose()
+            raise
+
+        self.commit(f.name, filename, size, digest.hexdigest(), mtime)
+
+    def open_temp(self, filename):
+        """
+        Opens a temp file next to where a file will be cached.
+
+        :param filename: The name of the file to be cached
+        :return: The open temp file.
+        """
+        directory = os.path.dirname(self.cache + filename) or '.'
+        os.makedirs(directory, exist_ok=True)
+
+        return tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.tmp', delete=False)
+
+    def commit(self, temp_name, filename, size, etag, last_modified):
+        """
+        Atomically moves a fully written temp file into the cache and indexes it, unless the
+        eviction policy does not admit it, in which case the temp file is discarded after it is
+        opened and handed to on_reject.
+
+        :param temp_name: The path of the temp file
+        :param filename: The name of the file to be cached
+        :param size: The size of the file in bytes
+        :param etag: The content hash of the file
+        :param last_modified: The modification time of the file at the origin as a timestamp
+        """
+        if not self.admit(filename, size):
+            f = open(temp_name, 'rb') if self.on_reject is not None else None
+            os.unlink(temp_name)
+            if f is not None:
+                self.on_reject(filename, f)
+            return
+
+        os.replace(temp_name, self.cache + filename)
+        self.index.put(filename, size, datetime.now() + timedelta(seconds=TTL), etag, last_modified)
+        self.update_policy(filename)
+
     def save_chunks_to_file(self, chunks, filename):
         """
         It takes a list of chunks and a filename, and writes the chunks to the file
@@ -70,9 +593,17 @@ class FileStore:
         :param chunks: The chunks of data that are being downloaded
         :param filename: The name of the file to be downloaded
         """
-        with open(self.cache+filename, 'wb') as f:
-            for chunk in chunks:
-                f.write(chunk.buffer)
+        for _ in self.tee_chunks_to_file(chunks, filename):
+            pass
+
+    def get_path(self, key):
+        """
+        Returns the absolute path of a key in the cache.
+
+        :param key: The key of the object
+        :return: The path of the cached file.
+        """
+        return os.path.abspath(os.path.join(self.cache, key))
 
     def get(self, key):
         """
@@ -89,133 +620,2532 @@ class FileStore:
         except Exception as e:
             return False
         
+    def get_expiry(self, key):
+        """
+        Looks up the expiry time of a cache key in the cache index.
+
+        :param key: key of the cached item
+        :return: The expiry as a datetime, or None if the key is not cached.
+        """
+        entry = self.index.get(key)
+
+        return entry.expiry if entry is not None else None
+
     def is_expired(self, key):
         """
-        Checks if a cache key has expired based on its time-to-live (TTL) attribute.
+        Checks if a cache key has expired based on its time-to-live (TTL).
         
         :param key: key of the cached item that we want to check for expiration
         :return: If the cache entry has expired, it returns True, otherwise it returns False.
         """
-        try:
-            ttl = os.getxattr(self.cache+key, 'user.ttl').decode()
+        expiry = self.get_expiry(key)
 
-            return datetime.strptime(ttl, TIME_FORMAT) < datetime.now()
-        except Exception as e:
-            return True
+        return expiry is None or expiry < datetime.now()
     
     def set_TTL(self, key):
         """
-        Sets a time-to-live (TTL) attribute for a given key in a cache using the current time
+        Sets the time-to-live (TTL) of a given key in the cache using the current time
         plus a specified TTL value.
         
         :param key: key of the cached item that we want to check for expiration
         """
+        self.index.set_expiry(key, datetime.now() + timedelta(seconds=TTL))
+
+    def get_validators(self, key):
+        """
+        Looks up the validators of a cached file in the cache index.
+
+        :param key: key of the cached item
+        :return: A tuple of the content hash and the origin modification time, each None if unknown.
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None, None
+
+        return entry.etag, entry.last_modified
+
+    def record_access(self, key):
+        """
+        Records that a cached file was served.
+
+        :param key: key of the cached item
+        """
+        self.index.touch(key)
+        self.update_policy(key)
+
+    def update_policy(self, key):
+        """
+        Moves a file to its place in the eviction order after its index entry changed.
+
+        :param key: key of the cached item
+        """
+        entry = self.index.get(key)
+        if entry is not None:
+            self.policy.update(key, entry)
+
+    def record_request(self, key):
+        """
+        Records a request for a key with the eviction policy, whether it is cached or not.
+
+        :param key: key of the requested item
+        """
+        self.policy.record(key)
+
+    def record_hit(self, size):
+        self.hits += 1
+        self.bytes_hit += size
+
+    def record_miss(self, size):
+        self.misses += 1
+        self.bytes_missed += size
+
+    def admit(self, key, size):
+        """
+        Decides if a downloaded file is cached. Files always fit while the cache is under capacity,
+        otherwise the eviction policy decides between the file and the first file it would evict.
+
+        :param key: key of the downloaded item
+        :param size: The size of the file in bytes
+        :return: True if the file should be cached.
+        """
+        if not self.capacity or key in self.index.entries or self.index.bytes + size <= self.capacity:
+            return True
+
+        victim = self.victim()
+        if size > self.capacity or victim is None:
+            self.rejections += 1
+            return False
+
+        if self.policy.admit(key, victim):
+            return True
+
+        self.rejections += 1
+        logging.info(f"Eviction policy rejected caching {key} in favour of {victim}")
+        return False
+
+    def remove(self, key):
+        """
+        Deletes a file from the cache.
+
+        :param key: key of the cached item
+        """
+        self.index.remove(key)
+        self.policy.discard(key)
+        if key.startswith(CHUNKS_KEY_PREFIX):
+            self.chunks.drop(key[len(CHUNKS_KEY_PREFIX):])
+            return
+
+        if self.on_remove is not None:
+            self.on_remove(key)
         try:
-            timestamp = datetime.now() + timedelta(seconds=TTL)
-            os.setxattr(self.cache+key, 'user.ttl', timestamp.strftime(TIME_FORMAT).encode())
-        except Exception as e:
+            os.unlink(self.cache+key)
+        except FileNotFoundError:
             pass
 
+    def victim(self):
+        """
+        Returns the cached file the eviction policy evicts first. The policy keeps its order up to date
+        as files are cached, served and removed, so no sort over the whole index is needed.
 
-class FileClient:
-    def __init__(self, address, file_store):
+        :return: The key of the file, or None if nothing is cached.
         """
-        Initializes the file store interface, creates a gRPC channel to the origin server and server stub
-        
-        :param address: The address of the origin server
-        :param file_store: The path to the directory where the files will be stored
+        while True:
+            key = self.policy.victim()
+            if key is None or key in self.index.entries:
+                return key
+            # the file was removed while it was being served
+            self.policy.discard(key)
+
+    def evict(self):
         """
-        channel = grpc.insecure_channel(address)
-        self.stub = ops_pb2_grpc.FileServerStub(channel)
-        self.storage = file_store
+        Evicts files in the order of the eviction policy until the cache is under its low watermark,
+        if it is over capacity.
+        """
+        if not self.capacity or self.index.bytes <= self.capacity:
+            return
 
-    def upload(self, in_file_name):
+        target = self.capacity * CACHE_LOW_WATERMARK
+        while self.index.bytes > target:
+            key = self.victim()
+            if key is None:
+                break
+            self.remove(key)
+            self.evictions += 1
+
+        logging.info(f"Evicted files from the cache down to {self.index.bytes} bytes")
+
+    def run_eviction(self):
         """
-        It takes a file name, splits it into chunks, and sends those chunks to the server
-        
-        :param in_file_name: The name of the file to be uploaded
+        Runs evict every EVICTION_INTERVAL seconds.
         """
-        chunks_generator = self.storage.get_file_chunks(in_file_name)
-        response = self.stub.put(chunks_generator)
+        while True:
+            time.sleep(EVICTION_INTERVAL)
+            try:
+                self.evict()
+            except Exception as e:
+                logging.error(f"Failed to evict files from the cache. {str(e)}")
 
-        assert response.length == os.path.getsize(in_file_name)
+    def stats(self):
+        """
+        Returns the size of the cache along with its hit ratio and byte hit ratio.
+        """
+        requests = self.hits + self.misses
+        bytes_requested = self.bytes_hit + self.bytes_missed
+        return {
+            **self.index.stats(),
+            'capacity': self.capacity,
+            'policy': self.policy.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0,
+            'byte_hit_ratio': self.bytes_hit / bytes_requested if bytes_requested else 0,
+            'evictions': self.evictions,
+            'rejections': self.rejections,
+        }
 
 
-    def download(self, target_name):
+class ChunkStore:
+    def __init__(self, meta_location, files):
         """
-        It sends a request to the server to download a file, and then saves the chunks of data it receives
-        to a file
-        
-        :param target_name: The name of the file you want to download
+        Caches parts of files at CHUNK_SIZE granularity, so a ranged request into a large file only
+        fetches and stores the chunks it covers. Each file gets a directory holding one file per
+        chunk index and a meta file with the size of the file and the expiry of its chunks. The
+        chunks of a file are indexed by the FileStore under CHUNKS_KEY_PREFIX and the key of the file,
+        so they count towards its capacity and are evicted by its eviction policy.
+
+        :param meta_location: The metadata directory the chunk directories are kept under
+        :param files: The FileStore the chunks are indexed by
         """
-        response = self.stub.get(ops_pb2.Request(name=target_name))
-        self.storage.save_chunks_to_file(response, target_name)
-        self.storage.set_TTL(target_name)
+        self.cache = os.path.join(meta_location, 'chunks')
+        self.files = files
+        self.meta = {}
+        self.lock = Lock()
 
-liveliness = {f'origin_backup{i+1}:{ORIGIN_BACKUPS[i]}': False for i in range(len(ORIGIN_BACKUPS))}
-liveliness.update({f'origin:{ORIGIN_PORT}': False})
+    def _dir(self, key):
+        return os.path.join(self.cache, key)
 
-def check_liveliness(liveliness):
-    while True:
-        for addr in liveliness.keys():
+    def get_size(self, key):
+        """
+        Returns the size of a file that has unexpired chunks in the store.
+
+        :param key: The key of the file
+        :return: The size of the file in bytes, or None if none of its chunks are cached.
+        """
+        with self.lock:
+            meta = self.meta.get(key)
+
+        if meta is None:
             try:
-                with grpc.insecure_channel(addr) as channel:
-                    stub = ops_pb2_grpc.FileServerStub(channel)
-                    res = stub.heartbeat(ops_pb2.HeartbeatRequest(message="hello"))
-                    liveliness[addr] = True if res.message == 'acknowledged' else False
-            except Exception:
-                liveliness[addr] = False
+                with open(os.path.join(self._dir(key), 'meta')) as f:
+                    data = json.load(f)
+                meta = (data['size'], datetime.strptime(data['expiry'], TIME_FORMAT))
+            except (OSError, ValueError, KeyError):
+                return None
 
-    
-app = Flask(__name__)
-file_store = FileStore()
-client = FileClient(f'origin:{ORIGIN_PORT}', file_store) # hostname must be docker service name since the origin server is in the same network
+            with self.lock:
+                self.meta[key] = meta
 
-@app.route('/heartbeat')
-def heartbeat():
-    """
-    Responds to heartbeat with 'OK'.
-    :return: 'OK'
-    """
-    return 'OK'
+        size, expiry = meta
+        if expiry < datetime.now():
+            self.invalidate(key)
+            return None
 
-@app.route('/<path:path>')
-def serve_GET(path):
-    """
-    Serves the requested file by checking if it is in the cache and returning it, otherwise
-    downloading it from the origin server or a live backup if the primary origin is dead.
-    
-    :param path: The path of the file to be served
-    :return: The file is being returned.
-    """
-    time.sleep(introduce_latency(request.args.get("area")))
+        return size
 
-    file = file_store.get(path)
+    def set_size(self, key, size):
+        """
+        Records the size of a file and starts the time-to-live of its chunks.
 
-    if file and not file_store.is_expired(path):
-        logging.info(f"Served file {path}. Request was a cache hit")
-        return file
-    
-    # If primary origin is dead, request file from a live backup
-    if liveliness[f'origin:{ORIGIN_PORT}']:
-        client.download(path) 
-    else:
-        logging.warning(f"Primary Origin on port {ORIGIN_PORT} is dead")
-        backups = list(liveliness.keys())
-        random.shuffle(backups)
-        
-        for backup in backups:
-            if liveliness[backup]:
-                FileClient(backup, file_store).download(path)
+        :param key: The key of the file
+        :param size: The size of the file in bytes
+        """
+        expiry = datetime.now() + timedelta(seconds=TTL)
+        self._write(key, 'meta', json.dumps({'size': size, 'expiry': expiry.strftime(TIME_FORMAT)}).encode())
 
-    logging.info(f"Served file {path}. Request was a cache miss")
-    return file_store.get(path)
+        with self.lock:
+            self.meta[key] = (size, expiry)
+            self.files.index.put(CHUNKS_KEY_PREFIX + key, 0, expiry)
+        self.files.update_policy(CHUNKS_KEY_PREFIX + key)
 
+    def has_chunk(self, key, index):
+        return os.path.exists(os.path.join(self._dir(key), str(index)))
 
-if __name__ == "__main__":
-    th = Thread(target=check_liveliness, args=(liveliness,))
-    th.start()
+    def get_chunk(self, key, index):
+        """
+        Returns the data of a cached chunk.
+
+        :param key: The key of the file
+        :param index: The index of the chunk in the file
+        :return: The chunk data, or None if the chunk is not cached.
+        """
+        try:
+            with open(os.path.join(self._dir(key), str(index)), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
 
-    app.run(debug=False, host="0.0.0.0", port=PORT)
+        self.files.record_access(CHUNKS_KEY_PREFIX + key)
+        return data
+
+    def save_chunk(self, key, index, data):
+        """
+        Atomically stores the data of a chunk.
+
+        :param key: The key of the file
+        :param index: The index of the chunk in the file
+        :param data: The chunk data
+        """
+        added = 0 if self.has_chunk(key, index) else len(data)
+        self._write(key, str(index), data)
+        with self.lock:
+            entry = self.files.index.get(CHUNKS_KEY_PREFIX + key)
+            if entry is not None:
+                self.files.index.resize(CHUNKS_KEY_PREFIX + key, entry.size + added)
+
+    def is_complete(self, key, size):
+        """
+        Checks if every chunk of a file is cached.
+
+        :param key: The key of the file
+        :param size: The size of the file in bytes
+        """
+        return all(self.has_chunk(key, index) for index in range(-(-size // CHUNK_SIZE)))
+
+    def invalidate(self, key):
+        """
+        Drops every cached chunk of a file and its index entry.
+
+        :param key: The key of the file
+        """
+        self.files.remove(CHUNKS_KEY_PREFIX + key)
+
+    def drop(self, key):
+        """
+        Deletes every cached chunk of a file, once the FileStore has removed its index entry.
+
+        :param key: The key of the file
+        """
+        with self.lock:
+            self.meta.pop(key, None)
+            shutil.rmtree(self._dir(key), ignore_errors=True)
+
+    def _write(self, key, name, data):
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, os.path.join(directory, name))
+
+
+class MemoryCache:
+    def __init__(self, capacity=MEMORY_CACHE_SIZE, protected_ratio=MEMORY_CACHE_PROTECTED):
+        """
+        A size-bounded, segmented LRU cache of hot objects kept in front of the FileStore.
+        New objects enter a probationary segment and are promoted to the protected segment
+        on their second hit, so a burst of one-off requests cannot flush the popular objects.
+
+        :param capacity: The maximum number of bytes held in memory
+        :param protected_ratio: The fraction of the capacity reserved for the protected segment
+        """
+        self.capacity = capacity
+        self.protected_capacity = int(capacity * protected_ratio)
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.probation_size = 0
+        self.protected_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the cached contents of a key if it is held in memory and not expired.
+
+        :param key: The key of the object to get
+        :return: A tuple of the object contents as binary data, its etag and its last modified
+        time, or None on a miss.
+        """
+        with self.lock:
+            if key in self.protected:
+                segment = self.protected
+            elif key in self.probation:
+                segment = self.probation
+            else:
+                self.misses += 1
+                return None
+
+            value, expiry, etag, last_modified = segment[key]
+            if expiry < datetime.now():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            if segment is self.protected:
+                self.protected.move_to_end(key)
+            else:
+                self._promote(key)
+
+            self.hits += 1
+            return value, etag, last_modified
+
+    def put(self, key, value, expiry, etag=None, last_modified=None):
+        """
+        Adds an object to the probationary segment, evicting the least recently used objects
+        if the cache is over its byte budget. Objects larger than the whole budget are not cached.
+
+        :param key: The key of the object
+        :param value: The object contents as binary data
+        :param expiry: The datetime after which the object must no longer be served
+        :param etag: The content hash of the object
+        :param last_modified: The modification time of the object at the origin as a timestamp
+        """
+        if not value or expiry is None or expiry < datetime.now() or len(value) > self.capacity:
+            return
+
+        with self.lock:
+            self._remove(key)
+            self.probation[key] = (value, expiry, etag, last_modified)
+            self.probation_size += len(value)
+            self._evict()
+
+    def invalidate(self, key):
+        """
+        Drops an object from the cache.
+
+        :param key: The key of the object
+        """
+        with self.lock:
+            self._remove(key)
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters along with the current size of the cache.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'objects': len(self.probation) + len(self.protected),
+                'bytes': self.probation_size + self.protected_size,
+                'capacity': self.capacity,
+            }
+
+    def _remove(self, key):
+        if key in self.probation:
+            self.probation_size -= len(self.probation.pop(key)[0])
+        elif key in self.protected:
+            self.protected_size -= len(self.protected.pop(key)[0])
+
+    def _promote(self, key):
+        entry = self.probation.pop(key)
+        self.probation_size -= len(entry[0])
+        self.protected[key] = entry
+        self.protected_size += len(entry[0])
+
+        # demote the coldest protected objects back to probation when the segment overflows
+        while self.protected_size > self.protected_capacity and len(self.protected) > 1:
+            demoted_key, demoted = self.protected.popitem(last=False)
+            self.protected_size -= len(demoted[0])
+            self.probation[demoted_key] = demoted
+            self.probation_size += len(demoted[0])
+
+    def _evict(self):
+        while self.probation_size + self.protected_size > self.capacity:
+            segment = self.probation if self.probation else self.protected
+            _, (value, *_) = segment.popitem(last=False)
+            if segment is self.probation:
+                self.probation_size -= len(value)
+            else:
+                self.protected_size -= len(value)
+            self.evictions += 1
+
+
+class FetchAborted(Exception):
+    """
+    Raised to the waiters of a fetch whose leader stopped before the file was cached.
+    """
+
+
+class Flight:
+    def __init__(self):
+        """
+        An in-flight origin fetch that other requests for the same key can wait on.
+        """
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    def wait(self):
+        """
+        Blocks until the fetch completes.
+
+        :return: The result of the fetch. Re-raises the error if the fetch failed.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Collapses concurrent fetches of the same key into a single call. The first caller
+        for a key becomes the leader and runs the fetch, later callers wait for its result.
+        """
+        self.flights = {}
+        self.lock = Lock()
+
+    def begin(self, key):
+        """
+        Joins the in-flight fetch for a key, or starts a new one if none is running.
+
+        :param key: The key being fetched
+        :return: A tuple of the Flight and whether the caller is its leader.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                return flight, False
+
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def attach(self, key, result):
+        """
+        Sets the result handed to the waiters of the in-flight fetch of a key, before it finishes.
+
+        :param key: The key being fetched
+        :param result: The result handed to the waiters
+        :return: True if a fetch of the key is in flight.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                return False
+            flight.result = result
+            return True
+
+    def finish(self, key, flight, result=None, error=None):
+        """
+        Completes a fetch started with begin and wakes up every waiter.
+
+        :param key: The key that was fetched
+        :param flight: The Flight returned by begin
+        :param result: The result handed to the waiters, instead of the one attached
+        :param error: The exception raised to the waiters if the fetch failed
+        """
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+        if result is not None:
+            flight.result = result
+        flight.error = error
+        flight.done.set()
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        """
+        The asyncio counterpart of SingleFlight used by the async proxy mode, where a flight is a
+        future that the requests waiting on the fetch await.
+        """
+        self.flights = {}
+        self.results = {}
+
+    def begin(self, key):
+        """
+        Joins the in-flight fetch for a key, or starts a new one if none is running.
+
+        :param key: The key being fetched
+        :return: A tuple of the future of the fetch and whether the caller is its leader.
+        """
+        future = self.flights.get(key)
+        if future is not None:
+            return future, False
+
+        future = self.flights[key] = asyncio.get_running_loop().create_future()
+        return future, True
+
+    def attach(self, key, result):
+        """
+        Sets the result of the in-flight fetch of a key, before it finishes. Downloads commit on
+        worker threads too, so this does not touch the future.
+
+        :param key: The key being fetched
+        :param result: The result the future is resolved with
+        :return: True if a fetch of the key is in flight.
+        """
+        future = self.flights.get(key)
+        if future is None:
+            return False
+        self.results[future] = result
+        return True
+
+    def finish(self, key, future, error=None):
+        """
+        Completes a fetch started with begin and wakes up every waiter.
+
+        :param key: The key that was fetched
+        :param future: The future returned by begin
+        :param error: The exception raised to the waiters if the fetch failed
+        """
+        if self.flights.get(key) is future:
+            del self.flights[key]
+
+        result = self.results.pop(future, None)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+            future.exception()  # mark the error as retrieved in case nobody waited on it
+
+
+class LoadTracker:
+    def __init__(self, window=1000):
+        """
+        Tracks the load of the proxy that is reported to the load balancer on heartbeats: the number
+        of requests being served, how many of them are queued behind another request's origin fetch,
+        and the 99th percentile duration of the last window requests.
+
+        :param window: The number of recent request durations kept for the percentile
+        """
+        self.in_flight = 0
+        self.queued_requests = 0
+        self.durations = deque(maxlen=window)
+        self.lock = Lock()
+
+    def start(self):
+        """
+        Records the start of a request.
+
+        :return: The start time to pass to finish.
+        """
+        with self.lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, start):
+        """
+        Records the end of a request.
+
+        :param start: The start time returned by start
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.durations.append(time.monotonic() - start)
+
+    @contextmanager
+    def queued(self):
+        """
+        Counts the request as queued for the duration of the block.
+        """
+        with self.lock:
+            self.queued_requests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.queued_requests -= 1
+
+    def stats(self):
+        with self.lock:
+            durations = sorted(self.durations)
+            return {
+                'in_flight': self.in_flight,
+                'queue_depth': self.queued_requests,
+                'p99': durations[int(0.99 * (len(durations) - 1))] if durations else 0,
+            }
+
+
+class LatencyWindow:
+    def __init__(self, window=1000):
+        """
+        Keeps the time origin fetches took to deliver their first chunk, to pick how long a fetch may
+        take before it is hedged.
+
+        :param window: The number of recent fetches kept
+        """
+        self.durations = deque(maxlen=window)
+        self.lock = Lock()
+
+    def record(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def hedge_delay(self):
+        """
+        :return: The HEDGE_PERCENTILE of the recent first chunk latencies, or HEDGE_DELAY until enough
+        fetches were timed
+        """
+        with self.lock:
+            durations = sorted(self.durations)
+        if len(durations) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY
+        return max(HEDGE_MIN_DELAY, durations[int(HEDGE_PERCENTILE / 100 * (len(durations) - 1))])
+
+
+class ChannelPool:
+    def __init__(self, connect):
+        """
+        Keeps one long-lived channel per origin server address. gRPC multiplexes concurrent calls over
+        a channel, and keepalive pings detect a dead server while the channel is idle.
+
+        :param connect: The function that opens a channel, grpc.insecure_channel or grpc.aio.insecure_channel
+        """
+        self.connect = connect
+        self.channels = {}
+        self.lock = Lock()
+
+    def get(self, address):
+        """
+        :param address: The address of the server
+        :return: The channel to the server, opened on first use
+        """
+        with self.lock:
+            if address not in self.channels:
+                self.channels[address] = self.connect(address, options=CHANNEL_OPTIONS)
+            return self.channels[address]
+
+
+channels = ChannelPool(grpc.insecure_channel)
+# grpc.aio channels belong to the event loop they are opened in, so they are only opened by the async proxy
+async_channels = ChannelPool(grpc.aio.insecure_channel)
+
+
+class FileClient:
+    def __init__(self, address, file_store):
+        """
+        Initializes the file store interface, creates a gRPC channel to the origin server and server stub
+        
+        :param address: The address of the origin server
+        :param file_store: The path to the directory where the files will be stored
+        """
+        self.stub = ops_pb2_grpc.FileServerStub(channels.get(address))
+        self.storage = file_store
+
+    def upload(self, in_file_name):
+        """
+        It takes a file name, splits it into chunks, and sends those chunks to the server
+        
+        :param in_file_name: The name of the file to be uploaded
+        """
+        chunks_generator = self.storage.get_file_chunks(in_file_name)
+        response = self.stub.put(chunks_generator)
+
+        assert response.length == os.path.getsize(in_file_name)
+
+
+    def download(self, target_name):
+        """
+        It sends a request to the server to download a file, and then saves the chunks of data it receives
+        to a file
+        
+        :param target_name: The name of the file you want to download
+        """
+        response = self.stub.get(ops_pb2.Request(name=target_name, chunk_size=ORIGIN_CHUNK_SIZE))
+        self.storage.save_chunks_to_file(response, target_name)
+
+    def stream(self, target_name):
+        """
+        It sends a request to the server to download a file, and yields the data of each chunk as it
+        arrives while saving the chunks to the cache
+
+        :param target_name: The name of the file you want to download
+        :return: A generator of the chunk data.
+        """
+        return self.start_stream(target_name)[1]
+
+    def start_stream(self, target_name):
+        """
+        Like stream, but also returns the call so another thread can cancel it
+
+        :param target_name: The name of the file you want to download
+        :return: A tuple of the call and the generator of the chunk data.
+        """
+        call = self.stub.get(ops_pb2.Request(name=target_name, chunk_size=ORIGIN_CHUNK_SIZE))
+        return call, self.storage.tee_chunks_to_file(call, target_name)
+
+    def stat(self, target_name, timeout=None):
+        """
+        It asks the server for the size, modification time and content hash of a file
+
+        :param target_name: The name of the file
+        :param timeout: The deadline of the call in seconds, None for no deadline
+        :return: A Stat message.
+        """
+        return self.stub.stat(ops_pb2.Request(name=target_name), timeout=timeout)
+
+    def stream_range(self, target_name, offset, length, chunk_size=CHUNK_SIZE, timeout=None):
+        """
+        It sends a request to the server for a byte range of a file, and returns the chunks as they arrive
+
+        :param target_name: The name of the file you want to download
+        :param offset: The position of the first byte of the range
+        :param length: The number of bytes in the range
+        :param chunk_size: The maximum size of the chunks, CHUNK_SIZE for ranges kept in the ChunkStore
+        :param timeout: The deadline of the call in seconds, None for no deadline
+        :return: The call, an iterator of Chunk messages carrying their offset and the size of the file.
+        """
+        request = ops_pb2.Request(name=target_name, offset=offset, length=length, chunk_size=chunk_size)
+        return self.stub.get_range(request, timeout=timeout)
+
+    def striped_stream(self, target_name, stat, peers):
+        """
+        Downloads a file in byte ranges of STRIPE_SIZE fetched from this server and its peers at once,
+        and yields its data in order as it arrives, so the first stripe is streamed while the others
+        download. The stripes are dealt out to a queue per server, and a server that runs out of stripes
+        steals from the back of the longest other queue. Each range is fetched with a deadline of
+        STRIPE_TIMEOUT seconds, and a server that fails or stalls drops out while its stripe is fetched
+        by the others from where it stopped. The ranges are written at their offsets into a temp file,
+        which is moved into the cache once every byte was yielded and its hash matches the stat.
+
+        :param target_name: The name of the file you want to download
+        :param stat: The Stat of the file at this server
+        :param peers: The FileClients of the other servers holding a replica of the file
+        :return: A generator of Chunk messages.
+        """
+        sources = [self] + peers
+        stripes = [(offset, min(STRIPE_SIZE, stat.size - offset)) for offset in range(0, stat.size, STRIPE_SIZE)]
+        # the number of bytes of each stripe written from its start on
+        progress = [0] * len(stripes)
+        queues = [deque() for _ in sources]
+        for index in range(len(stripes)):
+            queues[index % len(sources)].append(index)
+        retries = deque()
+        calls = {}
+        ready = Condition()
+        remaining = len(stripes)
+        working = len(sources)
+        stopped = False
+        error = RuntimeError(f"Every origin server failed to serve a stripe of {target_name}")
+
+        def take(source):
+            if retries:
+                return retries.popleft()
+            if queues[source]:
+                return queues[source].popleft()
+            longest = max(queues, key=len)
+            return longest.pop() if longest else None
+
+        def fetch(source, index):
+            offset, length = stripes[index]
+            call = sources[source].stream_range(target_name, offset + progress[index], length - progress[index],
+                                                ORIGIN_CHUNK_SIZE, timeout=STRIPE_TIMEOUT)
+            with ready:
+                if stopped:
+                    call.cancel()
+                    return
+                calls[source] = call
+
+            for chunk in call:
+                if chunk.size != stat.size:
+                    raise RuntimeError(f"File {target_name} changed size during the download")
+                os.pwrite(f.fileno(), chunk.buffer, chunk.offset)
+                with ready:
+                    progress[index] = chunk.offset + len(chunk.buffer) - offset
+                    ready.notify_all()
+            if progress[index] != length:
+                raise RuntimeError(f"Got {progress[index]} of the {length} bytes at offset {offset} of {target_name}")
+
+        def work(source):
+            nonlocal remaining, working, error
+            try:
+                while True:
+                    with ready:
+                        index = take(source)
+                        # wait for the stripes in progress, which are handed back if their server fails
+                        while index is None and remaining and not stopped:
+                            ready.wait()
+                            index = take(source)
+                        if index is None or stopped:
+                            return
+
+                    try:
+                        fetch(source, index)
+                    except Exception as e:
+                        with ready:
+                            if not stopped:
+                                logging.warning(f"A source failed to serve a stripe of {target_name}, "
+                                                f"fetching it from the others. {str(e)}")
+                            error = e
+                            # hand the stripe and the queue of the server to the others, in file order
+                            handed_back = sorted([*retries, index, *queues[source]])
+                            retries.clear()
+                            retries.extend(handed_back)
+                            queues[source].clear()
+                        return
+
+                    with ready:
+                        remaining -= 1
+            finally:
+                with ready:
+                    working -= 1
+                    ready.notify_all()
+
+        f = self.storage.open_temp(target_name)
+        pool = futures.ThreadPoolExecutor(max_workers=len(sources))
+        digest = hashlib.sha256()
+        try:
+            with f:
+                f.truncate(stat.size)
+                for source in range(len(sources)):
+                    pool.submit(work, source)
+
+                position = 0
+                while position < stat.size:
+                    index = position // STRIPE_SIZE
+                    offset = stripes[index][0]
+                    with ready:
+                        ready.wait_for(lambda: offset + progress[index] > position or not working)
+                        end = offset + progress[index]
+                    if end <= position:
+                        raise error
+
+                    piece = os.pread(f.fileno(), min(end - position, CHUNK_SIZE), position)
+                    digest.update(piece)
+                    position += len(piece)
+                    yield ops_pb2.Chunk(buffer=piece, mtime=stat.mtime)
+
+            if stat.hash and digest.hexdigest() != stat.hash:
+                raise RuntimeError(f"File {target_name} does not match its hash after the download")
+        except BaseException:
+            # also runs when the client disconnects and the generator is closed
+            with ready:
+                stopped = True
+                ready.notify_all()
+                pending = list(calls.values())
+            for call in pending:
+                call.cancel()
+            pool.shutdown(wait=True)
+            os.unlink(f.name)
+            raise
+
+        pool.shutdown(wait=True)
+        self.storage.commit(f.name, target_name, stat.size, digest.hexdigest(), stat.mtime)
+
+class AsyncFileClient:
+    def __init__(self, address, file_store):
+        """
+        The grpc.aio counterpart of FileClient used by the async proxy mode. It must be created
+        inside the running event loop.
+
+        :param address: The address of the origin server
+        :param file_store: The file store the downloads are cached in
+        """
+        self.stub = ops_pb2_grpc.FileServerStub(async_channels.get(address))
+        self.storage = file_store
+
+    async def stat(self, target_name):
+        """
+        It asks the server for the size, modification time and content hash of a file
+
+        :param target_name: The name of the file
+        :return: A Stat message.
+        """
+        return await self.stub.stat(ops_pb2.Request(name=target_name))
+
+    async def stream(self, target_name):
+        """
+        It sends a request to the server to download a file, and yields each chunk as it arrives
+        while writing it to a temp file that is moved into the cache once the download completes.
+        Writes are offloaded to a thread so they do not block the event loop.
+
+        :param target_name: The name of the file you want to download
+        :return: An async generator of the chunks.
+        """
+        call = self.stub.get(ops_pb2.Request(name=target_name, chunk_size=ORIGIN_CHUNK_SIZE))
+        f = self.storage.open_temp(target_name)
+        digest = hashlib.sha256()
+        mtime = None
+        size = 0
+
+        try:
+            with f:
+                async for chunk in call:
+                    await asyncio.to_thread(f.write, chunk.buffer)
+                    digest.update(chunk.buffer)
+                    mtime = mtime or chunk.mtime
+                    size += len(chunk.buffer)
+                    yield chunk
+        except BaseException:
+            os.unlink(f.name)
+            call.cancel()
+            raise
+
+        self.storage.commit(f.name, target_name, size, digest.hexdigest(), mtime)
+
+    async def download(self, target_name):
+        """
+        It downloads a file into the cache
+
+        :param target_name: The name of the file you want to download
+        """
+        async for _ in self.stream(target_name):
+            pass
+
+liveliness = {f'origin_backup{i+1}:{ORIGIN_BACKUPS[i]}': False for i in range(len(ORIGIN_BACKUPS))}
+liveliness.update({f'origin:{ORIGIN_PORT}': False})
+
+def set_liveliness(liveliness, addr, alive):
+    if liveliness[addr] != alive:
+        logging.warning(f"Origin server {addr} is now {'alive' if alive else 'dead'}")
+    liveliness[addr] = alive
+
+
+def watch_liveliness(addr, liveliness):
+    """
+    Follows the health of an origin server through its watch stream, which pushes every change of
+    its state, and marks it dead as soon as the stream breaks. Servers that do not accept another
+    watch are polled with a heartbeat every HEALTH_CHECK_INTERVAL seconds instead.
+
+    :param addr: The address of the origin server
+    :param liveliness: The liveliness dictionary to update
+    """
+    stub = ops_pb2_grpc.FileServerStub(channels.get(addr))
+    while True:
+        try:
+            for res in stub.watch(ops_pb2.HeartbeatRequest(message="hello")):
+                set_liveliness(liveliness, addr, res.message == 'acknowledged')
+            # the server closed the stream, it is shutting down
+            set_liveliness(liveliness, addr, False)
+        except grpc.RpcError as e:
+            if e.code() not in (grpc.StatusCode.UNIMPLEMENTED, grpc.StatusCode.RESOURCE_EXHAUSTED):
+                set_liveliness(liveliness, addr, False)
+            else:
+                try:
+                    res = stub.heartbeat(ops_pb2.HeartbeatRequest(message="hello"), timeout=HEALTH_CHECK_TIMEOUT)
+                    set_liveliness(liveliness, addr, res.message == 'acknowledged')
+                except grpc.RpcError:
+                    set_liveliness(liveliness, addr, False)
+
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def check_liveliness(liveliness):
+    """
+    Watches the health of every origin server on its own thread
+    """
+    watchers = [Thread(target=watch_liveliness, args=(addr, liveliness), daemon=True) for addr in liveliness]
+    for watcher in watchers:
+        watcher.start()
+    for watcher in watchers:
+        watcher.join()
+
+
+def register_with_load_balancer():
+    """
+    Registers this proxy with the load balancer, retrying until the load balancer is reachable. A
+    rejected registration is not retried, since the same request would be rejected again
+    """
+    body = json.dumps({'address': PROXY_ADDRESS, 'public_address': PUBLIC_ADDRESS,
+                       'area': AREA, 'weight': PROXY_WEIGHT}).encode()
+    headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {ADMIN_TOKEN}'}
+    while True:
+        try:
+            req = urllib.request.Request(LOAD_BALANCER.rstrip('/') + '/admin/proxies', data=body,
+                                         headers=headers, method='POST')
+            with urllib.request.urlopen(req, timeout=5) as res:
+                logging.info(f'Registered with the load balancer: {res.read().decode()}')
+                return
+        except OSError as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                logging.error(f'The load balancer rejected the registration. {str(e)}')
+                return
+            logging.warning(f'Could not register with the load balancer, retrying. {str(e)}')
+            time.sleep(5)
+
+    
+def share_uncached_copy(key, f):
+    """
+    Hands a download the eviction policy did not admit to the requests waiting on the fetch of it, so
+    they are served from it instead of each fetching the file again.
+
+    :param key: The key of the file
+    :param f: The downloaded file, open and already unlinked
+    """
+    if not (origin_fetches.attach(key, f) or async_fetches.attach(key, f)):
+        f.close()
+
+
+app = Flask(__name__)
+memory_cache = MemoryCache()
+file_store = FileStore(on_remove=memory_cache.invalidate, on_reject=share_uncached_copy,
+                       meta_location=CACHE_META_DIR)
+chunk_store = file_store.chunks
+load = LoadTracker()
+origin_fetches = SingleFlight()
+chunk_fetches = SingleFlight()
+first_chunk_latency = LatencyWindow()
+hedge_pool = futures.ThreadPoolExecutor(max_workers=32)
+# hostnames must be docker service names since the origin servers are in the same network
+clients = {addr: FileClient(addr, file_store) for addr in liveliness}
+client = clients[f'origin:{ORIGIN_PORT}']
+
+
+def origin_addresses():
+    """
+    Orders the live origin servers to fetch from, the primary origin first and then the live
+    backups in random order.
+
+    :return: The addresses of the live origin servers.
+    """
+    primary = f'origin:{ORIGIN_PORT}'
+    if not liveliness[primary]:
+        logging.warning(f"Primary Origin on port {ORIGIN_PORT} is dead")
+
+    backups = [backup for backup in liveliness.keys() if backup != primary and liveliness[backup]]
+    random.shuffle(backups)
+    return ([primary] if liveliness[primary] else []) + backups
+
+
+def origin_source():
+    """
+    Picks the server to fetch from, the primary origin or a random live backup if the primary
+    origin is dead.
+
+    :return: A FileClient for the chosen server, or None if every origin server is dead.
+    """
+    addresses = origin_addresses()
+    return clients[addresses[0]] if addresses else None
+
+
+def open_origin_stream(address, path, calls):
+    """
+    Starts streaming a file from an origin server and waits for its first chunk.
+
+    :param address: The address of the origin server
+    :param path: The path of the file to be downloaded
+    :param calls: The calls of the fetch by address, where the call is registered so it can be cancelled
+    :return: A tuple of the generator of the chunks, the first chunk, and the seconds it took to arrive.
+    """
+    start = time.monotonic()
+    call, chunks = clients[address].start_stream(path)
+    calls[address] = call
+    first = next(chunks, None)
+    return chunks, first, time.monotonic() - start
+
+
+def discard_origin_stream(future, call):
+    """
+    Cancels an origin stream that lost a hedged fetch, and closes its chunks once its worker returns,
+    which discards its temp file.
+
+    :param future: The future of open_origin_stream
+    :param call: The call of the stream, or None if it was not started yet
+    """
+    if call is not None:
+        call.cancel()
+
+    def close(done):
+        if done.exception() is None:
+            done.result()[0].close()
+
+    future.add_done_callback(close)
+
+
+def hedged_origin_stream(path):
+    """
+    Streams a file from the first live origin server. If its first chunk has not arrived within the
+    HEDGE_PERCENTILE of recent first chunk latencies, the same get is sent to the next live server,
+    up to HEDGE_MAX times. The first server to deliver wins and the others are cancelled. A server
+    that fails is replaced by the next live one.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks and the first chunk.
+    """
+    remaining = origin_addresses()
+    pending = {}
+    calls = {}
+    hedges = 0
+    error = RuntimeError(f"No live origin server to fetch {path} from")
+
+    def launch():
+        address = remaining.pop(0)
+        pending[hedge_pool.submit(open_origin_stream, address, path, calls)] = address
+
+    if remaining:
+        launch()
+    while pending:
+        delay = first_chunk_latency.hedge_delay() if remaining and hedges < HEDGE_MAX else None
+        done, _ = futures.wait(pending, timeout=delay, return_when=futures.FIRST_COMPLETED)
+        if not done:
+            logging.info(f"Origin server {next(iter(pending.values()))} is slow to serve {path}, hedging to {remaining[0]}")
+            hedges += 1
+            launch()
+            continue
+
+        winner = None
+        for future in done:
+            address = pending.pop(future)
+            if future.exception() is not None:
+                logging.warning(f"Origin server {address} failed to serve {path}. {str(future.exception())}")
+                error = future.exception()
+            elif winner is None:
+                winner = future
+            else:
+                discard_origin_stream(future, calls.get(address))
+
+        if winner is not None:
+            for future, address in pending.items():
+                discard_origin_stream(future, calls.get(address))
+            chunks, first, latency = winner.result()
+            first_chunk_latency.record(latency)
+            return chunks, first
+
+        # fail over to the next live server
+        if remaining and not pending:
+            launch()
+
+    raise error
+
+
+def striped_origin_stream(path):
+    """
+    Starts a striped download of a file of at least STRIPE_THRESHOLD bytes from every live origin
+    server at once and waits for its first chunk. Striping only pays off for large files when more
+    than one server is live, so it is skipped otherwise, and it is off unless STRIPE_THRESHOLD is set.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks and the first chunk, or None if the file should be
+    streamed from a single server instead.
+    """
+    addresses = origin_addresses()
+    if not STRIPE_THRESHOLD or len(addresses) < 2:
+        return None
+
+    try:
+        stat = clients[addresses[0]].stat(path, timeout=STRIPE_TIMEOUT)
+        if stat.size < STRIPE_THRESHOLD:
+            return None
+        chunks = clients[addresses[0]].striped_stream(path, stat, [clients[address] for address in addresses[1:]])
+        first = next(chunks)
+    except Exception as e:
+        logging.warning(f"Striped download of file {path} failed, streaming it instead. {str(e)}")
+        return None
+
+    logging.info(f"Downloading file {path} from {len(addresses)} origin servers at once")
+    return chunks, first
+
+
+def peer_chunks(response, mtime):
+    """
+    Reads the body of a response from a peer proxy in chunks of size CHUNK_SIZE.
+
+    :param response: The open response of the peer
+    :param mtime: The modification time of the file at the origin as a timestamp
+    :return: A generator of Chunk messages.
+    """
+    with response:
+        for piece in iter(lambda: response.read(CHUNK_SIZE), b''):
+            yield ops_pb2.Chunk(buffer=piece, mtime=mtime)
+
+
+def open_peer_stream(peer, path, only_if_cached=False):
+    """
+    Starts streaming a file from another proxy into the cache and waits for its first chunk. The
+    request carries a Via header, so the peer fetches the file from the origin itself instead of
+    asking its own peers. A sibling asked for a cached copy gets PEER_TIMEOUT seconds to answer, the
+    shield gets SHIELD_TIMEOUT seconds since it may have to fetch the file from the origin first.
+
+    :param peer: The URL of the proxy
+    :param path: The path of the file to be downloaded
+    :param only_if_cached: If True, the peer only serves the file if it has a fresh copy cached
+    :return: A tuple of the generator of the chunks and the first chunk, or None if the peer did
+    not serve the file.
+    """
+    headers = {'Via': f'1.1 {PROXY_ADDRESS or AREA}'}
+    if only_if_cached:
+        headers['Cache-Control'] = 'only-if-cached'
+    url = f"{peer.rstrip('/')}/{urllib.parse.quote(path)}?area={AREA}"
+
+    try:
+        timeout = PEER_TIMEOUT if only_if_cached else SHIELD_TIMEOUT
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+        last_modified = parse_date(response.headers.get('Last-Modified'))
+        mtime = last_modified.timestamp() if last_modified else 0
+        chunks = file_store.tee_chunks_to_file(peer_chunks(response, mtime), path)
+        return chunks, next(chunks, None)
+    except urllib.error.HTTPError as e:
+        # a 504 is how a peer says it does not have the file cached
+        if e.code != 504 or not only_if_cached:
+            logging.warning(f"Proxy {peer} failed to serve {path}. {e.code} {e.reason}")
+    except Exception as e:
+        logging.warning(f"Proxy {peer} failed to serve {path}. {str(e)}")
+    return None
+
+
+def close_peer_stream(future):
+    """
+    Closes a peer stream that is not used once it is open, which discards its temp file.
+
+    :param future: The future of open_peer_stream
+    """
+    stream = future.result()
+    if stream is not None:
+        stream[0].close()
+
+
+def sibling_stream(path):
+    """
+    Asks every sibling proxy of the area for a cached copy of a file at once, and waits at most
+    PEER_TIMEOUT seconds in total for the first one to start serving it.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks and the first chunk, or None if no sibling
+    served the file in time.
+    """
+    pending = {hedge_pool.submit(open_peer_stream, sibling, path, True): sibling for sibling in SIBLINGS}
+    deadline = time.monotonic() + PEER_TIMEOUT
+    try:
+        while pending:
+            done, _ = futures.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                   return_when=futures.FIRST_COMPLETED)
+            if not done:
+                return None
+            for future in done:
+                sibling = pending.pop(future)
+                if future.result() is not None:
+                    logging.info(f"Fetching file {path} from sibling proxy {sibling}")
+                    return future.result()
+        return None
+    finally:
+        # the siblings that answered too late or after the winner are closed once they do
+        for future in pending:
+            future.add_done_callback(close_peer_stream)
+
+
+def peer_stream(path):
+    """
+    Asks the sibling proxies of the area for a file they have cached, and otherwise fetches it
+    through the shield proxy of the area if one is configured.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks and the first chunk, or None if the file
+    should be fetched from the origin.
+    """
+    if SIBLINGS:
+        stream = sibling_stream(path)
+        if stream is not None:
+            return stream
+
+    if SHIELD:
+        stream = open_peer_stream(SHIELD, path)
+        if stream is not None:
+            logging.info(f"Fetching file {path} through shield proxy {SHIELD}")
+            return stream
+
+    return None
+
+
+def stream_from_peers(path, flight):
+    """
+    Streams a file from a sibling or shield proxy to the client while filling the cache.
+
+    :param path: The path of the file to be downloaded
+    :param flight: The Flight this request is the leader of
+    :return: A streaming response of the file data, or None if no peer served the file and it
+    should be fetched from the origin.
+    """
+    stream = peer_stream(path)
+    if stream is None:
+        return None
+    return stream_to_client(path, flight, *stream)
+
+
+def stream_from_origin(path, flight):
+    """
+    Streams a file from the origin to the client while filling the cache. The first chunk is
+    fetched up front with a hedged fetch, so a slow or failing server is skipped for the next
+    live one before the response is started.
+
+    :param path: The path of the file to be downloaded
+    :param flight: The Flight this request is the leader of
+    :return: A streaming response of the file data.
+    """
+    try:
+        chunks, first = hedged_origin_stream(path)
+    except Exception as e:
+        origin_fetches.finish(path, flight, error=e)
+        raise
+
+    return stream_to_client(path, flight, chunks, first)
+
+
+def stream_to_client(path, flight, chunks, first):
+    """
+    Streams the chunks of a fetch to the client. The flight is finished once the stream ends,
+    waking up the requests that waited on it.
+
+    :param path: The path of the file being downloaded
+    :param flight: The Flight this request is the leader of
+    :param chunks: The generator of the chunks after the first, which fills the cache
+    :param first: The first chunk, or None if the file is empty
+    :return: A streaming response of the file data.
+    """
+    completed = False
+    sent = 0
+
+    def generate():
+        nonlocal completed, sent
+        if first is not None:
+            sent += len(first.buffer)
+            yield first.buffer
+        for chunk in chunks:
+            sent += len(chunk.buffer)
+            yield chunk.buffer
+        completed = True
+
+    def finalize():
+        # runs when the response is closed, including when the client disconnects mid-stream
+        chunks.close()
+        file_store.record_miss(sent)
+        if flight.waiters:
+            logging.info(f"Collapsed {flight.waiters} concurrent requests for {path} into one origin fetch")
+        if completed:
+            chunk_store.invalidate(path)
+        origin_fetches.finish(path, flight, error=None if completed else FetchAborted(path))
+
+    response = Response(generate(), mimetype=mimetypes.guess_type(path)[0])
+    if first is not None and first.mtime:
+        response.last_modified = first.mtime
+    response.call_on_close(finalize)
+    return response
+
+
+def serve_from_cache(path, expiry):
+    """
+    Serves a fresh file from the disk cache. Small files are read into the memory cache, larger
+    ones are sent straight from the file descriptor, zero-copy through sendfile when the WSGI
+    server provides a file wrapper and in fixed size chunks otherwise, so they never sit in memory.
+
+    :param path: The path of the file to be served
+    :param expiry: The expiry of the cached file
+    :return: The response serving the file, or None if the file was evicted before it was opened.
+    """
+    file_path = file_store.get_path(path)
+    etag, last_modified = file_store.get_validators(path)
+    # an eviction can unlink the file at any point until it is open, the open descriptor keeps it readable
+    try:
+        size = os.path.getsize(file_path)
+        if size <= MEMORY_CACHE_MAX_OBJECT:
+            with open(file_path, 'rb') as f:
+                file = f.read()
+        else:
+            response = send_file(file_path, conditional=True, etag=etag or False, last_modified=last_modified)
+    except FileNotFoundError:
+        logging.info(f"Cached file {path} was evicted before it could be served")
+        return None
+
+    file_store.record_access(path)
+    file_store.record_hit(size)
+
+    if size <= MEMORY_CACHE_MAX_OBJECT:
+        memory_cache.put(path, file, expiry, etag, last_modified)
+        return memory_response(path, file, etag, last_modified)
+
+    return response
+
+
+def uncached_chunks(f):
+    """
+    Reads a download that was not admitted into the cache in chunks of size CHUNK_SIZE. Every request
+    waiting on the download shares the file, so it is read at explicit offsets.
+
+    :param f: The open, unlinked file
+    :return: A generator of the chunks of the file.
+    """
+    size = os.fstat(f.fileno()).st_size
+    for offset in range(0, size, CHUNK_SIZE):
+        yield os.pread(f.fileno(), CHUNK_SIZE, offset)
+
+
+def serve_uncached(path, f):
+    """
+    Serves a download the eviction policy did not admit into the cache to a request that waited on it.
+
+    :param path: The path of the file to be served
+    :param f: The open, unlinked file handed to the waiters by share_uncached_copy
+    :return: The response streaming the file.
+    """
+    response = Response(uncached_chunks(f), mimetype=mimetypes.guess_type(path)[0])
+    response.headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    return response
+
+
+def aligned_chunks(chunks):
+    """
+    Regroups the chunks of a ranged get starting at a multiple of CHUNK_SIZE into chunks of CHUNK_SIZE,
+    the granularity of the ChunkStore. The origin also splits its chunks where the chunks the file was
+    uploaded in end, which need not line up with CHUNK_SIZE.
+
+    :param chunks: The chunks of the ranged get
+    :return: A generator of Chunk messages of CHUNK_SIZE bytes, except for the last one.
+    """
+    buffer = bytearray()
+    offset = size = mtime = None
+
+    for chunk in chunks:
+        if offset is None:
+            offset = chunk.offset
+        size, mtime = chunk.size, chunk.mtime
+        if not buffer and len(chunk.buffer) == CHUNK_SIZE:
+            yield chunk
+            offset += CHUNK_SIZE
+            continue
+
+        buffer += chunk.buffer
+        while len(buffer) >= CHUNK_SIZE:
+            yield ops_pb2.Chunk(buffer=bytes(buffer[:CHUNK_SIZE]), offset=offset, size=size, mtime=mtime)
+            del buffer[:CHUNK_SIZE]
+            offset += CHUNK_SIZE
+
+    if buffer:
+        yield ops_pb2.Chunk(buffer=bytes(buffer), offset=offset, size=size, mtime=mtime)
+
+
+def serve_range(path, byte_range):
+    """
+    Serves a single byte range of a file that is not fully cached from the chunk store, fetching
+    only the missing chunks the range covers with ranged gets. Once every chunk of the file has
+    been fetched it is assembled into the file cache.
+
+    Concurrent requests for the same chunk are collapsed into one fetch through chunk_fetches, keyed
+    by the path and the index of the chunk.
+
+    :param path: The path of the file to be served
+    :param byte_range: The parsed Range header of the request
+    :return: A 206 or 416 response, or None if the range cannot be served from chunks and the
+    whole file should be served instead.
+    """
+    size = chunk_store.get_size(path)
+    start = byte_range.ranges[0][0]
+
+    if size is None:
+        # The size of the file is unknown until the first chunk arrives, which is not possible
+        # to pick for a suffix range
+        if start < 0:
+            return None
+
+        index = start // CHUNK_SIZE
+        flight, leader = chunk_fetches.begin((path, index))
+        if not leader:
+            try:
+                flight.wait()
+            except FetchAborted:
+                pass
+            size = chunk_store.get_size(path)
+            if size is None:
+                return None
+        else:
+            try:
+                source = origin_source()
+                if source is None:
+                    return None
+
+                for chunk in aligned_chunks(source.stream_range(path, index * CHUNK_SIZE, CHUNK_SIZE)):
+                    if size is None:
+                        size = chunk.size
+                        chunk_store.set_size(path, size)
+                    chunk_store.save_chunk(path, chunk.offset // CHUNK_SIZE, chunk.buffer)
+            finally:
+                chunk_fetches.finish((path, index), flight, error=None if size is not None else FetchAborted(path))
+
+            if size is None:
+                return None
+
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    start, stop = bounds
+    first, last = start // CHUNK_SIZE, (stop - 1) // CHUNK_SIZE
+
+    def piece(index, data):
+        offset = index * CHUNK_SIZE
+        return data[max(start - offset, 0):stop - offset]
+
+    def generate():
+        index = first
+        while index <= last:
+            data = chunk_store.get_chunk(path, index)
+            if data is not None:
+                yield piece(index, data)
+                index += 1
+                continue
+
+            # a chunk another request is fetching is read from the store once it is saved, or fetched
+            # here if that fetch was aborted
+            flight, leader = chunk_fetches.begin((path, index))
+            if not leader:
+                try:
+                    flight.wait()
+                except FetchAborted:
+                    pass
+                continue
+
+            # fetch the whole run of missing chunks no other request is fetching with a single ranged get
+            flights = {index: flight}
+            run_end = index
+            while run_end < last and not chunk_store.has_chunk(path, run_end + 1):
+                flight, leader = chunk_fetches.begin((path, run_end + 1))
+                if not leader:
+                    break
+                run_end += 1
+                flights[run_end] = flight
+
+            try:
+                source = origin_source()
+                if source is None:
+                    raise RuntimeError(f"No live origin server to fetch {path} from")
+
+                run = source.stream_range(path, index * CHUNK_SIZE, (run_end - index + 1) * CHUNK_SIZE)
+                for chunk in aligned_chunks(run):
+                    if chunk.size != size:
+                        logging.warning(f"File {path} changed size at the origin, dropping its cached chunks")
+                        chunk_store.invalidate(path)
+                        return
+                    chunk_index = chunk.offset // CHUNK_SIZE
+                    chunk_store.save_chunk(path, chunk_index, chunk.buffer)
+                    if chunk_index in flights:
+                        chunk_fetches.finish((path, chunk_index), flights.pop(chunk_index))
+                    yield piece(chunk_index, chunk.buffer)
+            finally:
+                # the waiters on chunks that never arrived fetch them themselves
+                for chunk_index, flight in flights.items():
+                    chunk_fetches.finish((path, chunk_index), flight, error=FetchAborted(path))
+            index = run_end + 1
+
+        if chunk_store.is_complete(path, size):
+            file_store.save_chunks_to_file(
+                (ops_pb2.Chunk(buffer=chunk_store.get_chunk(path, index)) for index in range(-(-size // CHUNK_SIZE))),
+                path)
+            chunk_store.invalidate(path)
+            logging.info(f"Assembled every chunk of {path} into the cache")
+
+    response = Response(generate(), status=206, mimetype=mimetypes.guess_type(path)[0])
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.content_length = stop - start
+    return response
+
+
+def memory_response(path, file, etag=None, last_modified=None):
+    """
+    Builds the response for file contents held in memory, honoring the Range and conditional
+    headers of the request.
+
+    :param path: The path of the file
+    :param file: The file contents as binary data
+    :param etag: The content hash of the file
+    :param last_modified: The modification time of the file at the origin as a timestamp
+    :return: The response serving the file.
+    """
+    response = Response(file, mimetype=mimetypes.guess_type(path)[0])
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(file))
+
+
+def revalidate(path):
+    """
+    Checks an expired file against the origin with a stat call, and extends its time-to-live
+    if the content hash is unchanged instead of downloading it again.
+
+    :param path: The path of the expired file
+    :return: True if the cached file is still valid, otherwise False.
+    """
+    etag, _ = file_store.get_validators(path)
+    source = origin_source()
+    if etag is None or source is None:
+        return False
+
+    try:
+        stat = source.stat(path)
+    except grpc.RpcError as e:
+        logging.warning(f"Could not revalidate file {path}. {e.details()}")
+        return False
+
+    if stat.hash != etag:
+        return False
+
+    file_store.set_TTL(path)
+    return True
+
+
+def is_valid_key(path):
+    """
+    Checks that a requested path can be used as a cache key. Paths with a segment starting with a dot
+    are rejected, so .. cannot leave the cache directory and the temp files in it cannot be requested.
+
+    :param path: The requested path
+    """
+    return not any(segment.startswith('.') for segment in path.split('/'))
+
+
+def has_fresh_copy(path):
+    """
+    Checks if an unexpired copy of a file is in the disk cache, which every file in the memory
+    cache was read from.
+
+    :param path: The path of the file
+    """
+    expiry = file_store.get_expiry(path)
+    return expiry is not None and expiry >= datetime.now()
+
+
+def is_stale_within(expiry, window):
+    """
+    Checks if an expired file is still inside a window of seconds past its expiry.
+
+    :param expiry: The expiry of the cached file, or None if it is not cached
+    :param window: The number of seconds past the expiry the file may be served
+    """
+    return expiry is not None and datetime.now() - expiry <= timedelta(seconds=window)
+
+
+def serve_stale(path, expiry, warning):
+    """
+    Serves an expired file from the disk cache, marking the response as stale.
+
+    :param path: The path of the file to be served
+    :param expiry: The expiry of the cached file
+    :param warning: The Warning header explaining why the stale file was served
+    :return: The response serving the file, or None if the file was evicted before it was opened.
+    """
+    response = serve_from_cache(path, expiry)
+    if response is not None:
+        response.headers['Warning'] = warning
+    return response
+
+
+def refresh_in_background(path):
+    """
+    Revalidates or downloads an expired file in a background thread. Nothing is started if a
+    fetch of the file is already in flight.
+
+    :param path: The path of the file to be refreshed
+    """
+    flight, leader = origin_fetches.begin(path)
+    if not leader:
+        return
+
+    def refresh():
+        try:
+            if not revalidate(path):
+                source = origin_source()
+                if source is None:
+                    raise RuntimeError(f"No live origin server to fetch {path} from")
+                source.download(path)
+                memory_cache.invalidate(path)
+                chunk_store.invalidate(path)
+            origin_fetches.finish(path, flight)
+        except Exception as e:
+            logging.warning(f"Background refresh of file {path} failed. {str(e)}")
+            origin_fetches.finish(path, flight, error=e)
+
+    Thread(target=refresh, daemon=True).start()
+
+
+UNTRACKED_PATHS = ('/heartbeat', '/stats')
+
+
+@app.before_request
+def start_load_tracking():
+    if request.path not in UNTRACKED_PATHS:
+        g.load_start = load.start()
+
+
+@app.after_request
+def finish_load_tracking(response):
+    # streamed responses are only finished once their body has been sent
+    start = g.pop('load_start', None)
+    if start is not None:
+        response.call_on_close(lambda: load.finish(start))
+    return response
+
+
+@app.teardown_request
+def abort_load_tracking(error):
+    # after_request is skipped when the request failed
+    start = g.pop('load_start', None)
+    if start is not None:
+        load.finish(start)
+
+
+@app.route('/heartbeat')
+def heartbeat():
+    """
+    Responds to heartbeat with 'OK' along with the current load of the proxy.
+    :return: The status and load of the proxy as JSON
+    """
+    return jsonify(status='OK', **load.stats())
+
+@app.route('/stats')
+def stats():
+    """
+    Reports the hit, miss and eviction counters of the in-memory and disk caches.
+    :return: The cache statistics as JSON
+    """
+    return jsonify(memory_cache=memory_cache.stats(), disk_cache=file_store.stats())
+
+@app.route('/<path:path>')
+def serve_GET(path):
+    """
+    Serves the requested file by checking if it is in the cache and returning it, otherwise
+    downloading it from the origin server or a live backup if the primary origin is dead.
+    
+    :param path: The path of the file to be served
+    :return: The file is being returned.
+    """
+    if not is_valid_key(path):
+        return Response(status=404)
+
+    # a peer asking for a cached copy is told right away when there is none
+    if request.cache_control.only_if_cached and not has_fresh_copy(path):
+        return Response(status=504)
+
+    time.sleep(introduce_latency(request.args.get("area")))
+    file_store.record_request(path)
+
+    cached = memory_cache.get(path)
+    if cached is not None:
+        file_store.record_access(path)
+        file_store.record_hit(len(cached[0]))
+        logging.info(f"Served file {path}. Request was a memory cache hit")
+        return memory_response(path, *cached)
+
+    expiry = file_store.get_expiry(path)
+
+    # a cached file evicted before it could be opened is treated as a miss
+    if expiry is not None and expiry >= datetime.now():
+        response = serve_from_cache(path, expiry)
+        if response is not None:
+            logging.info(f"Served file {path}. Request was a cache hit")
+            return response
+        expiry = None
+
+    if request.cache_control.only_if_cached:
+        return Response(status=504)
+
+    if is_stale_within(expiry, STALE_WHILE_REVALIDATE):
+        refresh_in_background(path)
+        response = serve_stale(path, expiry, '110 - "Response is Stale"')
+        if response is not None:
+            logging.info(f"Served stale file {path} while it is refreshed in the background")
+            return response
+        expiry = None
+
+    if is_stale_within(expiry, STALE_IF_ERROR) and not any(liveliness.values()):
+        response = serve_stale(path, expiry, '111 - "Revalidation Failed"')
+        if response is not None:
+            logging.warning(f"Served stale file {path}. Every origin server is dead")
+            return response
+        expiry = None
+
+    if expiry is not None and revalidate(path):
+        response = serve_from_cache(path, file_store.get_expiry(path))
+        if response is not None:
+            logging.info(f"Served file {path}. Expired copy was revalidated with the origin")
+            return response
+        expiry = None
+
+    # an open-ended range from the start asks for the whole file, which is fetched like any other miss
+    byte_range = request.range
+    if (byte_range is not None and byte_range.units == 'bytes' and len(byte_range.ranges) == 1
+            and byte_range.ranges[0] != (0, None)):
+        response = serve_range(path, byte_range)
+        if response is not None:
+            logging.info(f"Served range of file {path} from the chunk cache")
+            return response
+
+    # Only the first request to miss fetches from the origin, the rest wait for it to finish
+    while True:
+        flight, leader = origin_fetches.begin(path)
+        if leader:
+            break
+
+        try:
+            with load.queued():
+                uncached = flight.wait()
+        except FetchAborted:
+            continue
+        except Exception:
+            response = None
+            if is_stale_within(expiry, STALE_IF_ERROR):
+                response = serve_stale(path, expiry, '111 - "Revalidation Failed"')
+            if response is None:
+                raise
+            logging.warning(f"Served stale file {path}. The origin fetch it waited on failed")
+            return response
+
+        # a download the cache did not admit is served from the copy handed to the waiters, a file
+        # evicted since it was fetched is fetched again
+        fetched_expiry = file_store.get_expiry(path)
+        response = serve_from_cache(path, fetched_expiry) if fetched_expiry is not None else None
+        if response is None and uncached is not None:
+            logging.info(f"Served file {path}. Request waited on an origin fetch the cache did not admit")
+            return serve_uncached(path, uncached)
+        if response is None:
+            continue
+
+        logging.info(f"Served file {path}. Request waited on an in-flight origin fetch")
+        return response
+
+    # a request from another proxy is fetched from the origin, so peers never ask each other in a loop
+    if 'Via' not in request.headers:
+        response = stream_from_peers(path, flight)
+        if response is not None:
+            logging.info(f"Served file {path}. Request was a cache miss fetched from a peer proxy")
+            return response
+
+    stream = striped_origin_stream(path)
+    if stream is not None:
+        logging.info(f"Served file {path}. Request was a cache miss")
+        return stream_to_client(path, flight, *stream)
+
+    try:
+        response = stream_from_origin(path, flight)
+    except Exception:
+        response = None
+        if is_stale_within(expiry, STALE_IF_ERROR):
+            response = serve_stale(path, expiry, '111 - "Revalidation Failed"')
+        if response is None:
+            raise
+        logging.warning(f"Served stale file {path}. The origin fetch failed")
+        return response
+
+    logging.info(f"Served file {path}. Request was a cache miss")
+    return response
+
+
+async_fetches = AsyncSingleFlight()
+async_clients = {}
+# keep-alive connections to the sibling and shield proxies, shared by every request of the async mode
+peer_http = httpx.AsyncClient()
+background_tasks = set()
+
+
+def async_origin_source():
+    """
+    Picks the server to fetch from in the async proxy mode, the primary origin or a random live
+    backup if the primary origin is dead. Clients are created on first use, inside the event loop.
+
+    :return: An AsyncFileClient for the chosen server, or None if every origin server is dead.
+    """
+    addresses = origin_addresses()
+    return async_client(addresses[0]) if addresses else None
+
+
+def async_client(address):
+    if address not in async_clients:
+        async_clients[address] = AsyncFileClient(address, file_store)
+    return async_clients[address]
+
+
+def is_not_modified(headers, etag, last_modified):
+    """
+    Evaluates the If-None-Match and If-Modified-Since headers of a request.
+
+    :param headers: The headers of the request
+    :param etag: The content hash of the file
+    :param last_modified: The modification time of the file at the origin as a timestamp
+    :return: True if the client's copy is current and a 304 should be sent.
+    """
+    if 'if-none-match' in headers:
+        return bool(etag) and parse_etags(headers['if-none-match']).contains(etag)
+
+    since = parse_date(headers.get('if-modified-since'))
+    if since is not None and last_modified:
+        return datetime.fromtimestamp(int(last_modified), timezone.utc) <= since
+
+    return False
+
+
+def validator_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+async def async_serve_from_cache(req, path, expiry):
+    """
+    Serves a file from the disk cache in the async proxy mode. Small files are read into the memory
+    cache in a thread, larger ones are streamed from disk.
+
+    :param req: The request being served
+    :param path: The path of the file to be served
+    :param expiry: The expiry of the cached file
+    :return: The response serving the file, or None if the file was evicted before it was opened.
+    """
+    file_path = file_store.get_path(path)
+    etag, last_modified = file_store.get_validators(path)
+    # the file is opened up front, an eviction can unlink it at any point until then
+    try:
+        f = await asyncio.to_thread(open, file_path, 'rb')
+    except FileNotFoundError:
+        logging.info(f"Cached file {path} was evicted before it could be served")
+        return None
+
+    size = os.fstat(f.fileno()).st_size
+    file_store.record_access(path)
+    file_store.record_hit(size)
+    headers = validator_headers(etag, last_modified)
+
+    if is_not_modified(req.headers, etag, last_modified):
+        f.close()
+        return AsyncResponse(status_code=304, headers=headers)
+
+    if size <= MEMORY_CACHE_MAX_OBJECT:
+        with f:
+            file = await asyncio.to_thread(f.read)
+        memory_cache.put(path, file, expiry, etag, last_modified)
+        return AsyncResponse(file, headers=headers, media_type=mimetypes.guess_type(path)[0])
+
+    headers['Content-Length'] = str(size)
+    return StreamingResponse(async_file_chunks(f), headers=headers, media_type=mimetypes.guess_type(path)[0])
+
+
+async def async_file_chunks(f):
+    """
+    Reads an open file in chunks of size CHUNK_SIZE on a thread, and closes it when done.
+
+    :param f: The open file
+    :return: An async generator of the chunks of the file.
+    """
+    try:
+        while True:
+            piece = await asyncio.to_thread(f.read, CHUNK_SIZE)
+            if not piece:
+                return
+            yield piece
+    finally:
+        f.close()
+
+
+async def async_uncached_chunks(f):
+    """
+    The async counterpart of uncached_chunks, reading the chunks on a thread.
+
+    :param f: The open, unlinked file
+    :return: An async generator of the chunks of the file.
+    """
+    size = os.fstat(f.fileno()).st_size
+    for offset in range(0, size, CHUNK_SIZE):
+        yield await asyncio.to_thread(os.pread, f.fileno(), CHUNK_SIZE, offset)
+
+
+async def async_serve_stale(req, path, expiry, warning):
+    response = await async_serve_from_cache(req, path, expiry)
+    if response is not None:
+        response.headers['Warning'] = warning
+    return response
+
+
+async def async_revalidate(path):
+    """
+    The async counterpart of revalidate.
+
+    :param path: The path of the expired file
+    :return: True if the cached file is still valid, otherwise False.
+    """
+    etag, _ = file_store.get_validators(path)
+    source = async_origin_source()
+    if etag is None or source is None:
+        return False
+
+    try:
+        stat = await source.stat(path)
+    except grpc.RpcError as e:
+        logging.warning(f"Could not revalidate file {path}. {e.details()}")
+        return False
+
+    if stat.hash != etag:
+        return False
+
+    file_store.set_TTL(path)
+    return True
+
+
+def async_refresh_in_background(path):
+    """
+    The async counterpart of refresh_in_background, running the refresh as a task.
+
+    :param path: The path of the file to be refreshed
+    """
+    future, leader = async_fetches.begin(path)
+    if not leader:
+        return
+
+    async def refresh():
+        try:
+            if not await async_revalidate(path):
+                source = async_origin_source()
+                if source is None:
+                    raise RuntimeError(f"No live origin server to fetch {path} from")
+                await source.download(path)
+                memory_cache.invalidate(path)
+                chunk_store.invalidate(path)
+            async_fetches.finish(path, future)
+        except Exception as e:
+            logging.warning(f"Background refresh of file {path} failed. {str(e)}")
+            async_fetches.finish(path, future, error=e)
+
+    task = asyncio.create_task(refresh())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def async_open_origin_stream(address, path):
+    """
+    The async counterpart of open_origin_stream. Cancelling it cancels the call.
+
+    :param address: The address of the origin server
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks, the first chunk, and the seconds it took to arrive.
+    """
+    start = time.monotonic()
+    chunks = async_client(address).stream(path)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return chunks, first, time.monotonic() - start
+
+
+async def async_hedged_origin_stream(path):
+    """
+    The async counterpart of hedged_origin_stream.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the generator of the chunks and the first chunk.
+    """
+    remaining = origin_addresses()
+    pending = {}
+    hedges = 0
+    error = RuntimeError(f"No live origin server to fetch {path} from")
+
+    def launch():
+        address = remaining.pop(0)
+        pending[asyncio.ensure_future(async_open_origin_stream(address, path))] = address
+
+    if remaining:
+        launch()
+    try:
+        while pending:
+            delay = first_chunk_latency.hedge_delay() if remaining and hedges < HEDGE_MAX else None
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logging.info(f"Origin server {next(iter(pending.values()))} is slow to serve {path}, hedging to {remaining[0]}")
+                hedges += 1
+                launch()
+                continue
+
+            winner = None
+            for task in done:
+                address = pending.pop(task)
+                if task.exception() is not None:
+                    logging.warning(f"Origin server {address} failed to serve {path}. {str(task.exception())}")
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    await task.result()[0].aclose()
+
+            if winner is not None:
+                chunks, first, latency = winner.result()
+                first_chunk_latency.record(latency)
+                return chunks, first
+
+            # fail over to the next live server
+            if remaining and not pending:
+                launch()
+    finally:
+        # cancel the servers that lost, which discards their temp files
+        for task in pending:
+            task.cancel()
+
+    raise error
+
+
+async def async_stream_from_origin(path, future):
+    """
+    The async counterpart of stream_from_origin.
+
+    :param path: The path of the file to be downloaded
+    :param future: The future of the flight this request is the leader of
+    :return: A streaming response of the file data.
+    """
+    try:
+        chunks, first = await async_hedged_origin_stream(path)
+    except Exception as e:
+        async_fetches.finish(path, future, error=e)
+        raise
+
+    return async_stream_to_client(path, future, chunks, first)
+
+
+async def async_thread_chunks(chunks):
+    """
+    Iterates the chunks of a blocking fetch on a thread, so reading them does not block the event loop.
+
+    :param chunks: The generator of the chunks
+    :return: An async generator of the chunks.
+    """
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+
+async def async_peer_chunks(response, mtime):
+    """
+    The async counterpart of peer_chunks, which closes the response when done.
+
+    :param response: The open httpx response of the peer
+    :param mtime: The modification time of the file at the origin as a timestamp
+    :return: An async generator of Chunk messages.
+    """
+    try:
+        async for piece in response.aiter_bytes(CHUNK_SIZE):
+            yield ops_pb2.Chunk(buffer=piece, mtime=mtime)
+    finally:
+        await response.aclose()
+
+
+async def async_open_peer_stream(peer, path, only_if_cached=False):
+    """
+    The async counterpart of open_peer_stream, using the pooled connections of peer_http.
+    Cancelling it closes the request.
+
+    :param peer: The URL of the proxy
+    :param path: The path of the file to be downloaded
+    :param only_if_cached: If True, the peer only serves the file if it has a fresh copy cached
+    :return: A tuple of the async generator of the chunks and the first chunk, or None if the peer
+    did not serve the file.
+    """
+    headers = {'Via': f'1.1 {PROXY_ADDRESS or AREA}'}
+    if only_if_cached:
+        headers['Cache-Control'] = 'only-if-cached'
+    url = f"{peer.rstrip('/')}/{urllib.parse.quote(path)}?area={AREA}"
+    timeout = PEER_TIMEOUT if only_if_cached else SHIELD_TIMEOUT
+
+    try:
+        response = await peer_http.send(peer_http.build_request('GET', url, headers=headers, timeout=timeout),
+                                        stream=True)
+        if response.status_code != 200:
+            await response.aclose()
+            # a 504 is how a peer says it does not have the file cached
+            if response.status_code != 504 or not only_if_cached:
+                logging.warning(f"Proxy {peer} failed to serve {path}. {response.status_code} {response.reason_phrase}")
+            return None
+
+        last_modified = parse_date(response.headers.get('Last-Modified'))
+        mtime = last_modified.timestamp() if last_modified else 0
+        chunks = file_store.async_tee_chunks_to_file(async_peer_chunks(response, mtime), path)
+        try:
+            return chunks, await chunks.__anext__()
+        except StopAsyncIteration:
+            return chunks, None
+    except Exception as e:
+        logging.warning(f"Proxy {peer} failed to serve {path}. {str(e)}")
+    return None
+
+
+def async_close_peer_stream(task):
+    """
+    The async counterpart of close_peer_stream, closing the stream of a finished sibling request
+    in a background task.
+
+    :param task: The task of async_open_peer_stream
+    """
+    if task.cancelled() or task.result() is None:
+        return
+    closing = asyncio.ensure_future(task.result()[0].aclose())
+    background_tasks.add(closing)
+    closing.add_done_callback(background_tasks.discard)
+
+
+async def async_sibling_stream(path):
+    """
+    The async counterpart of sibling_stream. The siblings that have not answered once one serves
+    the file, or the budget runs out, are cancelled.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the async generator of the chunks and the first chunk, or None if no
+    sibling served the file in time.
+    """
+    pending = {asyncio.create_task(async_open_peer_stream(sibling, path, True)): sibling for sibling in SIBLINGS}
+    deadline = time.monotonic() + PEER_TIMEOUT
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None
+            for task in done:
+                sibling = pending.pop(task)
+                if task.result() is not None:
+                    logging.info(f"Fetching file {path} from sibling proxy {sibling}")
+                    return task.result()
+        return None
+    finally:
+        # siblings that answered alongside the winner are closed, the rest are cancelled
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(async_close_peer_stream)
+
+
+async def async_peer_stream(path):
+    """
+    The async counterpart of peer_stream.
+
+    :param path: The path of the file to be downloaded
+    :return: A tuple of the async generator of the chunks and the first chunk, or None if the file
+    should be fetched from the origin.
+    """
+    if SIBLINGS:
+        stream = await async_sibling_stream(path)
+        if stream is not None:
+            return stream
+
+    if SHIELD:
+        stream = await async_open_peer_stream(SHIELD, path)
+        if stream is not None:
+            logging.info(f"Fetching file {path} through shield proxy {SHIELD}")
+            return stream
+
+    return None
+
+
+async def async_stream_from_peers(path, future):
+    """
+    The async counterpart of stream_from_peers.
+
+    :param path: The path of the file to be downloaded
+    :param future: The future of the flight this request is the leader of
+    :return: A streaming response of the file data, or None if no peer served the file and it
+    should be fetched from the origin.
+    """
+    stream = await async_peer_stream(path)
+    if stream is None:
+        return None
+    return async_stream_to_client(path, future, *stream)
+
+
+def async_stream_to_client(path, future, chunks, first):
+    """
+    The async counterpart of stream_to_client.
+
+    :param path: The path of the file being downloaded
+    :param future: The future of the flight this request is the leader of
+    :param chunks: The async generator of the chunks after the first, which fills the cache
+    :param first: The first chunk, or None if the file is empty
+    :return: A streaming response of the file data.
+    """
+    async def generate():
+        completed = False
+        sent = 0
+        try:
+            if first is not None:
+                sent += len(first.buffer)
+                yield first.buffer
+            async for chunk in chunks:
+                sent += len(chunk.buffer)
+                yield chunk.buffer
+            completed = True
+        finally:
+            # runs when the stream ends, including when the client disconnects mid-stream
+            await chunks.aclose()
+            file_store.record_miss(sent)
+            if completed:
+                chunk_store.invalidate(path)
+            async_fetches.finish(path, future, error=None if completed else FetchAborted(path))
+
+    headers = {}
+    if first is not None and first.mtime:
+        headers['Last-Modified'] = http_date(first.mtime)
+    return StreamingResponse(generate(), headers=headers, media_type=mimetypes.guess_type(path)[0])
+
+
+async def async_serve_GET(req):
+    """
+    The async counterpart of serve_GET. Latency is simulated with asyncio.sleep and origin
+    fetches use grpc.aio, so a slow request does not hold a thread.
+
+    :param req: The request being served
+    :return: The response serving the file.
+    """
+    path = req.path_params['path']
+    if not is_valid_key(path):
+        return AsyncResponse(status_code=404)
+
+    if 'only-if-cached' in req.headers.get('cache-control', '') and not has_fresh_copy(path):
+        return AsyncResponse(status_code=504)
+
+    await asyncio.sleep(introduce_latency(req.query_params.get("area")))
+    file_store.record_request(path)
+
+    cached = memory_cache.get(path)
+    if cached is not None:
+        file, etag, last_modified = cached
+        file_store.record_access(path)
+        file_store.record_hit(len(file))
+        logging.info(f"Served file {path}. Request was a memory cache hit")
+        if is_not_modified(req.headers, etag, last_modified):
+            return AsyncResponse(status_code=304, headers=validator_headers(etag, last_modified))
+        return AsyncResponse(file, headers=validator_headers(etag, last_modified), media_type=mimetypes.guess_type(path)[0])
+
+    expiry = file_store.get_expiry(path)
+
+    # a cached file evicted before it could be opened is treated as a miss
+    if expiry is not None and expiry >= datetime.now():
+        response = await async_serve_from_cache(req, path, expiry)
+        if response is not None:
+            logging.info(f"Served file {path}. Request was a cache hit")
+            return response
+        expiry = None
+
+    if 'only-if-cached' in req.headers.get('cache-control', ''):
+        return AsyncResponse(status_code=504)
+
+    if is_stale_within(expiry, STALE_WHILE_REVALIDATE):
+        async_refresh_in_background(path)
+        response = await async_serve_stale(req, path, expiry, '110 - "Response is Stale"')
+        if response is not None:
+            logging.info(f"Served stale file {path} while it is refreshed in the background")
+            return response
+        expiry = None
+
+    if is_stale_within(expiry, STALE_IF_ERROR) and not any(liveliness.values()):
+        response = await async_serve_stale(req, path, expiry, '111 - "Revalidation Failed"')
+        if response is not None:
+            logging.warning(f"Served stale file {path}. Every origin server is dead")
+            return response
+        expiry = None
+
+    if expiry is not None and await async_revalidate(path):
+        response = await async_serve_from_cache(req, path, file_store.get_expiry(path))
+        if response is not None:
+            logging.info(f"Served file {path}. Expired copy was revalidated with the origin")
+            return response
+        expiry = None
+
+    # Only the first request to miss fetches from the origin, the rest wait for it to finish
+    while True:
+        future, leader = async_fetches.begin(path)
+        if leader:
+            break
+
+        try:
+            with load.queued():
+                uncached = await asyncio.shield(future)
+        except FetchAborted:
+            continue
+        except Exception:
+            response = None
+            if is_stale_within(expiry, STALE_IF_ERROR):
+                response = await async_serve_stale(req, path, expiry, '111 - "Revalidation Failed"')
+            if response is None:
+                raise
+            logging.warning(f"Served stale file {path}. The origin fetch it waited on failed")
+            return response
+
+        fetched_expiry = file_store.get_expiry(path)
+        response = await async_serve_from_cache(req, path, fetched_expiry) if fetched_expiry is not None else None
+        if response is None and uncached is not None:
+            logging.info(f"Served file {path}. Request waited on an origin fetch the cache did not admit")
+            headers = {'Content-Length': str(os.fstat(uncached.fileno()).st_size)}
+            return StreamingResponse(async_uncached_chunks(uncached), headers=headers,
+                                     media_type=mimetypes.guess_type(path)[0])
+        if response is None:
+            continue
+
+        logging.info(f"Served file {path}. Request waited on an in-flight origin fetch")
+        return response
+
+    if 'via' not in req.headers:
+        response = await async_stream_from_peers(path, future)
+        if response is not None:
+            logging.info(f"Served file {path}. Request was a cache miss fetched from a peer proxy")
+            return response
+
+    stream = await asyncio.to_thread(striped_origin_stream, path)
+    if stream is not None:
+        chunks, first = stream
+        logging.info(f"Served file {path}. Request was a cache miss")
+        return async_stream_to_client(path, future, async_thread_chunks(chunks), first)
+
+    try:
+        response = await async_stream_from_origin(path, future)
+    except Exception:
+        response = None
+        if is_stale_within(expiry, STALE_IF_ERROR):
+            response = await async_serve_stale(req, path, expiry, '111 - "Revalidation Failed"')
+        if response is None:
+            raise
+        logging.warning(f"Served stale file {path}. The origin fetch failed")
+        return response
+
+    logging.info(f"Served file {path}. Request was a cache miss")
+    return response
+
+
+async_app = Starlette(routes=[Route('/{path:path}', async_serve_GET)])
+wsgi_app = WsgiToAsgi(app)
+
+
+async def asgi_app(scope, receive, send):
+    """
+    The ASGI entry point of the async proxy mode. Plain GETs for files are served by the asyncio
+    handlers, everything else (ranges, heartbeats, stats, other methods) falls back to the Flask
+    app running in a thread pool.
+    """
+    if scope['type'] == 'http':
+        headers = dict(scope['headers'])
+        if (scope['method'] != 'GET' or b'range' in headers
+                or scope['path'] in ('/',) + UNTRACKED_PATHS):
+            await wsgi_app(scope, receive, send)
+            return
+
+        start = load.start()
+        try:
+            await async_app(scope, receive, send)
+        finally:
+            load.finish(start)
+        return
+
+    await async_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    th = Thread(target=check_liveliness, args=(liveliness,))
+    th.start()
+    Thread(target=file_store.index.run_snapshots, daemon=True).start()
+    Thread(target=file_store.run_eviction, daemon=True).start()
+    if LOAD_BALANCER and PROXY_ADDRESS and ADMIN_TOKEN:
+        Thread(target=register_with_load_balancer, daemon=True).start()
+    elif LOAD_BALANCER and PROXY_ADDRESS:
+        logging.warning('Not registering with the load balancer, ADMIN_TOKEN is not set')
+
+    if PROXY_MODE == 'async':
+        uvicorn.run(asgi_app, host="0.0.0.0", port=int(PORT), log_level="warning")
+    else:
+        app.run(debug=False, host="0.0.0.0", port=PORT)
 
 
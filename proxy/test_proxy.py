@@ -0,0 +1,660 @@
+import os
+import json
+import time
+import types
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+import grpc
+import pytest
+
+import ops_pb2
+import file_server
+
+
+@pytest.fixture
+def proxy(load_service, tmp_path):
+    return load_service('proxy', CACHE_DIR=f'{tmp_path}/cache/', ORIGIN_BACKUPS='8002,8003', BASE_LATENCY=0)
+
+
+def later(seconds=60):
+    return datetime.now() + timedelta(seconds=seconds)
+
+
+def chunks(*pieces, mtime=0):
+    return iter([ops_pb2.Chunk(buffer=piece, mtime=mtime) for piece in pieces])
+
+
+def test_memory_cache_promotes_on_the_second_hit_and_evicts_probation_first(proxy):
+    cache = proxy.MemoryCache(capacity=30, protected_ratio=0.5)
+    cache.put('hot', b'h' * 10, later())
+    assert cache.get('hot') == (b'h' * 10, None, None)
+    assert 'hot' in cache.protected
+
+    cache.put('a', b'a' * 10, later())
+    cache.put('b', b'b' * 10, later())
+    cache.put('c', b'c' * 10, later())
+    assert cache.get('a') is None
+    assert cache.get('hot') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_files_removed_from_disk_are_dropped_from_memory(proxy):
+    proxy.file_store.save_chunks_to_file(chunks(b'cached'), 'file.txt')
+    client = proxy.app.test_client()
+    client.get('/file.txt')
+    assert proxy.memory_cache.get('file.txt') is not None
+
+    proxy.file_store.remove('file.txt')
+    assert proxy.memory_cache.get('file.txt') is None
+
+
+def test_memory_cache_skips_expired_and_oversized_objects(proxy):
+    cache = proxy.MemoryCache(capacity=10)
+    cache.put('big', b'x' * 11, later())
+    cache.put('old', b'x', datetime.now() - timedelta(seconds=1))
+    assert cache.stats()['objects'] == 0
+
+    cache.put('soon', b'x', later(0.05))
+    time.sleep(0.1)
+    assert cache.get('soon') is None
+
+
+def test_single_flight_hands_the_result_to_every_waiter(proxy):
+    flights = proxy.SingleFlight()
+    flight, leader = flights.begin('key')
+    assert leader
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(flights.begin('key')[0].wait())) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while flight.waiters < 3:
+        time.sleep(0.01)
+
+    flights.finish('key', flight, result='done')
+    for waiter in waiters:
+        waiter.join()
+    assert results == ['done'] * 3
+    assert flights.begin('key')[1]
+
+
+def test_single_flight_raises_the_error_to_the_waiters(proxy):
+    flights = proxy.SingleFlight()
+    flight, _ = flights.begin('key')
+    waiter, leader = flights.begin('key')
+    assert waiter is flight and not leader
+
+    flights.finish('key', flight, error=proxy.FetchAborted('key'))
+    with pytest.raises(proxy.FetchAborted):
+        waiter.wait()
+
+
+def test_tee_commits_the_file_with_its_validators_once_exhausted(proxy):
+    tee = proxy.file_store.tee_chunks_to_file(chunks(b'hello ', b'world', mtime=1234), 'dir/file')
+    assert next(tee).buffer == b'hello '
+    assert proxy.file_store.get_expiry('dir/file') is None
+
+    assert [chunk.buffer for chunk in tee] == [b'world']
+    assert proxy.file_store.get('dir/file') == b'hello world'
+    assert proxy.file_store.get_validators('dir/file') == (hashlib.sha256(b'hello world').hexdigest(), 1234)
+
+
+def test_tee_discards_the_temp_file_when_closed_early(proxy):
+    tee = proxy.file_store.tee_chunks_to_file(chunks(b'hello ', b'world'), 'file')
+    next(tee)
+    tee.close()
+
+    assert proxy.file_store.get_expiry('file') is None
+    assert not [name for name in os.listdir(proxy.file_store.cache) if name.endswith('.tmp')]
+
+
+def test_cache_hits_are_served_from_disk_and_then_memory(proxy):
+    proxy.file_store.save_chunks_to_file(chunks(b'cached'), 'file.txt')
+    client = proxy.app.test_client()
+
+    response = client.get('/file.txt')
+    assert response.data == b'cached'
+    assert client.get('/file.txt', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert proxy.memory_cache.stats()['hits'] == 1
+
+
+def expire(proxy, path, seconds=1):
+    proxy.file_store.index.set_expiry(path, datetime.now() - timedelta(seconds=seconds))
+
+
+def stat_origin(proxy, monkeypatch, digest):
+    origin = types.SimpleNamespace(stat=lambda path: types.SimpleNamespace(hash=digest),
+                                   download=lambda path: pytest.fail('the file was downloaded again'))
+    monkeypatch.setattr(proxy, 'clients', {'origin:8001': origin})
+    monkeypatch.setattr(proxy, 'liveliness', {'origin:8001': True})
+
+
+def test_expired_files_with_an_unchanged_hash_are_revalidated_instead_of_downloaded(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'cached'), 'file.txt')
+    expire(proxy, 'file.txt')
+    stat_origin(proxy, monkeypatch, hashlib.sha256(b'cached').hexdigest())
+
+    assert proxy.app.test_client().get('/file.txt').data == b'cached'
+    assert proxy.file_store.get_expiry('file.txt') > later(proxy.TTL - 5)
+
+
+def test_expired_files_with_a_changed_hash_are_not_revalidated(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'cached'), 'file.txt')
+    expire(proxy, 'file.txt')
+    stat_origin(proxy, monkeypatch, hashlib.sha256(b'changed').hexdigest())
+
+    assert not proxy.revalidate('file.txt')
+    assert proxy.file_store.get_expiry('file.txt') < datetime.now()
+
+
+def test_stale_files_are_served_while_they_are_refreshed_in_the_background(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'stale'), 'file.txt')
+    expire(proxy, 'file.txt')
+    refreshed = []
+    monkeypatch.setattr(proxy, 'STALE_WHILE_REVALIDATE', 60)
+    monkeypatch.setattr(proxy, 'refresh_in_background', refreshed.append)
+
+    response = proxy.app.test_client().get('/file.txt')
+    assert (response.data, response.headers['Warning']) == (b'stale', '110 - "Response is Stale"')
+    assert refreshed == ['file.txt']
+
+
+def test_stale_files_are_served_when_every_origin_server_is_dead(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'stale'), 'file.txt')
+    expire(proxy, 'file.txt')
+    monkeypatch.setattr(proxy, 'STALE_IF_ERROR', 60)
+
+    response = proxy.app.test_client().get('/file.txt')
+    assert (response.data, response.headers['Warning']) == (b'stale', '111 - "Revalidation Failed"')
+
+
+def test_stale_files_are_only_served_within_the_stale_if_error_window(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'stale'), 'file.txt')
+    expire(proxy, 'file.txt', seconds=120)
+    monkeypatch.setattr(proxy, 'STALE_IF_ERROR', 60)
+
+    assert proxy.app.test_client().get('/file.txt').status_code == 500
+
+
+def test_cache_index_replays_the_journal_and_ignores_a_torn_line(proxy, tmp_path):
+    index = proxy.CacheIndex(str(tmp_path))
+    index.put('a', 10, later(), etag='abc')
+    index.put('b', 20, later())
+    index.remove('b')
+    index.journal.write('{"op": "put", "key": "torn"')
+    index.journal.flush()
+
+    reloaded = proxy.CacheIndex(str(tmp_path))
+    assert set(reloaded.entries) == {'a'}
+    assert reloaded.get('a').etag == 'abc'
+    assert reloaded.stats() == {'objects': 1, 'bytes': 10}
+
+    with open(reloaded.snapshot_path) as f:
+        assert set(json.load(f)) == {'a'}
+
+
+def test_cache_metadata_cannot_be_requested(proxy, tmp_path):
+    proxy.chunk_store.set_size('file', 10)
+    journal = os.path.join(proxy.file_store.index.directory, 'journal')
+    assert not journal.startswith(proxy.file_store.cache)
+    assert not proxy.chunk_store.cache.startswith(proxy.file_store.cache)
+
+    client = proxy.app.test_client()
+    for path in ('/.index/journal', '/.chunks/file/meta', '/a/../b', '/a/.hidden'):
+        assert client.get(path, headers={'Via': '1.1 proxy'}).status_code == 404
+    assert asyncio.run(asgi_get(proxy.async_app, '/.index/journal'))[0] == 404
+    assert not os.path.exists(f'{tmp_path}/cache/.index')
+
+
+def entries(proxy, *specs):
+    return [(key, proxy.IndexEntry(1, later(), last_access, hits=hits)) for key, last_access, hits in specs]
+
+
+def victims(policy):
+    order = []
+    key = policy.victim()
+    while key is not None:
+        order.append(key)
+        policy.discard(key)
+        key = policy.victim()
+    return order
+
+
+def test_lru_and_lfu_victim_orders(proxy):
+    items = entries(proxy, ('old', 1, 5), ('new', 3, 0), ('middle', 2, 0))
+    lru, lfu = proxy.LRUPolicy(), proxy.LFUPolicy()
+    lru.load(items)
+    lfu.load(items)
+
+    assert victims(lru) == ['old', 'middle', 'new']
+    assert victims(lfu) == ['middle', 'new', 'old']
+
+
+def test_victim_orders_follow_each_access_without_a_sort(proxy):
+    items = dict(entries(proxy, ('a', 1, 0), ('b', 2, 0), ('c', 3, 0)))
+    lru, lfu = proxy.LRUPolicy(), proxy.LFUPolicy()
+    lru.load(list(items.items()))
+    lfu.load(list(items.items()))
+
+    items['a'].hits += 1
+    lru.update('a', items['a'])
+    lfu.update('a', items['a'])
+    assert lru.victim() == lfu.victim() == 'b'
+    assert victims(lru) == ['b', 'c', 'a']
+    assert victims(lfu) == ['b', 'c', 'a']
+
+
+def test_tinylfu_only_admits_files_more_popular_than_the_victim(proxy):
+    policy = proxy.TinyLFUPolicy()
+    for _ in range(3):
+        policy.record('popular')
+    policy.record('one-off')
+
+    assert policy.admit('popular', 'one-off')
+    assert not policy.admit('one-off', 'popular')
+
+
+def test_evict_removes_files_down_to_the_low_watermark(proxy, tmp_path):
+    store = proxy.FileStore(f'{tmp_path}/bounded/', capacity=100)
+    for i in range(5):
+        store.save_chunks_to_file(chunks(b'x' * 30), str(i))
+        store.index.entries[str(i)].last_access = i
+    assert store.index.bytes == 150
+
+    store.evict()
+    assert sorted(store.index.entries) == ['2', '3', '4']
+    assert not os.path.exists(f'{tmp_path}/bounded/0')
+    assert store.stats()['evictions'] == 2
+
+
+def test_evict_follows_the_accesses_since_the_files_were_cached(proxy, tmp_path):
+    store = proxy.FileStore(f'{tmp_path}/bounded/', capacity=100)
+    for i in range(5):
+        store.save_chunks_to_file(chunks(b'x' * 30), str(i))
+    store.record_access('0')
+
+    store.evict()
+    assert sorted(store.index.entries) == ['0', '3', '4']
+
+
+def test_cached_chunks_count_towards_the_capacity_and_are_evicted(proxy, tmp_path):
+    store = proxy.FileStore(f'{tmp_path}/bounded/', capacity=100)
+    store.chunks.set_size('ranged', 1000)
+    store.chunks.save_chunk('ranged', 0, b'x' * 60)
+    store.chunks.save_chunk('ranged', 0, b'x' * 60)
+    store.save_chunks_to_file(chunks(b'x' * 50), 'file')
+    assert store.index.bytes == 110
+
+    store.evict()
+    assert sorted(store.index.entries) == ['file']
+    assert store.chunks.get_size('ranged') is None
+    assert not store.chunks.has_chunk('ranged', 0)
+
+
+def test_waiters_are_served_from_a_download_the_cache_did_not_admit(proxy, monkeypatch):
+    flight, _ = proxy.origin_fetches.begin('file.txt')
+    monkeypatch.setattr(proxy.file_store, 'admit', lambda key, size: False)
+    monkeypatch.setattr(proxy, 'hedged_origin_stream', lambda path: pytest.fail('fetched the file again'))
+    responses = []
+    waiter = threading.Thread(target=lambda: responses.append(proxy.app.test_client().get('/file.txt')))
+    waiter.start()
+    while flight.waiters < 1:
+        time.sleep(0.01)
+
+    proxy.file_store.save_chunks_to_file(chunks(b'not ', b'admitted'), 'file.txt')
+    proxy.origin_fetches.finish('file.txt', flight)
+    waiter.join()
+    assert proxy.file_store.get_expiry('file.txt') is None
+    assert (responses[0].status_code, responses[0].data) == (200, b'not admitted')
+
+
+def test_files_evicted_before_they_are_opened_are_cache_misses(proxy, monkeypatch):
+    proxy.file_store.save_chunks_to_file(chunks(b'stale copy'), 'file.txt')
+    os.unlink(proxy.file_store.get_path('file.txt'))
+    assert proxy.serve_from_cache('file.txt', later()) is None
+
+    monkeypatch.setattr(proxy, 'hedged_origin_stream', lambda path: (iter(()), ops_pb2.Chunk(buffer=b'fresh copy')))
+    response = proxy.app.test_client().get('/file.txt')
+    assert (response.status_code, response.data) == (200, b'fresh copy')
+
+
+async def body(response):
+    return b''.join([piece async for piece in response.body_iterator])
+
+
+def test_async_files_evicted_before_they_are_opened_are_cache_misses(proxy):
+    proxy.file_store.save_chunks_to_file(chunks(b'x' * (proxy.MEMORY_CACHE_MAX_OBJECT + 1)), 'big')
+    request = types.SimpleNamespace(headers={})
+    response = asyncio.run(proxy.async_serve_from_cache(request, 'big', later()))
+
+    # the open file is still read after it is unlinked
+    os.unlink(proxy.file_store.get_path('big'))
+    assert len(asyncio.run(body(response))) == int(response.headers['Content-Length'])
+    assert asyncio.run(proxy.async_serve_from_cache(request, 'big', later())) is None
+
+
+async def asgi_get(app, path):
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path,
+             'raw_path': path.encode(), 'query_string': b'', 'root_path': '', 'headers': [],
+             'server': ('proxy', 5000), 'client': ('127.0.0.1', 1234)}
+    messages = []
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # the client stays connected until the response is sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def test_async_misses_are_fetched_from_the_origin_and_cached(proxy, tmp_path, grpc_server, monkeypatch):
+    monkeypatch.setattr(file_server, 'time', types.SimpleNamespace(sleep=lambda seconds: None, time=time.time))
+    origin = file_server.FileServer(f'{tmp_path}/origin/')
+    data = os.urandom(3 * proxy.CHUNK_SIZE + 10)
+    origin.store.save([ops_pb2.Chunk(name='big', buffer=data)])
+    address = grpc_server(origin)
+    monkeypatch.setattr(proxy, 'liveliness', {'origin:8001': True})
+
+    async def requests():
+        # grpc.aio clients belong to the event loop they are created in
+        proxy.async_clients['origin:8001'] = proxy.AsyncFileClient(address, proxy.file_store)
+        first = await asgi_get(proxy.async_app, '/big')
+        origin.store.save([ops_pb2.Chunk(name='big', buffer=b'changed')])
+        return first, await asgi_get(proxy.async_app, '/big')
+
+    first, second = asyncio.run(requests())
+    assert first == second == (200, data)
+    assert proxy.file_store.get('big') == data
+
+
+def test_ranges_are_cached_in_chunk_size_pieces_whatever_the_origin_chunk_size(load_service, tmp_path, grpc_server,
+                                                                             monkeypatch):
+    proxy = load_service('proxy', CACHE_DIR=f'{tmp_path}/cache/', ORIGIN_BACKUPS='8002,8003', BASE_LATENCY=0,
+                         ORIGIN_CHUNK_SIZE=256 * 1024)
+    monkeypatch.setattr(file_server, 'time', types.SimpleNamespace(sleep=lambda seconds: None, time=time.time))
+    origin = file_server.FileServer(f'{tmp_path}/origin/')
+    data = os.urandom(2 * proxy.CHUNK_SIZE + 1000)
+    # chunks that do not line up with CHUNK_SIZE, as a client uploading in other sizes leaves them
+    origin.store.save(ops_pb2.Chunk(name='big', buffer=data[i:i + 700 * 1024]) for i in range(0, len(data), 700 * 1024))
+    monkeypatch.setattr(proxy, 'clients', {'origin:8001': proxy.FileClient(grpc_server(origin), proxy.file_store)})
+    monkeypatch.setattr(proxy, 'liveliness', {'origin:8001': True})
+    client = proxy.app.test_client()
+
+    start = proxy.CHUNK_SIZE + 100
+    assert client.get('/big', headers={'Range': f'bytes={start}-{start + 99}'}).data == data[start:start + 100]
+    assert proxy.chunk_store.get_chunk('big', 1) == data[proxy.CHUNK_SIZE:2 * proxy.CHUNK_SIZE]
+
+    assert client.get('/big', headers={'Range': f'bytes=10-{len(data) - 1}'}).data == data[10:]
+    assert proxy.file_store.get('big') == data
+
+
+def test_concurrent_requests_for_a_chunk_fetch_it_once(proxy, monkeypatch):
+    data = os.urandom(proxy.CHUNK_SIZE + 10)
+    release, fetches = threading.Event(), []
+
+    def stream_range(path, offset, length):
+        fetches.append(offset)
+        release.wait()
+        return iter([ops_pb2.Chunk(buffer=data[offset:offset + length], offset=offset, size=len(data))])
+
+    monkeypatch.setattr(proxy, 'origin_source', lambda: types.SimpleNamespace(stream_range=stream_range))
+    responses = []
+    requests = [threading.Thread(target=lambda: responses.append(
+        proxy.app.test_client().get('/big', headers={'Range': 'bytes=10-19'}))) for _ in range(3)]
+    for thread in requests:
+        thread.start()
+    while not fetches or proxy.chunk_fetches.flights[('big', 0)].waiters < 2:
+        time.sleep(0.01)
+
+    release.set()
+    for thread in requests:
+        thread.join()
+    assert fetches == [0]
+    assert [(response.status_code, response.data) for response in responses] == [(206, data[10:20])] * 3
+
+
+def test_open_ended_ranges_from_the_start_are_fetched_as_a_whole_file(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'origin_source', lambda: pytest.fail('fetched a range'))
+    monkeypatch.setattr(proxy, 'hedged_origin_stream', lambda path: (iter(()), ops_pb2.Chunk(buffer=b'whole file')))
+
+    response = proxy.app.test_client().get('/file.txt', headers={'Range': 'bytes=0-'})
+    assert (response.status_code, response.data) == (200, b'whole file')
+    assert proxy.chunk_store.get_size('file.txt') is None
+
+
+def test_idle_pooled_channels_survive_keepalive_pings(load_service, tmp_path, grpc_server):
+    proxy = load_service('proxy', CACHE_DIR=f'{tmp_path}/cache/', ORIGIN_BACKUPS='8002,8003', BASE_LATENCY=0,
+                         KEEPALIVE_TIME=1)
+    address = grpc_server(file_server.FileServer(f'{tmp_path}/origin/'), options=file_server.SERVER_OPTIONS)
+    channel = proxy.channels.get(address)
+    states = []
+    channel.subscribe(states.append, try_to_connect=True)
+
+    # a server that allows fewer pings than the proxy sends answers them with a GOAWAY too_many_pings
+    time.sleep(6)
+    channel.unsubscribe(states.append)
+    channel.close()
+    assert grpc.ChannelConnectivity.READY in states
+    assert states[states.index(grpc.ChannelConnectivity.READY):] == [grpc.ChannelConnectivity.READY]
+
+
+def test_hedge_delay_follows_the_recent_latencies(proxy):
+    window = proxy.LatencyWindow()
+    assert window.hedge_delay() == proxy.HEDGE_DELAY
+    for i in range(100):
+        window.record(i / 100)
+    assert window.hedge_delay() == pytest.approx(0.94)
+
+
+class FakeClient:
+    def __init__(self, delay, pieces=(b'data',), error=None):
+        self.delay = delay
+        self.pieces = pieces
+        self.error = error
+        self.closed = False
+
+    def start_stream(self, target_name):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+        def stream():
+            try:
+                yield from chunks(*self.pieces)
+            finally:
+                self.closed = True
+
+        return types.SimpleNamespace(cancel=lambda: None), stream()
+
+
+def origins(proxy, monkeypatch, primary, backup):
+    monkeypatch.setattr(proxy, 'HEDGE_DELAY', 0.1)
+    monkeypatch.setattr(proxy, 'clients', {'origin:8001': primary, 'origin_backup1:8002': backup})
+    monkeypatch.setattr(proxy, 'liveliness', {'origin:8001': True, 'origin_backup1:8002': True})
+
+
+def test_a_slow_origin_fetch_is_hedged_to_a_backup(proxy, monkeypatch):
+    primary, backup = FakeClient(1, [b'primary']), FakeClient(0, [b'backup'])
+    origins(proxy, monkeypatch, primary, backup)
+
+    start = time.monotonic()
+    stream, first = proxy.hedged_origin_stream('file')
+    assert first.buffer == b'backup'
+    assert time.monotonic() - start < 0.5
+
+    # the losing stream is closed once it delivers its first chunk, which discards its temp file
+    deadline = time.monotonic() + 5
+    while not primary.closed:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_a_failed_origin_fetch_fails_over_to_a_backup(proxy, monkeypatch):
+    origins(proxy, monkeypatch, FakeClient(0, error=RuntimeError('down')), FakeClient(0, [b'backup']))
+
+    assert proxy.hedged_origin_stream('file')[1].buffer == b'backup'
+
+
+class StalledServer(file_server.FileServer):
+    def get_range(self, request, context):
+        time.sleep(3)
+        yield from super().get_range(request, context)
+
+
+@pytest.fixture
+def striping(load_service, tmp_path, grpc_server, monkeypatch):
+    """
+    A proxy striping files over 64KB across an origin and a backup holding the same file.
+    """
+    def start(backup_class=file_server.FileServer):
+        proxy = load_service('proxy', CACHE_DIR=f'{tmp_path}/cache/', ORIGIN_BACKUPS='8002', BASE_LATENCY=0,
+                             STRIPE_THRESHOLD=64 * 1024, STRIPE_SIZE=64 * 1024, STRIPE_TIMEOUT=1)
+        monkeypatch.setattr(file_server, 'time', types.SimpleNamespace(sleep=lambda seconds: None, time=time.time))
+        data = os.urandom(5 * 64 * 1024 + 100)
+        servers = [file_server.FileServer(f'{tmp_path}/origin/'), backup_class(f'{tmp_path}/backup/')]
+        for server in servers:
+            server.store.save([ops_pb2.Chunk(name='big', buffer=data)])
+        addresses = ['origin:8001', 'origin_backup1:8002']
+        monkeypatch.setattr(proxy, 'clients', {address: proxy.FileClient(grpc_server(server), proxy.file_store)
+                                               for address, server in zip(addresses, servers)})
+        monkeypatch.setattr(proxy, 'liveliness', dict.fromkeys(addresses, True))
+        return proxy, data
+
+    return start
+
+
+def test_striping_is_off_by_default(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'liveliness', {'origin:8001': True, 'origin_backup1:8002': True})
+    monkeypatch.setattr(proxy, 'clients', {})
+    assert proxy.striped_origin_stream('big') is None
+
+
+def test_striped_downloads_stream_the_file_and_cache_it(striping):
+    proxy, data = striping()
+
+    assert proxy.app.test_client().get('/big').data == data
+    assert proxy.file_store.get('big') == data
+    assert proxy.file_store.get_validators('big')[0] == hashlib.sha256(data).hexdigest()
+
+
+def test_stalled_stripes_are_fetched_from_another_server(striping):
+    proxy, data = striping(StalledServer)
+
+    start = time.monotonic()
+    chunks, first = proxy.striped_origin_stream('big')
+    # the first stripe is streamed while the backup stalls on the second
+    assert time.monotonic() - start < 1
+    assert b''.join([first.buffer] + [chunk.buffer for chunk in chunks]) == data
+    assert time.monotonic() - start < 3
+    assert proxy.file_store.get('big') == data
+
+
+def test_a_closed_striped_download_leaves_no_temp_file(striping):
+    proxy, data = striping(StalledServer)
+
+    chunks, first = proxy.striped_origin_stream('big')
+    chunks.close()
+    assert proxy.file_store.get_expiry('big') is None
+    assert not [name for name in os.listdir(proxy.file_store.cache) if name.endswith('.tmp')]
+
+
+def test_only_if_cached_misses_are_answered_with_a_504(proxy):
+    assert proxy.app.test_client().get('/missing', headers={'Cache-Control': 'only-if-cached'}).status_code == 504
+
+
+def test_peers_asking_for_a_missing_copy_do_not_wait_out_the_latency(load_service, tmp_path):
+    proxy = load_service('proxy', CACHE_DIR=f'{tmp_path}/cache/', ORIGIN_BACKUPS='8002,8003', BASE_LATENCY=1)
+    client = proxy.app.test_client()
+
+    start = time.monotonic()
+    assert client.get('/missing', headers={'Cache-Control': 'only-if-cached'}).status_code == 504
+    assert time.monotonic() - start < 0.5
+
+
+def sibling(delay, served):
+    def open_peer_stream(peer, path, only_if_cached=False):
+        time.sleep(delay[peer])
+        return ((chunk for chunk in ()), ops_pb2.Chunk(buffer=peer.encode())) if peer in served else None
+    return open_peer_stream
+
+
+def test_siblings_are_asked_at_once(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'SIBLINGS', ['a', 'b', 'c'])
+    monkeypatch.setattr(proxy, 'open_peer_stream', sibling({'a': 0.5, 'b': 0.5, 'c': 0.6}, {'c'}))
+
+    start = time.monotonic()
+    assert proxy.peer_stream('file')[1].buffer == b'c'
+    assert time.monotonic() - start < 1
+
+
+def test_siblings_get_a_bounded_budget(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'SIBLINGS', ['a', 'b'])
+    monkeypatch.setattr(proxy, 'PEER_TIMEOUT', 0.2)
+    monkeypatch.setattr(proxy, 'open_peer_stream', sibling({'a': 0.1, 'b': 2}, {'b'}))
+
+    start = time.monotonic()
+    assert proxy.peer_stream('file') is None
+    assert time.monotonic() - start < 0.5
+
+
+def test_the_shield_gets_longer_than_an_origin_miss_to_answer(proxy, monkeypatch):
+    timeouts = []
+
+    def urlopen(request, timeout):
+        timeouts.append(timeout)
+        raise OSError('unreachable')
+
+    monkeypatch.setattr(proxy.urllib.request, 'urlopen', urlopen)
+    assert proxy.open_peer_stream('http://shield', 'file') is None
+    assert proxy.open_peer_stream('http://sibling', 'file', only_if_cached=True) is None
+    assert timeouts == [proxy.SHIELD_TIMEOUT, proxy.PEER_TIMEOUT]
+
+
+def test_async_misses_are_fetched_from_peers_over_http(proxy, monkeypatch):
+    timeouts = {}
+
+    def handler(request):
+        timeouts[request.url.host] = request.extensions['timeout']['read']
+        assert 'Via' in request.headers
+        if request.url.host == 'sibling':
+            return proxy.httpx.Response(504)
+        return proxy.httpx.Response(200, content=b'from the shield')
+
+    monkeypatch.setattr(proxy, 'SIBLINGS', ['http://sibling'])
+    monkeypatch.setattr(proxy, 'SHIELD', 'http://shield')
+    monkeypatch.setattr(proxy, 'peer_http', proxy.httpx.AsyncClient(transport=proxy.httpx.MockTransport(handler)))
+
+    assert asyncio.run(asgi_get(proxy.async_app, '/file')) == (200, b'from the shield')
+    assert timeouts == {'sibling': proxy.PEER_TIMEOUT, 'shield': proxy.SHIELD_TIMEOUT}
+    assert proxy.file_store.get('file') == b'from the shield'
+
+
+def test_chunk_store_treats_an_unreadable_meta_file_as_a_miss(proxy):
+    proxy.chunk_store.set_size('file', 10)
+    proxy.chunk_store.meta.clear()
+    with open(os.path.join(proxy.chunk_store._dir('file'), 'meta'), 'w') as f:
+        f.write('{"size": 10')
+
+    assert proxy.chunk_store.get_size('file') is None
+    assert proxy.chunk_store.get_size('missing') is None
+
+
+def test_rejected_registrations_are_not_retried(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'LOAD_BALANCER', 'http://load_balancer:8000/')
+    monkeypatch.setattr(proxy, 'time', types.SimpleNamespace(sleep=lambda seconds: None))
+    answers = [503, 403]
+
+    def urlopen(req, timeout):
+        raise proxy.urllib.error.HTTPError(req.full_url, answers.pop(0), 'error', {}, None)
+
+    monkeypatch.setattr(proxy.urllib.request, 'urlopen', urlopen)
+    proxy.register_with_load_balancer()
+    assert answers == []